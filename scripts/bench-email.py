@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for the Gmail reorganization scripts.
+
+Runs organize-email.py, cleanup-email.py and delete-old-labels.py (dry
+run, the same dry run again from the metadata cache, then --execute, in
+that order) against a local fake Gmail server
+(fake_imap.py) holding a synthetic account (mailbox_gen.py), and reports
+wall time, commands, round trips and bytes for each run. Every round trip
+is delayed by --latency seconds to stand in for the network to
+imap.gmail.com.
+
+Usage:
+    python3 bench-email.py                       # 100, 1k and 10k labels
+    python3 bench-email.py --sizes 100,1000      # Chosen label counts
+    python3 bench-email.py --latency 0.05        # 50 ms per round trip
+    python3 bench-email.py --messages 100        # ~100 msgs per label (default 20)
+    python3 bench-email.py --throttle 50         # NO [THROTTLED] every 50th command
+    python3 bench-email.py --disconnect 200      # Drop the connection every 200th
+    python3 bench-email.py --server dovecot      # Non-Gmail server: a plain folder store
+    python3 bench-email.py --pipeline            # reorg-email.py (all phases, one session)
+    python3 bench-email.py --accounts 4          # reorg-email.py --accounts over 4 accounts
+    python3 bench-email.py --accounts 4 --parallel 1   # ... one account at a time
+    python3 bench-email.py --verbose             # Show the scripts' output
+"""
+
+import builtins
+import contextlib
+import getpass
+import io
+import os
+import sys
+import tempfile
+import time
+
+from fake_imap import DOVECOT_CAPABILITIES, GMAIL_CAPABILITIES, FakeIMAPServer
+from imap_session import RATE_PROFILE_ENV
+from mailbox_gen import generate, load_script
+
+SERVERS = {"gmail": GMAIL_CAPABILITIES, "dovecot": DOVECOT_CAPABILITIES}
+SCRIPTS = ["organize-email.py", "cleanup-email.py", "delete-old-labels.py"]
+EMAIL = "bench@example.com"
+PASSWORD = "bench-app-password"
+
+
+def option(name, default):
+    """Value following `name` in argv, or default."""
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+
+@contextlib.contextmanager
+def scripted_input(answers, verbose):
+    """Answer the scripts' prompts and silence their output."""
+    replies = iter(answers)
+    saved = builtins.input, getpass.getpass
+    builtins.input = lambda prompt="": next(replies)
+    getpass.getpass = lambda prompt="": PASSWORD
+    try:
+        if verbose:
+            yield
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+    finally:
+        builtins.input, getpass.getpass = saved
+
+
+def run_script(name, args, verbose):
+    """Run one script's main() in-process; returns wall seconds."""
+    module = load_script(name)
+    argv = sys.argv
+    sys.argv = [name] + args
+    t0 = time.perf_counter()
+    try:
+        with scripted_input([EMAIL, "yes", "yes"], verbose):
+            module.main()
+    except SystemExit as e:
+        if e.code:
+            print(f"  [!] {name} {' '.join(args)} exited with {e.code}")
+    finally:
+        sys.argv = argv
+    return time.perf_counter() - t0
+
+
+def main():
+    sizes = [int(s) for s in option("--sizes", "100,1000,10000").split(",")]
+    latency = float(option("--latency", "0.02"))
+    per_label = int(option("--messages", "20"))
+    seed = int(option("--seed", "1"))
+    throttle = int(option("--throttle", "0"))
+    disconnect = int(option("--disconnect", "0"))
+    jobs = option("--jobs", "4")
+    server_kind = option("--server", "gmail")
+    verbose = "--verbose" in sys.argv
+    n_accounts = int(option("--accounts", "1"))
+    scripts = ["reorg-email.py"] if "--pipeline" in sys.argv or n_accounts > 1 else SCRIPTS
+    extra = ["--jobs", jobs]
+    if n_accounts > 1:
+        # Batch mode: one generated account per address, all on one server
+        emails = [f"bench{i}@example.com" for i in range(n_accounts)]
+        extra += ["--accounts", ",".join(emails), "--yes",
+                  "--parallel", option("--parallel", str(n_accounts))]
+
+    # Plans and journals go to a scratch directory, not ~/.local/state
+    os.environ["XDG_STATE_HOME"] = tempfile.mkdtemp(prefix="gmail-reorg-bench-")
+    # The fake server needs no protecting: measure the scripts, not the limiter
+    os.environ[RATE_PROFILE_ENV] = "bench"
+
+    print("=" * 62)
+    print("  Gmail reorganization benchmark (fake IMAP server)")
+    print(f"  Latency {latency * 1000:.0f} ms/round trip, ~{per_label} msgs/label, "
+          f"--jobs {jobs}, {server_kind} capabilities"
+          + (f", {n_accounts} accounts" if n_accounts > 1 else ""))
+    print("=" * 62)
+    print()
+    print(f"  {'Script':<22} {'Mode':<8} {'Labels':>6} {'Wall s':>8} {'Cmds':>7} "
+          f"{'RTTs':>7} {'KiB in':>8} {'KiB out':>8}")
+    print("  " + "─" * 80)
+
+    for size in sizes:
+        t0 = time.perf_counter()
+        if n_accounts > 1:
+            account = {email: generate(seed + i, size, size * per_label)
+                       for i, email in enumerate(emails)}
+            n_messages = sum(len(a.messages) for a in account.values())
+        else:
+            account = generate(seed, size, size * per_label)
+            n_messages = len(account.messages)
+        build = time.perf_counter() - t0
+        server = FakeIMAPServer(account, SERVERS[server_kind], password=PASSWORD,
+                                latency=latency,
+                                throttle_every=throttle, disconnect_every=disconnect)
+        with server:
+            host, port = server.address
+            os.environ["GMAIL_REORG_SERVER"] = f"imap://{host}:{port}"
+            for name in scripts:
+                for mode, args in (("dry-run", []), ("cached", []),
+                                   ("execute", ["--execute"])):
+                    server.stats.reset()
+                    wall = run_script(name, args + extra, verbose)
+                    s = server.stats.snapshot()
+                    print(f"  {name:<22} {mode:<8} {size:>6} {wall:>8.2f} "
+                          f"{s['commands']:>7} {s['round_trips']:>7} "
+                          f"{s['bytes_in'] / 1024:>8.1f} {s['bytes_out'] / 1024:>8.1f}")
+        print(f"  ({n_messages} messages, built in {build:.2f}s)")
+        print()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted.")
@@ -9,61 +9,28 @@ Fixes:
   4. Handle straggler folders
 
 Usage:
-    python3 cleanup-email.py                # Dry-run (preview only)
+    python3 cleanup-email.py                # Dry-run (preview only, saves plan)
     python3 cleanup-email.py --execute      # Apply changes
+    python3 cleanup-email.py --apply [PLAN] # Apply the saved dry-run plan
+    python3 cleanup-email.py --execute --jobs 8   # Use 8 IMAP connections
+    python3 cleanup-email.py --profile [TRACE]    # Latency report (+ JSON trace)
+    python3 cleanup-email.py --refresh      # Ignore cached folder counts
+    python3 cleanup-email.py --offline      # Dry-run from the envelope index (index-email.py)
+    python3 cleanup-email.py --execute --yes      # Unattended: no prompts (see imap_credentials)
+    python3 cleanup-email.py --execute --snapshot DIR   # Export affected folders first (see imap_snapshot)
 """
 
 import imaplib
-import getpass
 import sys
-import re
-import time
 
-
-def imap_utf7_encode(text):
-    """Encode & as &- for IMAP modified UTF-7."""
-    return text.replace('&', '&-')
-
-
-def imap_encode(folder_name):
-    """Quote and encode folder name for IMAP."""
-    return '"' + imap_utf7_encode(folder_name) + '"'
-
-
-def imap_utf7_decode(text):
-    """Decode IMAP modified UTF-7 &- back to &."""
-    return text.replace('&-', '&')
-
-
-def parse_folder_list(response):
-    """Parse LIST response into folder names."""
-    folders = []
-    for item in response:
-        if isinstance(item, bytes):
-            item = item.decode("utf-8", errors="replace")
-        match = re.match(r'\(.*?\)\s+"(.+?)"\s+"?(.+?)"?\s*$', item)
-        if match:
-            name = imap_utf7_decode(match.group(2).strip('"'))
-            folders.append(name)
-        else:
-            match = re.match(r'\(.*?\)\s+"(.+?)"\s+(.+)', item)
-            if match:
-                name = imap_utf7_decode(match.group(2).strip('"'))
-                folders.append(name)
-    return sorted(folders)
-
-
-def get_message_count(imap, folder):
-    """Get number of messages in a folder."""
-    try:
-        status, data = imap.select(imap_encode(folder), readonly=True)
-        if status == "OK":
-            count = int(data[0])
-            imap.close()
-            return count
-    except Exception:
-        pass
-    return 0
+from imap_credentials import CredentialError, get_credentials
+from imap_folders import FolderTree, MovePlanner
+from imap_helpers import delete_refusal, imap_encode, move_all
+from imap_journal import (Journal, apply_arg, check_plan, journal_path,
+                          load_plan, plan_op, plan_path, save_plan)
+from imap_pool import run_parallel
+from imap_run import Context, offline_context
+from imap_trace import phase, profile_arg
 
 
 def rename_folder(imap, source, dest, dry_run=True):
@@ -84,26 +51,19 @@ def rename_folder(imap, source, dest, dry_run=True):
         return False
 
 
-def move_messages_and_delete(imap, source, dest, dry_run=True):
+def move_messages_and_delete(imap, counts, caps, source, dest, dry_run=True,
+                             progress=None):
     """Move all messages from source to dest, delete source."""
-    count = get_message_count(imap, source)
+    count = counts.get(source)
     if dry_run:
         print(f"  [DRY] MERGE '{source}' ({count} msgs) → '{dest}', then DELETE '{source}'")
         return True
     try:
         if count > 0:
-            status, data = imap.select(imap_encode(source))
-            if status != "OK":
-                print(f"  [!] Could not select '{source}'")
-                return False
-            status, data = imap.uid("COPY", "1:*", imap_encode(dest))
-            if status != "OK":
-                print(f"  [!] COPY failed: {data}")
-                imap.close()
+            ok, data = move_all(imap, source, dest, caps, progress)
+            if not ok:
+                print(f"  [!] MOVE failed for '{source}': {data}")
                 return False
-            imap.uid("STORE", "1:*", "+FLAGS", "(\\Deleted)")
-            imap.expunge()
-            imap.close()
             print(f"  MOVED {count} msgs: '{source}' → '{dest}'")
         # Delete the folder
         status, data = imap.delete(imap_encode(source))
@@ -121,10 +81,14 @@ def move_messages_and_delete(imap, source, dest, dry_run=True):
         return False
 
 
-def delete_folder(imap, folder, dry_run=True):
+def delete_folder(imap, counts, caps, folder, dry_run=True):
     """Delete a folder (must be empty or Gmail will just remove the label)."""
+    refusal = delete_refusal(caps, counts, folder)
+    if refusal:
+        print(f"  [!] SKIP DELETE '{folder}': {refusal}")
+        return False
     if dry_run:
-        count = get_message_count(imap, folder)
+        count = counts.get(folder)
         print(f"  [DRY] DELETE '{folder}' ({count} msgs)")
         return True
     try:
@@ -140,42 +104,120 @@ def delete_folder(imap, folder, dry_run=True):
         return False
 
 
-def main():
-    dry_run = "--execute" not in sys.argv
-
+def banner(argv):
+    dry_run = "--execute" not in argv and "--apply" not in argv
     print("=" * 62)
     print("  Gmail Cleanup — Fix nesting + remove old labels")
     print("=" * 62)
-    print(f"  MODE: {'DRY RUN (preview)' if dry_run else 'EXECUTE'}")
+    if "--apply" in argv:
+        print("  MODE: APPLY saved dry-run plan")
+    else:
+        print(f"  MODE: {'DRY RUN (preview)' if dry_run else 'EXECUTE'}")
     print()
 
-    email = input("Email: ").strip()
-    password = getpass.getpass("App Password: ")
-    print()
 
-    print("Connecting...")
-    try:
-        imap = imaplib.IMAP4_SSL("imap.gmail.com", 993)
-        imap.login(email, password)
-        print("Connected.\n")
-    except imaplib.IMAP4.error as e:
-        print(f"Login failed: {e}")
-        sys.exit(1)
+def run(ctx):
+    """Plan and (with --execute) apply the cleanup."""
+    dry_run = "--execute" not in ctx.argv and "--apply" not in ctx.argv
+    email, imap, caps, counts, cache = ctx.email, ctx.imap, ctx.caps, ctx.counts, ctx.cache
+    plan_file = apply_arg(ctx.argv, "cleanup", email)
+
+    # Execute runs journal every operation so an interrupted run resumes
+    journal = None if dry_run else Journal(journal_path("cleanup", email))
+    if journal and journal.resumed():
+        print(f"Resuming interrupted run ({len(journal.done)} operations already done)\n")
+    plan_ops = []
+
+    def run_op(op, src, dst=None):
+        """Add one rename/merge/delete to the plan (previewing it in dry runs)."""
+        plan_ops.append(plan_op(counts, op, src, dst))
+        if not dry_run:
+            return
+        if op == "rename":
+            rename_folder(imap, src, dst)
+        elif op == "merge":
+            move_messages_and_delete(imap, counts, caps, src, dst)
+        else:
+            delete_folder(imap, counts, caps, src)
 
-    # List all folders
-    status, folder_data = imap.list()
-    if status != "OK":
+    def apply_op(conn, op):
+        """Execute one planned operation on a pooled connection."""
+        key = (op["op"], op["src"], op["dst"], op["uidvalidity"])
+        if journal.is_done(*key):
+            print(f"  Already done: {op['op'].upper()} '{op['src']}'")
+            return True
+        journal.planned(*key)
+        if op["op"] == "rename":
+            ok = rename_folder(conn, op["src"], op["dst"], dry_run=False)
+        elif op["op"] == "merge":
+            ok = move_messages_and_delete(conn, counts, caps, op["src"], op["dst"],
+                                          dry_run=False, progress=journal.progress)
+        else:
+            ok = delete_folder(conn, counts, caps, op["src"], dry_run=False)
+        journal.record(ok, *key)
+        return ok
+
+    def apply_ops(ops):
+        """Execute planned operations, independent ones in parallel; False if aborted."""
+        if not ctx.snapshot(ops):
+            print("Snapshot incomplete; nothing was changed.")
+            journal.close(keep=journal.resumed())
+            return False
+        # Workers read counts from memory only: the queries go over
+        # ctx.imap, which the pool also hands to a worker
+        sources = [op["src"] for op in ops]
+        counts.prefetch_many(sources)
+        for source in sources:
+            counts.lookup(source)
+        phase("apply")
+        cache.invalidate()
+        print(f"Applying {len(ops)} operations on up to {ctx.jobs} connections...")
+        results = run_parallel(ops, apply_op, ctx.pool(), ctx.delimiter())
+        cache.record_outcomes("cleanup", ops, results)
+        ctx.applied(ops, results)
+        journal.close()
+        print(f"\n  {sum(results)} OK, {len(results) - sum(results)} failed\n")
+        return True
+
+    phase("plan")
+    if plan_file:
+        # Execute the saved dry-run plan; only re-check it with STATUS
+        try:
+            plan = load_plan(plan_file, "cleanup", email)
+        except (OSError, ValueError) as e:
+            print(f"Cannot load plan: {e}")
+            sys.exit(1)
+        print(f"Loaded plan: {plan_file} ({len(plan['ops'])} operations)")
+        problems, changed = check_plan(plan, counts, journal)
+        for c in changed:
+            print(f"  [~] {c}")
+        if problems:
+            print("\nServer changed since the dry run; re-run it to refresh the plan:")
+            for p in problems:
+                print(f"  [!] {p}")
+            journal.close(keep=journal.resumed())
+            sys.exit(1)
+        print()
+        if not apply_ops(plan["ops"]):
+            return False
+        print("=" * 62)
+        print("  Cleanup complete!")
+        print("  Refresh Thunderbird: right-click account → Subscribe")
+        print("=" * 62)
+        return True
+
+    # List all folders (already known when an earlier phase listed them)
+    all_folders = ctx.list_folders()
+    if all_folders is None:
         print("Failed to list folders")
         sys.exit(1)
-
-    all_folders = set(parse_folder_list(folder_data))
     print(f"Total labels on server: {len(all_folders)}\n")
 
     # Print current state
     print("─" * 62)
     print("CURRENT LABELS:")
     print("─" * 62)
-    for f in sorted(all_folders):
+    for f in all_folders:
         print(f"  {f}")
     print()
 
@@ -188,41 +230,28 @@ def main():
     # System folders to never touch
     system_prefixes = {"[Gmail]", "[Superhuman]", "INBOX"}
 
+    system = FolderTree(system_prefixes, all_folders.delimiter)
+    categories = FolderTree(valid_categories, all_folders.delimiter)
+
+    # Phases 1-3 count most labels; fetch them in one pipelined batch
+    counts.prefetch_many(f for f in all_folders if system.covering(f) is None)
+
     # ── Phase 1: Fix Finance triple/double nesting ──
     print("─" * 62)
     print("PHASE 1: Fix Finance nesting")
     print("─" * 62)
 
-    finance_fixes = []
-    for folder in sorted(all_folders):
-        # Finance/General/General/* → Finance/*
-        if folder.startswith("Finance/General/General/"):
-            new_name = "Finance/" + folder[len("Finance/General/General/"):]
-            finance_fixes.append(("rename", folder, new_name))
-        # Finance/General/* → Finance/* (but not Finance/General/General which we handle above)
-        elif folder.startswith("Finance/General/") and not folder.startswith("Finance/General/General"):
-            new_name = "Finance/" + folder[len("Finance/General/"):]
-            finance_fixes.append(("rename", folder, new_name))
-
-    # Delete the empty nesting containers after moving children
-    if "Finance/General/General" in all_folders:
-        finance_fixes.append(("delete", "Finance/General/General", None))
-    if "Finance/General" in all_folders:
-        finance_fixes.append(("delete", "Finance/General", None))
+    # Finance/General/General/* → Finance/*, then Finance/General/* → Finance/*.
+    # Whole sub-trees move with one RENAME where the target is free; the
+    # emptied containers are deleted last.
+    planner = MovePlanner(all_folders)
+    planner.dissolve("Finance/General/General", "Finance")
+    planner.dissolve("Finance/General", "Finance")
+    finance_fixes = planner.ops[:]
 
     if finance_fixes:
         for action, src, dst in finance_fixes:
-            if action == "rename":
-                # Check if destination already exists
-                if dst in all_folders:
-                    # Merge instead
-                    move_messages_and_delete(imap, src, dst, dry_run)
-                else:
-                    rename_folder(imap, src, dst, dry_run)
-            elif action == "delete":
-                delete_folder(imap, src, dry_run)
-            if not dry_run:
-                time.sleep(0.2)
+            run_op(action, src, dst)
     else:
         print("  No Finance nesting issues found.")
     print()
@@ -377,40 +406,48 @@ def main():
     old_found = []
     for old_name, new_name in sorted(old_to_new.items()):
         if old_name in all_folders:
-            count = get_message_count(imap, old_name)
+            count = counts.get(old_name)
             old_found.append((old_name, new_name, count))
 
     if old_found:
+        phase1 = len(planner.ops)
         for old_name, new_name, count in old_found:
-            if count > 0:
-                # Has messages — merge into the correct destination
-                if new_name in all_folders:
-                    move_messages_and_delete(imap, old_name, new_name, dry_run)
-                else:
-                    # Destination doesn't exist, rename instead
-                    rename_folder(imap, old_name, new_name, dry_run)
+            if count > 0 or planner.tree.children(old_name):
+                # Has messages or sub-labels — rename into the correct
+                # destination, or merge if it exists (or an earlier
+                # operation creates it)
+                planner.move(old_name, new_name)
             else:
                 # Empty — just delete
-                delete_folder(imap, old_name, dry_run)
-            if not dry_run:
-                time.sleep(0.2)
+                planner.delete(old_name)
+        for action, src, dst in planner.ops[phase1:]:
+            run_op(action, src, dst)
     else:
         print("  No old flat labels found.")
     print()
+    cache.report_outcomes("cleanup", plan_ops)
+
+    if not dry_run and plan_ops:
+        if not apply_ops(plan_ops):
+            return False
+    elif dry_run:
+        ctx.applied(plan_ops, [True] * len(plan_ops))
 
     # ── Phase 3: Clean up any remaining uncategorized labels ──
+    phase("report")
     print("─" * 62)
     print("PHASE 3: Remaining uncategorized labels")
     print("─" * 62)
 
-    # Re-list after changes (in dry-run, use original list)
+    # The folder tree already reflects Phases 1-2 (applied, or in a dry
+    # run as planned)
     remaining = []
-    for f in sorted(all_folders):
+    for f in all_folders:
         # Skip system
-        if any(f == s or f.startswith(s + "/") for s in system_prefixes):
+        if system.covering(f) is not None:
             continue
         # Skip already-categorized
-        if any(f == c or f.startswith(c + "/") for c in valid_categories):
+        if categories.covering(f) is not None:
             continue
         # Skip if in old_to_new (will be handled)
         if f in old_to_new:
@@ -419,7 +456,7 @@ def main():
 
     if remaining:
         for f in remaining:
-            count = get_message_count(imap, f)
+            count = counts.get(f)
             print(f"  UNCATEGORIZED: '{f}' ({count} msgs)")
     else:
         print("  All labels are categorized.")
@@ -429,14 +466,60 @@ def main():
     print("=" * 62)
     if dry_run:
         print("  DRY RUN complete. No changes made.")
-        print("  Run with --execute to apply.")
+        if not (ctx.pipeline or ctx.offline):
+            save_plan(plan_path("cleanup", email), "cleanup", email, plan_ops)
+            print("  Run with --execute to apply, or --apply to run exactly")
+            print("  this plan without re-listing.")
+            print(f"  Plan saved: {plan_path('cleanup', email)}")
     else:
         print("  Cleanup complete!")
         print("  Refresh Thunderbird: right-click account → Subscribe")
     print("=" * 62)
+    return True
+
+
+def main():
+    banner(sys.argv)
 
-    imap.logout()
+    if "--offline" in sys.argv:
+        ctx = offline_context(sys.argv)
+        try:
+            run(ctx)
+        finally:
+            ctx.close()
+        return
+
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
+
+    phase("connect")
+    print("Connecting...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+        print("Connected.\n")
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        run(ctx)
+    finally:
+        ctx.close()
 
 
 if __name__ == "__main__":
-    main()
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run with --execute again to resume where it stopped.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
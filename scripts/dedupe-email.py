@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""
+Gmail duplicate remover — Frost Peak
+Finds messages stored more than once and removes the redundant copies.
+
+COPY-based merges on non-Gmail servers left physical duplicates behind,
+and imports into Gmail did the same under different X-GM-MSGIDs. Every
+copy counts against the quota and is moved again by every later merge.
+
+Two passes keep the cost down. The first fetches, in bulk and in
+parallel over the connection pool, each message's Message-ID (or Date,
+From and Subject when it has none) and groups them in HashIndex: an
+open-addressing table of 64-bit digests held in two arrays, about 32
+bytes per message instead of the ~100 a dict would take, so millions of
+messages fit. Only the groups it finds are read in the second pass,
+which hashes each candidate's body (BODY.PEEK[TEXT], large ones in
+parts); copies with the same Message-ID and the same body hash are
+duplicates.
+
+On Gmail the scan covers All Mail, where each X-GM-MSGID appears once
+however many labels it has, so labels are never mistaken for copies;
+only distinct X-GM-MSGIDs with the same content count. The oldest copy
+is kept and given the labels of the others, and the redundant copies
+are moved to Trash, which Gmail empties after 30 days (empty it sooner
+to reclaim the space at once). On other servers duplicates are looked
+for within each folder (--across: across the folders, keeping the copy
+in the first one listed), and redundant copies are flagged \\Deleted
+and expunged, a few thousand UIDs per command (left flagged on servers
+without UIDPLUS, where EXPUNGE would take other deleted mail with them).
+INBOX and the Sent, Drafts, Trash and Junk folders are only deduped
+within themselves even with --across (on Gmail, copies labelled Sent or
+Drafts only against each other): a message filed elsewhere and also in
+INBOX, or a sent message that came back, is a copy in another role.
+
+Usage:
+    python3 dedupe-email.py                 # Dry-run: find duplicates, report space
+    python3 dedupe-email.py --execute       # Remove the redundant copies
+    python3 dedupe-email.py --folders "Bills,Billing"   # Only these folders (not Gmail)
+    python3 dedupe-email.py --across        # Across folders, not only within each (not Gmail)
+    python3 dedupe-email.py --execute --jobs 8   # Use 8 IMAP connections
+    python3 dedupe-email.py --profile [TRACE]    # Latency report (+ JSON trace)
+    python3 dedupe-email.py --execute --yes      # Unattended: no prompts (see imap_credentials)
+    python3 dedupe-email.py --execute --snapshot DIR   # Export affected folders first (see imap_snapshot)
+"""
+
+import hashlib
+import imaplib
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+
+from imap_caps import find_special_use
+from imap_credentials import CredentialError, arg_value, confirm, get_credentials
+from imap_helpers import imap_encode, move_selected, selected_uidvalidity, uid_ranges, unselect
+from imap_pool import ContextExecutor
+from imap_rules import parse_header_fetch
+from imap_run import Context
+from imap_snapshot import FETCH_BYTES, FETCH_COUNT, PART_SIZE
+from imap_trace import phase, profile_arg
+
+SCAN_BATCH = 5000       # UIDs per metadata UID FETCH
+IDENTITY_FIELDS = "(MESSAGE-ID DATE FROM SUBJECT)"
+SKIP_FOLDERS = ("[Gmail]", "[Google Mail]")
+# Folders --across leaves alone: by special-use attribute, else by name
+ROLE_USES = ("\\Sent", "\\Drafts", "\\Trash", "\\Junk")
+ROLE_NAMES = {"INBOX", "SENT", "SENT ITEMS", "SENT MESSAGES", "DRAFTS", "TRASH",
+              "DELETED ITEMS", "DELETED MESSAGES", "JUNK", "SPAM"}
+GMAIL_ROLE_LABELS = {"\\Sent", "\\Draft"}
+
+UID_RE = re.compile(rb"\bUID (\d+)")
+SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+FLAGS_RE = re.compile(rb"\bFLAGS \(([^)]*)\)")
+LABELS_RE = re.compile(rb"\bX-GM-LABELS \(([^)]*)\)")
+LABEL_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[^\s()]+')
+
+
+class HashIndex:
+    """Open-addressing hash table of 64-bit keys to 64-bit values.
+
+    Keys and values live in two array("Q") columns kept at most half
+    full, about 32 bytes per entry. Keys should already be well mixed
+    (digests); 0 marks an empty slot, so a zero key is stored as 1.
+    """
+
+    def __init__(self, expected=0):
+        capacity = 1 << 16
+        while capacity < 2 * expected:
+            capacity *= 2
+        self.keys = array("Q", bytes(8 * capacity))
+        self.values = array("Q", bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def setdefault(self, key, value):
+        """The value stored for key, storing `value` first if key is new."""
+        key = key or 1
+        if 2 * (self.size + 1) > len(self.keys):
+            self._grow()
+        keys, mask = self.keys, self.mask
+        i = key & mask
+        while True:
+            found = keys[i]
+            if found == key:
+                return self.values[i]
+            if found == 0:
+                keys[i] = key
+                self.values[i] = value
+                self.size += 1
+                return value
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = [(k, v) for k, v in zip(self.keys, self.values) if k]
+        self.__init__(len(self.keys))
+        for key, value in old:
+            self.setdefault(key, value)
+
+
+def digest(*parts):
+    """64-bit digest of byte strings."""
+    return int.from_bytes(hashlib.blake2b(b"\0".join(parts), digest_size=8).digest(), "big")
+
+
+def identity(raw):
+    """Message-ID of a header block, else its Date, From and Subject."""
+    values = {}
+    name = None
+    for line in raw.replace(b"\r\n", b"\n").split(b"\n"):
+        if line[:1] in (b" ", b"\t") and name:
+            values[name] += line.strip()
+        elif b":" in line:
+            name, _, value = line.partition(b":")
+            name = name.strip().upper()
+            values[name] = value.strip()
+    if values.get(b"MESSAGE-ID"):
+        return b"id:" + values[b"MESSAGE-ID"]
+    return b"hdr:" + b"\0".join(values.get(h, b"") for h in (b"DATE", b"FROM", b"SUBJECT"))
+
+
+def parse_scan(data):
+    """[(uid, size, raw headers)] from a UID FETCH of the identity headers.
+
+    Messages already flagged \\Deleted are left out, so one is never kept
+    in place of a live copy.
+    """
+    result = []
+    head = None
+    for item in data or []:
+        if isinstance(item, tuple):
+            head = item
+            continue
+        if head is None or not isinstance(item, bytes):
+            continue
+        text = head[0] + b" " + item
+        uid, size, flags = UID_RE.search(text), SIZE_RE.search(text), FLAGS_RE.search(text)
+        if flags and b"\\deleted" in flags.group(1).lower().split():
+            head = None
+            continue
+        if uid:
+            result.append((int(uid.group(1)), int(size.group(1)) if size else 0, head[1]))
+        head = None
+    return result
+
+
+def parse_labels(text):
+    """X-GM-LABELS of one FETCH response, as sent (quoted or atoms) to STORE back."""
+    found = LABELS_RE.search(text)
+    if not found:
+        return set()
+    return {label.decode() for label in LABEL_RE.findall(found.group(1))}
+
+
+def role_names(ctx):
+    """Names of the Sent, Drafts, Trash and Junk special-use folders found."""
+    return {find_special_use(ctx.imap, ctx.caps, use) for use in ROLE_USES} - {None}
+
+
+def role_folders(folders, special):
+    """Numbers of the folders in INBOX, Sent, Drafts, Trash or Junk roles."""
+    return {number for number, folder in enumerate(folders)
+            if folder in special or folder.upper() in ROLE_NAMES}
+
+
+def label_name(label):
+    """A label as parse_labels returns it, unquoted."""
+    if label.startswith('"'):
+        return re.sub(r"\\(.)", r"\1", label[1:-1])
+    return label
+
+
+def is_system_label(label):
+    """Gmail system labels (\\Sent, \\Important, ...) cannot be STOREd."""
+    return label_name(label).startswith("\\")
+
+
+def expand(uid_set):
+    """UIDs of a sequence set like "1:5,9" (no "*")."""
+    uids = []
+    for part in uid_set.split(","):
+        lo, _, hi = part.partition(":")
+        uids += range(int(lo), int(hi or lo) + 1)
+    return uids
+
+
+# ──────────────────────────────────────────────
+# Pass 1: group by identity
+# ──────────────────────────────────────────────
+
+def scan(ctx, folders, across, own=()):
+    """HashIndex pass over folders; returns (candidates, scanned, uidvalidities).
+
+    candidates maps an identity digest to the locations (folder index << 32
+    | uid) sharing it, only for identities seen more than once. With
+    `across`, folders share one scope except the numbers in `own`.
+    """
+    pool = ctx.pool()
+    tasks = []
+    for number, folder in enumerate(folders):
+        uidnext = ctx.counts.lookup(folder).get("UIDNEXT")
+        if uidnext is None:
+            tasks.append((number, "1:*"))
+        else:
+            tasks += [(number, f"{lo}:{min(lo + SCAN_BATCH - 1, uidnext - 1)}")
+                      for lo in range(1, uidnext, SCAN_BATCH)]
+    uidvalidities = {}
+
+    def fetch(task):
+        number, uid_set = task
+        conn = pool.acquire()
+        try:
+            typ, data = conn.select(imap_encode(folders[number]), readonly=True)
+            if typ != "OK":
+                print(f"  [~] Skipping {folders[number]}: {data}")
+                return number, []
+            uidvalidities.setdefault(number, selected_uidvalidity(conn))
+            typ, data = conn.uid("FETCH", uid_set, "(UID RFC822.SIZE FLAGS BODY.PEEK[HEADER.FIELDS "
+                                 + IDENTITY_FIELDS + "])")
+            if typ != "OK":
+                raise RuntimeError(f"UID FETCH in {folders[number]} failed: {data}")
+            return number, parse_scan(data)
+        finally:
+            pool.release(conn)
+
+    # Sized from the STATUS counts so the table never has to grow
+    index = HashIndex(sum(ctx.counts.get(f) for f in folders))
+    candidates = defaultdict(list)
+    scanned = 0
+    with ContextExecutor(max_workers=pool.size) as executor:
+        for done, (number, messages) in enumerate(executor.map(fetch, tasks), 1):
+            scope = b"" if across and number not in own else str(number).encode()
+            for uid, size, raw in messages:
+                key = digest(scope, identity(raw))
+                location = number << 32 | uid
+                first = index.setdefault(key, location)
+                if first != location:
+                    group = candidates[key]
+                    if not group:
+                        group.append(first)
+                    group.append(location)
+            scanned += len(messages)
+            if done % 20 == 0 or done == len(tasks):
+                print(f"  {done}/{len(tasks)} batches, {scanned} messages, "
+                      f"{len(candidates)} possible duplicates")
+    return candidates, scanned, uidvalidities
+
+
+# ──────────────────────────────────────────────
+# Pass 2: hash candidate bodies
+# ──────────────────────────────────────────────
+
+def hash_bodies(ctx, folders, locations):
+    """{location: (size, body digest, labels)} for the candidate messages."""
+    by_folder = defaultdict(list)
+    for location in locations:
+        by_folder[location >> 32].append(location & 0xFFFFFFFF)
+    gmail = ctx.caps.gmail
+    items = "(UID RFC822.SIZE X-GM-LABELS)" if gmail else "(UID RFC822.SIZE)"
+    pool = ctx.pool()
+    result = {}
+    lock = threading.Lock()
+
+    def body_digest(conn, folder, uid, size):
+        h = hashlib.blake2b(digest_size=16)
+        offset = 0
+        while offset < size:
+            typ, data = conn.uid("FETCH", str(uid), f"(UID BODY.PEEK[TEXT]<{offset}.{PART_SIZE}>)")
+            if typ != "OK":
+                raise RuntimeError(f"UID FETCH {uid} in {folder} failed: {data}")
+            parts = parse_header_fetch(data)
+            if not parts or not parts[0][1]:
+                break
+            h.update(parts[0][1])
+            offset += len(parts[0][1])
+        return h.digest()
+
+    def hash_folder(number):
+        folder = folders[number]
+        conn = pool.acquire()
+        try:
+            typ, data = conn.select(imap_encode(folder), readonly=True)
+            if typ != "OK":
+                raise RuntimeError(f"cannot examine {folder}: {data}")
+            meta = {}
+            for uid_set in uid_ranges(by_folder[number]):
+                typ, data = conn.uid("FETCH", uid_set, items)
+                if typ != "OK":
+                    raise RuntimeError(f"UID FETCH in {folder} failed: {data}")
+                for line in data or []:
+                    line = line[0] if isinstance(line, tuple) else line
+                    uid, size = UID_RE.search(line or b""), SIZE_RE.search(line or b"")
+                    if uid and size:
+                        meta[int(uid.group(1))] = (int(size.group(1)),
+                                                   parse_labels(line) if gmail else set())
+            found = {}
+            # Small bodies a batch at a time, large ones in parts
+            small = [uid for uid in sorted(meta) if meta[uid][0] <= PART_SIZE]
+            batch, total = [], 0
+            for uid in small + [None]:
+                if uid is not None:
+                    batch.append(uid)
+                    total += meta[uid][0]
+                    if total < FETCH_BYTES and len(batch) < FETCH_COUNT:
+                        continue
+                if batch:
+                    typ, data = conn.uid("FETCH", ",".join(uid_ranges(batch)),
+                                         "(UID BODY.PEEK[TEXT])")
+                    if typ != "OK":
+                        raise RuntimeError(f"UID FETCH in {folder} failed: {data}")
+                    for got, body in parse_header_fetch(data):
+                        found[got] = hashlib.blake2b(body, digest_size=16).digest()
+                    batch, total = [], 0
+            for uid in sorted(meta):
+                if meta[uid][0] > PART_SIZE:
+                    found[uid] = body_digest(conn, folder, uid, meta[uid][0])
+            with lock:
+                for uid, body in found.items():
+                    size, labels = meta[uid]
+                    result[number << 32 | uid] = (size, body, labels)
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            pool.release(conn)
+
+    with ContextExecutor(max_workers=pool.size) as executor:
+        list(executor.map(hash_folder, sorted(by_folder)))
+    return result
+
+
+def find_duplicates(candidates, bodies, roles=frozenset()):
+    """[(kept location, [redundant locations])] of the confirmed duplicates.
+
+    Copies are only duplicates of copies with the same labels from `roles`.
+    """
+    groups = []
+    for locations in candidates.values():
+        same = defaultdict(list)
+        for location in locations:
+            if location in bodies:
+                _, body, labels = bodies[location]
+                role = frozenset(label_name(label) for label in labels) & roles
+                same[body, role].append(location)
+        for copies in same.values():
+            if len(copies) > 1:
+                # Lowest folder number (order listed), then lowest (oldest) UID
+                copies.sort()
+                groups.append((copies[0], copies[1:]))
+    return groups
+
+
+# ──────────────────────────────────────────────
+# Removing redundant copies
+# ──────────────────────────────────────────────
+
+def remove_copies(ctx, folder, uidvalidity, keep_labels, redundant, trash):
+    """Remove redundant UIDs from one folder (to trash, if given); returns the UIDs removed.
+
+    keep_labels maps a kept UID to labels it must gain (Gmail only).
+    """
+    conn = ctx.pool().acquire()
+    try:
+        typ, data = conn.select(imap_encode(folder))
+        if typ != "OK":
+            print(f"  [!] Cannot select {folder}: {data}")
+            return []
+        if selected_uidvalidity(conn) != uidvalidity:
+            print(f"  [!] {folder} changed since the scan (UIDVALIDITY); skipped")
+            return []
+        # Gmail: the kept copy takes over the labels first, grouped by label set
+        by_labels = defaultdict(list)
+        for uid, labels in keep_labels.items():
+            if labels:
+                by_labels[frozenset(labels)].append(uid)
+        for labels, uids in by_labels.items():
+            shown = "(" + " ".join(sorted(labels)) + ")"
+            for uid_set in uid_ranges(uids):
+                typ, data = conn.uid("STORE", uid_set, "+X-GM-LABELS.SILENT", shown)
+                if typ != "OK":
+                    print(f"  [!] Cannot copy labels in {folder}: {data}; nothing removed")
+                    return []
+        removed = []
+        for uid_set in uid_ranges(redundant):
+            if trash:
+                ok, data = move_selected(conn, trash, ctx.caps, uid_set)
+            else:
+                typ, data = conn.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")
+                ok = typ == "OK"
+                if ok and "UIDPLUS" in ctx.caps:
+                    typ, data = conn.uid("EXPUNGE", uid_set)
+                    ok = typ == "OK"
+            if not ok:
+                print(f"  [!] Removing copies from {folder} failed: {data}")
+                break
+            removed += expand(uid_set)
+        return removed
+    finally:
+        # CLOSE would also expunge \Deleted mail that is not ours
+        try:
+            unselect(conn, ctx.caps, folder)
+        except Exception:
+            pass
+        ctx.pool().release(conn)
+
+
+# ──────────────────────────────────────────────
+# Main
+# ──────────────────────────────────────────────
+
+def banner(argv):
+    execute = "--execute" in argv
+    print("=" * 62)
+    print("  Gmail Duplicate Remover — Frost Peak")
+    print("  Removes redundant copies of the same message")
+    print("=" * 62)
+    print()
+    if execute:
+        print("  MODE: EXECUTE (redundant copies will be removed!)")
+    else:
+        print("  MODE: DRY RUN (preview only)")
+        print("  Add --execute to remove duplicates")
+    print()
+
+
+def run(ctx):
+    """Find duplicates and (with --execute) remove them; False if aborted."""
+    execute = "--execute" in ctx.argv
+    caps = ctx.caps
+    gmail = caps.gmail and caps.all_mail is not None
+    trash = None
+    if gmail:
+        folders, across = [caps.all_mail], False
+        if execute:
+            trash = find_special_use(ctx.imap, caps, "\\Trash")
+            if trash is None:
+                print("Cannot find the Trash folder (\\Trash); nothing removed.")
+                return False
+    else:
+        across = "--across" in ctx.argv
+        if execute and "UIDPLUS" not in caps:
+            print("  [!] No UIDPLUS: redundant copies will be flagged \\Deleted, not expunged\n")
+        chosen = arg_value(ctx.argv, "--folders")
+        if chosen:
+            folders = [f.strip() for f in chosen.split(",") if f.strip()]
+        else:
+            tree = ctx.list_folders()
+            if tree is None:
+                print("Failed to list folders.")
+                sys.exit(1)
+            folders = sorted(tree)
+    folders = [f for f in folders if not (f.startswith(SKIP_FOLDERS) and f != caps.all_mail)]
+    special = role_names(ctx) if across or gmail else set()
+    own = role_folders(folders, special) if across else set()
+
+    # ── Pass 1: identities ──
+    phase("scan")
+    started = time.monotonic()
+    ctx.counts.prefetch_many(folders)
+    print(f"Scanning {len(folders)} folder(s) on up to {ctx.jobs} connections...")
+    candidates, scanned, uidvalidities = scan(ctx, folders, across, own)
+    locations = {loc for group in candidates.values() for loc in group}
+
+    # ── Pass 2: bodies of the candidates ──
+    phase("hash")
+    if locations:
+        print(f"Hashing {len(locations)} candidate bodies...")
+    bodies = hash_bodies(ctx, folders, locations) if locations else {}
+    roles = special | GMAIL_ROLE_LABELS if gmail else frozenset()
+    groups = find_duplicates(candidates, bodies, roles)
+    print(f"  {scanned} messages in {time.monotonic() - started:.1f}s\n")
+
+    redundant = defaultdict(list)
+    reclaim = Counter()
+    for _, copies in groups:
+        for location in copies:
+            number = location >> 32
+            redundant[number].append(location & 0xFFFFFFFF)
+            reclaim[number] += bodies[location][0]
+    total = sum(len(uids) for uids in redundant.values())
+
+    print("─" * 62)
+    print("DUPLICATES")
+    print("─" * 62)
+    if not groups:
+        print("  No duplicates found.")
+        print()
+        return True
+    for number in sorted(redundant, key=lambda n: -reclaim[n]):
+        print(f"  {folders[number]:<40} {len(redundant[number]):>7} copies "
+              f"{reclaim[number] / 1e6:>9.1f} MB")
+    print()
+    print("=" * 62)
+    print(f"  {total} redundant copies of {len(groups)} messages: "
+          f"{sum(reclaim.values()) / 1e6:.1f} MB reclaimable")
+    if not execute:
+        print("  DRY RUN — nothing removed. Run with --execute to remove them.")
+        print("=" * 62)
+        return True
+    print("=" * 62)
+    if not confirm(ctx.argv, f"\n  Remove {total} redundant copies? Type 'yes': "):
+        print("Aborted.")
+        return False
+    print()
+    if not ctx.snapshot([{"op": "dedupe", "src": folders[n]} for n in sorted(redundant)]):
+        print("Snapshot incomplete; nothing was changed.")
+        return False
+
+    # Gmail: the kept copy gains the labels of the copies it replaces
+    keep_labels = defaultdict(dict)
+    if gmail:
+        for keep, copies in groups:
+            labels = set().union(*(bodies[c][2] for c in copies)) - bodies[keep][2]
+            # One system label in the STORE would fail the whole batch
+            labels = {label for label in labels if not is_system_label(label)}
+            if labels:
+                keep_labels[keep >> 32][keep & 0xFFFFFFFF] = labels
+
+    phase("apply")
+    ctx.cache.invalidate()
+    print(f"Removing copies from {len(redundant)} folder(s)"
+          f"{f' (to {trash})' if trash else ''}...")
+
+    def apply(number):
+        return number, remove_copies(ctx, folders[number], uidvalidities.get(number),
+                                     keep_labels[number], redundant[number], trash)
+
+    removed, freed = 0, 0
+    with ContextExecutor(max_workers=ctx.jobs) as executor:
+        for number, uids in executor.map(apply, sorted(redundant)):
+            removed += len(uids)
+            freed += sum(bodies[number << 32 | uid][0] for uid in uids)
+            print(f"  {folders[number]}: {len(uids)} of {len(redundant[number])} removed")
+
+    print()
+    print("=" * 62)
+    print(f"  Removed {removed} redundant copies, {freed / 1e6:.1f} MB reclaimed"
+          + (" once Trash is emptied" if trash else ""))
+    print("=" * 62)
+    return removed == total
+
+
+def main():
+    banner(sys.argv)
+
+    # ── Credentials ──
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
+
+    # ── Connect ──
+    phase("connect")
+    print("Connecting to Gmail IMAP...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+        print("Connected successfully.\n")
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        print("Make sure you're using an App Password, not your regular password.")
+        print("Create one at: https://myaccount.google.com/apppasswords")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        run(ctx)
+    finally:
+        ctx.close()
+
+
+if __name__ == "__main__":
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run again to remove the duplicates that are left.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
@@ -5,24 +5,27 @@ On Gmail, deleting a label does NOT delete messages — they remain in
 All Mail and under any other labels (the new categorized ones).
 
 Usage:
-    python3 delete-old-labels.py                # Dry-run
+    python3 delete-old-labels.py                # Dry-run (saves plan)
     python3 delete-old-labels.py --execute      # Apply
+    python3 delete-old-labels.py --apply [PLAN] # Apply the saved dry-run plan
+    python3 delete-old-labels.py --execute --jobs 8   # Use 8 IMAP connections
+    python3 delete-old-labels.py --profile [TRACE]    # Latency report (+ JSON trace)
+    python3 delete-old-labels.py --refresh      # Ignore cached folder counts
+    python3 delete-old-labels.py --offline      # Dry-run from the envelope index (index-email.py)
+    python3 delete-old-labels.py --execute --yes      # Unattended: no prompts (see imap_credentials)
+    python3 delete-old-labels.py --execute --snapshot DIR   # Export affected folders first (see imap_snapshot)
 """
 
 import imaplib
-import getpass
 import sys
-import time
 
-
-def imap_utf7_encode(text):
-    return text.replace('&', '&-')
-
-def imap_encode(folder_name):
-    return '"' + imap_utf7_encode(folder_name) + '"'
-
-def imap_utf7_decode(text):
-    return text.replace('&-', '&')
+from imap_credentials import CredentialError, confirm, get_credentials
+from imap_helpers import delete_refusal, imap_encode
+from imap_journal import (Journal, apply_arg, check_plan, journal_path,
+                          load_plan, plan_op, plan_path, save_plan)
+from imap_pool import run_parallel
+from imap_run import Context, offline_context
+from imap_trace import phase, profile_arg
 
 
 # ── Old flat labels to delete ──
@@ -74,91 +77,191 @@ OLD_LABELS = [
 ]
 
 
-def main():
-    dry_run = "--execute" not in sys.argv
-
+def banner(argv):
+    dry_run = "--execute" not in argv and "--apply" not in argv
     print("=" * 62)
     print("  Delete old flat Gmail labels")
     print("=" * 62)
-    print(f"  MODE: {'DRY RUN' if dry_run else 'EXECUTE'}\n")
+    if "--apply" in argv:
+        print("  MODE: APPLY saved dry-run plan\n")
+    else:
+        print(f"  MODE: {'DRY RUN' if dry_run else 'EXECUTE'}\n")
 
-    email = input("Email: ").strip()
-    password = getpass.getpass("App Password: ")
-    print()
 
-    print("Connecting...")
-    try:
-        imap = imaplib.IMAP4_SSL("imap.gmail.com", 993)
-        imap.login(email, password)
-    except imaplib.IMAP4.error as e:
-        print(f"Login failed: {e}")
-        sys.exit(1)
+def run(ctx):
+    """Delete the old labels that are still present; False if aborted."""
+    dry_run = "--execute" not in ctx.argv and "--apply" not in ctx.argv
+    email, caps, counts, cache = ctx.email, ctx.caps, ctx.counts, ctx.cache
+    plan_file = apply_arg(ctx.argv, "delete-old-labels", email)
 
-    # Get current folders
-    status, folder_data = imap.list()
-    current = set()
-    for item in folder_data:
-        if isinstance(item, bytes):
-            item = item.decode("utf-8", errors="replace")
-        import re
-        match = re.match(r'\(.*?\)\s+"(.+?)"\s+"?(.+?)"?\s*$', item)
-        if match:
-            current.add(imap_utf7_decode(match.group(2).strip('"')))
-
-    print(f"Labels on server: {len(current)}\n")
-
-    # Find which old labels still exist
-    to_delete = [label for label in OLD_LABELS if label in current]
-    not_found = [label for label in OLD_LABELS if label not in current]
-
-    print(f"Old labels still present: {len(to_delete)}")
-    print(f"Already gone: {len(not_found)}\n")
-
-    if not to_delete:
-        print("Nothing to delete!")
-        imap.logout()
-        return
+    phase("plan")
+    if plan_file:
+        # Delete exactly what the dry run found; only re-check with STATUS
+        try:
+            plan = load_plan(plan_file, "delete-old-labels", email)
+        except (OSError, ValueError) as e:
+            print(f"Cannot load plan: {e}")
+            sys.exit(1)
+        journal = Journal(journal_path("delete-old-labels", email))
+        ops = plan["ops"]
+        print(f"Loaded plan: {plan_file} ({len(ops)} labels)")
+        problems, _ = check_plan(plan, counts, journal)
+        if problems:
+            print("\nServer changed since the dry run; re-run it to refresh the plan:")
+            for p in problems:
+                print(f"  [!] {p}")
+            sys.exit(1)
+        to_delete = [op["src"] for op in ops]
+        print()
+    else:
+        # Get current folders
+        current = ctx.list_folders()
+        if current is None:
+            print("Failed to list folders")
+            sys.exit(1)
 
-    print("─" * 62)
-    print("WILL DELETE:")
-    print("─" * 62)
-    for label in sorted(to_delete):
-        print(f"  {label}")
-    print()
+        print(f"Labels on server: {len(current)}\n")
+
+        # Find which old labels still exist
+        to_delete = [label for label in OLD_LABELS if label in current]
+        not_found = [label for label in OLD_LABELS if label not in current]
+
+        print(f"Old labels still present: {len(to_delete)}")
+        print(f"Already gone: {len(not_found)}\n")
+
+        if not to_delete:
+            print("Nothing to delete!")
+            return True
+
+        print("─" * 62)
+        print("WILL DELETE:")
+        print("─" * 62)
+        for label in sorted(to_delete):
+            print(f"  {label}")
+        print()
+
+        # Deletes are keyed by name only: a label deleted by an interrupted
+        # run is already gone from the LIST above.
+        journal = Journal(journal_path("delete-old-labels", email))
+        ops = [{"op": "delete", "src": label, "dst": None, "uidvalidity": None}
+               for label in to_delete]
+    cache.report_outcomes("delete-old-labels", ops)
 
     if dry_run:
-        print("DRY RUN — no changes made. Run with --execute to delete.")
-        imap.logout()
-        return
+        counts.prefetch_many(to_delete)
+        ops = [plan_op(counts, "delete", label) for label in to_delete]
+        refused = []
+        for label in to_delete:
+            refusal = delete_refusal(caps, counts, label)
+            refused.append(refusal)
+            if refusal:
+                print(f"  [!] Will skip {label}: {refusal}")
+        ctx.applied(ops, [not r for r in refused])
+        if ctx.pipeline or ctx.offline:
+            print("DRY RUN — no changes made.")
+            return True
+        save_plan(plan_path("delete-old-labels", email), "delete-old-labels", email, ops)
+        print("DRY RUN — no changes made. Run with --execute to delete,")
+        print("or --apply to delete exactly these labels without re-listing.")
+        print(f"Plan saved: {plan_path('delete-old-labels', email)}")
+        return True
 
-    confirm = input(f"Delete {len(to_delete)} old labels? Type 'yes': ").strip()
-    if confirm != "yes":
+    if not confirm(ctx.argv, f"Delete {len(to_delete)} old labels? Type 'yes': "):
         print("Aborted.")
-        imap.logout()
-        return
+        return False
 
     print()
-    ok = 0
-    fail = 0
-    for label in sorted(to_delete):
+    if not ctx.snapshot(ops):
+        print("Snapshot incomplete; nothing was changed.")
+        journal.close(keep=journal.resumed())
+        return False
+
+    # Counts are queried on ctx.imap, which the pool also hands to a
+    # worker, so every refusal is decided here before the workers start
+    counts.prefetch_many(to_delete)
+    refusals = {label: delete_refusal(caps, counts, label) for label in to_delete}
+
+    def delete_label(conn, op):
+        label = op["src"]
+        key = ("delete", label, None, op["uidvalidity"])
+        if journal.is_done(*key):
+            print(f"  Already deleted: {label}")
+            return True
+        refusal = refusals.get(label)
+        if refusal:
+            print(f"  [!] Skipped: {label} — {refusal}")
+            journal.record(False, *key)
+            return False
+        journal.planned(*key)
         try:
-            status, data = imap.delete(imap_encode(label))
+            status, data = conn.delete(imap_encode(label))
             if status == "OK":
                 print(f"  Deleted: {label}")
-                ok += 1
             else:
                 print(f"  [!] Failed: {label} — {data}")
-                fail += 1
         except imaplib.IMAP4.error as e:
             print(f"  [!] Error: {label} — {e}")
-            fail += 1
-        time.sleep(0.1)
+            status = "NO"
+        journal.record(status == "OK", *key)
+        return status == "OK"
+
+    # Label deletes are independent, so they spread across the pool
+    phase("apply")
+    cache.invalidate()
+    ops = sorted(ops, key=lambda op: op["src"])
+    results = run_parallel(ops, delete_label, ctx.pool(), ctx.delimiter())
+    cache.record_outcomes("delete-old-labels", ops, results)
+    ctx.applied(ops, results)
+    ok = sum(results)
+    fail = len(results) - ok
+    journal.close()
 
     print(f"\nDone: {ok} deleted, {fail} failed")
     print("Refresh Thunderbird: right-click account → Subscribe → Refresh")
+    return True
 
-    imap.logout()
+
+def main():
+    banner(sys.argv)
+
+    if "--offline" in sys.argv:
+        ctx = offline_context(sys.argv)
+        try:
+            run(ctx)
+        finally:
+            ctx.close()
+        return
+
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
+
+    phase("connect")
+    print("Connecting...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        run(ctx)
+    finally:
+        ctx.close()
 
 
 if __name__ == "__main__":
-    main()
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run with --execute again to resume where it stopped.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
@@ -0,0 +1,1033 @@
+"""
+In-process IMAP server that behaves like Gmail, for tests and benchmarks.
+
+Emulates Gmail's labels-as-folders model: every message lives once in
+[Gmail]/All Mail and appears in one folder per label, each with its own
+UIDs. COPY adds a label, MOVE swaps one, \\Deleted + EXPUNGE in a label
+folder removes the label, DELETE drops a label from every message, and
+RENAME moves a label with all its sublabels. X-GM-EXT-1 (X-GM-LABELS,
+X-GM-MSGID) and LIST-STATUS can be switched on or off per server.
+
+Without X-GM-EXT-1 (e.g. DOVECOT_CAPABILITIES) the account is turned
+into a plain folder store, like Dovecot's: each folder holds its own
+copy of every message in it, COPY makes a new copy, EXPUNGE and MOVE
+remove only the selected folder's copy, DELETE destroys the folder's
+messages, HIGHESTMODSEQ is per folder, and there is no All Mail.
+
+A server holds one Account for any login, or a {username: Account}
+dict for multi-account runs. Faults can be injected per server: a
+latency per round trip (to stand in for the network to imap.gmail.com;
+pipelined commands share one), extra per-command processing time,
+NO [THROTTLED] every Nth command, a dropped connection every Nth
+command, and a BYE after an IDLE has lasted idle_timeout seconds (Gmail
+does this at ~29 minutes). IDLE reports EXISTS as mail is added to the
+selected folder. The server counts commands, round trips and bytes so
+the benchmarks can report them.
+
+    account = Account()
+    account.add_message(b"Subject: hi\\r\\n\\r\\nbody", ["Billing"])
+    with FakeIMAPServer(account, latency=0.02) as server:
+        imap = imaplib.IMAP4(*server.address)
+"""
+
+import gc
+import itertools
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import Counter
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+
+ALL_MAIL = "[Gmail]/All Mail"
+SYSTEM_FOLDERS = {
+    "INBOX": "",
+    "[Gmail]": "\\Noselect",
+    ALL_MAIL: "\\All",
+    "[Gmail]/Drafts": "\\Drafts",
+    "[Gmail]/Important": "\\Important",
+    "[Gmail]/Sent Mail": "\\Sent",
+    "[Gmail]/Spam": "\\Junk",
+    "[Gmail]/Starred": "\\Flagged",
+    "[Gmail]/Trash": "\\Trash",
+}
+
+GMAIL_CAPABILITIES = ("IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN "
+                      "X-GM-EXT-1 UIDPLUS COMPRESS=DEFLATE ENABLE MOVE CONDSTORE "
+                      "ESEARCH UTF8=ACCEPT LIST-EXTENDED LITERAL- SPECIAL-USE")
+DOVECOT_CAPABILITIES = ("IMAP4rev1 LITERAL+ SASL-IR LOGIN-REFERRALS ID ENABLE IDLE "
+                        "SORT THREAD=REFERENCES MULTIAPPEND UNSELECT CHILDREN "
+                        "NAMESPACE UIDPLUS LIST-EXTENDED I18NLEVEL=1 CONDSTORE "
+                        "QRESYNC ESEARCH SEARCHRES WITHIN CONTEXT=SEARCH LIST-STATUS "
+                        "SPECIAL-USE MOVE")
+
+
+def decode_name(name):
+    return name.replace("&-", "&")
+
+
+def encode_name(name):
+    return '"' + name.replace("&", "&-").replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+# ──────────────────────────────────────────────
+# Mail store
+# ──────────────────────────────────────────────
+
+class Message:
+    __slots__ = ("gid", "labels", "flags", "raw", "modseq")
+
+    def __init__(self, gid, raw, flags=(), labels=()):
+        self.gid = gid
+        self.labels = set(labels)
+        self.flags = set(flags)
+        self.raw = raw
+        self.modseq = 1
+
+
+class Folder:
+    """One label: its own UIDs mapping to shared Message objects.
+
+    In a folder store (Account.use_folders) the messages are the folder's own.
+    """
+
+    def __init__(self, name, uidvalidity, special=""):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.special = special
+        self.uidnext = 1
+        self.modseq = 1      # highest mod-sequence in a folder store
+        self.uids = {}       # uid → Message
+        self.by_gid = {}     # gid → uid
+        self.order = []      # sorted uids, for sequence numbers
+
+    @property
+    def selectable(self):
+        return self.special != "\\Noselect"
+
+    def add(self, msg):
+        if msg.gid in self.by_gid:
+            return self.by_gid[msg.gid]
+        uid = self.uidnext
+        self.uidnext += 1
+        self.uids[uid] = msg
+        self.by_gid[msg.gid] = uid
+        self.order.append(uid)
+        return uid
+
+    def bulk_add(self, msgs):
+        """Append many new messages at once (fixture loading)."""
+        uids = range(self.uidnext, self.uidnext + len(msgs))
+        self.uids.update(zip(uids, msgs))
+        self.by_gid.update(zip((m.gid for m in msgs), uids))
+        self.order.extend(uids)
+        self.uidnext += len(msgs)
+
+    def remove(self, uid):
+        """Drop one UID; returns its former sequence number."""
+        msg = self.uids.pop(uid)
+        del self.by_gid[msg.gid]
+        i = bisect_left(self.order, uid)
+        del self.order[i]
+        return i + 1
+
+    def seq(self, uid):
+        return bisect_left(self.order, uid) + 1
+
+
+class Account:
+    """A Gmail-style mailbox: messages, labels and per-label folders.
+
+    use_folders() turns it into a plain folder store instead.
+    """
+
+    def __init__(self, system=True):
+        self.lock = threading.RLock()
+        self.labels = True      # False once use_folders() has run
+        self.folders = {}
+        self.messages = {}
+        self._gid = itertools.count(1_000_000_000_000)
+        self._uidvalidity = itertools.count(int(time.time()) % 100_000 * 10)
+        self.modseq = 1
+        if system:
+            for name, special in SYSTEM_FOLDERS.items():
+                self.folders[name] = Folder(name, next(self._uidvalidity), special)
+
+    @property
+    def all_mail(self):
+        return self.folders.get(ALL_MAIL)
+
+    def create(self, name):
+        """Create a label and any missing parents (Gmail does the same)."""
+        parts = name.split("/")
+        for i in range(1, len(parts) + 1):
+            path = "/".join(parts[:i])
+            if path not in self.folders:
+                self.folders[path] = Folder(path, next(self._uidvalidity))
+        return self.folders[name]
+
+    def use_folders(self):
+        """Become a plain folder store (what servers without X-GM-EXT-1 have).
+
+        Every folder gets its own copy of each message it holds, keeping
+        the UIDs; All Mail, which only Gmail has, goes.
+        """
+        if not self.labels:
+            return
+        self.labels = False
+        self.folders.pop(ALL_MAIL, None)
+        self.messages = {}
+        for folder in self.folders.values():
+            folder.by_gid = {}
+            for uid in folder.order:
+                msg = self._copy(folder.uids[uid], folder)
+                folder.uids[uid] = msg
+                folder.by_gid[msg.gid] = uid
+                folder.modseq = max(folder.modseq, msg.modseq)
+
+    def _copy(self, msg, folder):
+        """A new message with the same content and flags, stored in `folder`."""
+        copy = Message(next(self._gid), msg.raw, msg.flags, (folder.name,))
+        copy.modseq = msg.modseq
+        self.messages[copy.gid] = copy
+        return copy
+
+    def add_message(self, raw, labels=(), flags=()):
+        msg = Message(next(self._gid), raw, flags)
+        if not self.labels:
+            # One copy per folder; the first is returned
+            copies = [self.copy(msg, label) for label in labels]
+            return copies[0] if copies else msg
+        self.messages[msg.gid] = msg
+        if self.all_mail is not None:
+            self.all_mail.add(msg)
+        for label in labels:
+            self.label(msg, label)
+        return msg
+
+    def bulk_load(self, folders, messages):
+        """Load many messages at once, bypassing per-message bookkeeping.
+
+        `messages` is an iterable of (raw, labels); `folders` lists every
+        label to create first. Used by the synthetic mailbox generator.
+        """
+        # Millions of new objects would trigger full GC passes over and
+        # over; none of them form cycles, so collection can wait
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._bulk_load(folders, messages)
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _bulk_load(self, folders, messages):
+        for name in folders:
+            self.create(name)
+        members = {name: [] for name in folders}
+        everything = []
+        add = everything.append
+        gids = self._gid
+        for raw, labels in messages:
+            msg = Message(next(gids), raw, (), labels)
+            add(msg)
+            for label in labels:
+                members[label].append(msg)
+        self.messages.update((m.gid, m) for m in everything)
+        if self.all_mail is not None:
+            self.all_mail.bulk_add(everything)
+        for name, msgs in members.items():
+            self.folders[name].bulk_add(msgs)
+
+    def label(self, msg, name):
+        folder = self.folders.get(name) or self.create(name)
+        msg.labels.add(name)
+        self.touch(msg)
+        return folder.add(msg)
+
+    def unlabel(self, msg, name):
+        """Remove a label; returns the sequence number it had, or None."""
+        folder = self.folders.get(name)
+        msg.labels.discard(name)
+        self.touch(msg)
+        if folder is None or msg.gid not in folder.by_gid:
+            return None
+        return folder.remove(folder.by_gid[msg.gid])
+
+    def copy(self, msg, name):
+        """COPY `msg` to `name`: a label on Gmail, a new copy in a folder store."""
+        if self.labels:
+            return self.label(msg, name)
+        folder = self.folders.get(name) or self.create(name)
+        copy = self._copy(msg, folder)
+        uid = folder.add(copy)
+        self.touch(copy)
+        return uid
+
+    def move(self, msg, source, name):
+        """MOVE `msg` from folder `source` to `name`; returns its old sequence number."""
+        if self.labels:
+            self.label(msg, name)
+            return self.unlabel(msg, source.name)
+        folder = self.folders.get(name) or self.create(name)
+        seq = self.discard(msg, source)
+        self.messages[msg.gid] = msg
+        msg.labels = {folder.name}
+        folder.add(msg)
+        self.touch(msg)
+        return seq
+
+    def discard(self, msg, folder):
+        """Expunge a folder store's message; returns its old sequence number."""
+        seq = folder.remove(folder.by_gid[msg.gid])
+        self.messages.pop(msg.gid, None)
+        self.modseq += 1
+        folder.modseq = self.modseq
+        return seq
+
+    def touch(self, msg):
+        self.modseq += 1
+        msg.modseq = self.modseq
+        if not self.labels:
+            for name in msg.labels:
+                if name in self.folders:
+                    self.folders[name].modseq = self.modseq
+
+    def rename(self, old, new):
+        prefix = old + "/"
+        moving = [n for n in self.folders if n == old or n.startswith(prefix)]
+        for name in sorted(moving, key=len):
+            folder = self.folders.pop(name)
+            folder.name = new + name[len(old):]
+            self.folders[folder.name] = folder
+            for msg in folder.uids.values():
+                msg.labels.discard(name)
+                msg.labels.add(folder.name)
+                self.touch(msg)
+        parent = new.rpartition("/")[0]
+        if parent and parent not in self.folders:
+            self.create(parent)
+
+    def delete(self, name):
+        folder = self.folders.pop(name)
+        for msg in folder.uids.values():
+            if self.labels:
+                msg.labels.discard(name)
+                self.touch(msg)
+            else:
+                # A folder store's messages go with their folder
+                self.messages.pop(msg.gid, None)
+
+    def expunge_message(self, msg):
+        """Remove a message everywhere (expunged from All Mail)."""
+        for folder in self.folders.values():
+            uid = folder.by_gid.get(msg.gid)
+            if uid is not None:
+                folder.remove(uid)
+        msg.labels.clear()
+        self.messages.pop(msg.gid, None)
+
+
+# ──────────────────────────────────────────────
+# Protocol
+# ──────────────────────────────────────────────
+
+TOKEN_RE = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+))')
+PARTIAL_RE = re.compile(r"<(\d+)\.(\d+)>$")
+
+
+def tokenize(text):
+    """Parse command arguments into nested lists of strings."""
+    stack = [[]]
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        quoted, open_, close, atom = match.groups()
+        if quoted is not None:
+            stack[-1].append(re.sub(r'\\(.)', r'\1', quoted))
+        elif open_:
+            stack.append([])
+        elif close:
+            if len(stack) > 1:
+                inner = stack.pop()
+                stack[-1].append(inner)
+        elif atom is not None:
+            stack[-1].append(atom)
+    while len(stack) > 1:
+        inner = stack.pop()
+        stack[-1].append(inner)
+    return stack[0]
+
+
+def parse_set(text, folder):
+    """UIDs in `folder` matching a UID set like "1:5,9,12:*"."""
+    if not folder.order:
+        return []
+    top = folder.order[-1]
+    wanted = set()
+    ranges = []
+    for part in text.split(","):
+        lo, _, hi = part.partition(":")
+        lo = top if lo == "*" else int(lo)
+        hi = lo if not hi else (top if hi == "*" else int(hi))
+        lo, hi = min(lo, hi), max(lo, hi)
+        if hi - lo < 1000:
+            wanted.update(range(lo, hi + 1))
+        else:
+            ranges.append((lo, hi))
+    uids = [u for u in folder.order if u in wanted or any(lo <= u <= hi for lo, hi in ranges)]
+    return uids
+
+
+class Stats:
+    """Server-side counters for benchmarks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.commands = Counter()
+        self.round_trips = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {"commands": sum(self.commands.values()),
+                    "by_command": dict(self.commands),
+                    "round_trips": self.round_trips,
+                    "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "connections": self.connections}
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """One client connection."""
+
+    def setup(self):
+        self.buffer = bytearray()
+        self.out = []
+        self.selected = None
+        self.readonly = False
+        self.authenticated = False
+        self.user = None
+        self.deflate = self.inflate = None
+        self.server.stats.connections += 1
+
+    # ── I/O ──
+
+    def recv_more(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise ConnectionError("client closed")
+        with self.server.stats.lock:
+            self.server.stats.bytes_in += len(data)
+        if self.inflate is not None:
+            data = self.inflate.decompress(data)
+        self.buffer += data
+
+    def read_line(self):
+        while b"\r\n" not in self.buffer:
+            self.recv_more()
+        i = self.buffer.index(b"\r\n")
+        line = bytes(self.buffer[:i])
+        del self.buffer[:i + 2]
+        return line
+
+    def read_exact(self, n):
+        while len(self.buffer) < n:
+            self.recv_more()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def read_command(self):
+        """One command line with literals folded in as quoted strings."""
+        line = self.read_line()
+        text = ""
+        while True:
+            match = re.search(rb"\{(\d+)(\+?)\}$", line)
+            if not match:
+                return text + line.decode("utf-8", errors="replace")
+            if not match.group(2):
+                self.send(b"+ go ahead\r\n")
+                self.flush()
+            literal = self.read_exact(int(match.group(1))).decode("utf-8", errors="replace")
+            text += line[:match.start()].decode("utf-8", errors="replace")
+            text += '"' + literal.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            line = self.read_line()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.out.append(data)
+
+    def untagged(self, text):
+        self.send(f"* {text}\r\n")
+
+    def flush(self):
+        data = b"".join(self.out)
+        self.out = []
+        if data:
+            if self.deflate is not None:
+                data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+            self.request.sendall(data)
+            with self.server.stats.lock:
+                self.server.stats.bytes_out += len(data)
+
+    # ── Main loop ──
+
+    def handle(self):
+        self.send("* OK Gimap ready (fake)\r\n")
+        self.flush()
+        try:
+            while True:
+                line = self.read_command()
+                tag, _, rest = line.partition(" ")
+                name, _, args = rest.partition(" ")
+                name = name.upper()
+                if name == "UID":
+                    sub, _, args = args.partition(" ")
+                    name = "UID " + sub.upper()
+                fault = self.server.before_command(self, tag, name)
+                if fault == "drop":
+                    return
+                if fault == "throttle":
+                    done = False
+                elif name == "IDLE":
+                    # Waits outside dispatch: deliveries need the account lock
+                    done = self.idle(tag)
+                else:
+                    try:
+                        done = self.dispatch(tag, name, tokenize(args))
+                    except Exception as e:
+                        self.send(f"{tag} BAD {type(e).__name__}: {e}\r\n")
+                        done = False
+                if b"\r\n" not in self.buffer:
+                    # Client must wait for this answer before sending more
+                    with self.server.stats.lock:
+                        self.server.stats.round_trips += 1
+                    if self.server.latency:
+                        time.sleep(self.server.latency)
+                self.flush()
+                if done:
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+    def idle(self, tag):
+        """IDLE until the client sends DONE, reporting EXISTS as mail arrives.
+
+        With the server's idle_timeout set, the connection is dropped with
+        a BYE after that many seconds, as Gmail does after ~29 minutes.
+        """
+        if not self.authenticated or "IDLE" not in self.server.capabilities.split():
+            self.send(f"{tag} BAD IDLE not available\r\n")
+            return False
+        folder = self.selected
+        seen = len(folder.uids) if folder else 0
+        started = time.monotonic()
+        self.send("+ idling\r\n")
+        self.flush()
+        self.request.settimeout(0.05)
+        try:
+            while b"\r\n" not in self.buffer:
+                try:
+                    self.recv_more()
+                except socket.timeout:
+                    pass
+                with self.account.lock:
+                    count = len(folder.uids) if folder else 0
+                if count != seen:
+                    self.untagged(f"{count} EXISTS")
+                    self.flush()
+                    seen = count
+                limit = self.server.idle_timeout
+                if limit and time.monotonic() - started > limit:
+                    self.untagged("BYE IDLE timeout")
+                    self.flush()
+                    return True
+        finally:
+            self.request.settimeout(None)
+        self.read_line()  # DONE
+        self.send(f"{tag} OK IDLE terminated (Success)\r\n")
+        return False
+
+    def dispatch(self, tag, name, args):
+        method = getattr(self, "cmd_" + name.replace(" ", "_").replace("-", "_"), None)
+        if method is None:
+            self.send(f"{tag} BAD unknown command {name}\r\n")
+            return False
+        if name not in ("CAPABILITY", "LOGIN", "LOGOUT", "NOOP") and not self.authenticated:
+            self.send(f"{tag} NO not authenticated\r\n")
+            return False
+        self.tag = tag
+        with self.account.lock:
+            result = method(args)
+        if result is False:
+            pass
+        elif result is True or result is None:
+            self.send(f"{tag} OK {name} completed\r\n")
+        elif isinstance(result, str):
+            self.send(f"{tag} {result}\r\n")
+        return name == "LOGOUT"
+
+    @property
+    def account(self):
+        return self.server.account_for(self.user)
+
+    def folder(self, name):
+        return self.account.folders.get(decode_name(name))
+
+    # ── Any state ──
+
+    def cmd_CAPABILITY(self, args):
+        self.untagged(f"CAPABILITY {self.server.capabilities}")
+
+    def cmd_NOOP(self, args):
+        pass
+
+    def cmd_LOGOUT(self, args):
+        self.untagged("BYE LOGOUT Requested")
+
+    def cmd_COMPRESS(self, args):
+        if "COMPRESS=DEFLATE" not in self.server.capabilities or str(args[0]).upper() != "DEFLATE":
+            return "BAD COMPRESS not supported"
+        if self.deflate is not None:
+            return "NO [COMPRESSIONACTIVE] Already compressing"
+        # The OK goes out uncompressed; everything after it is deflated
+        self.send(f"{self.tag} OK DEFLATE active\r\n")
+        self.flush()
+        self.deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.inflate = zlib.decompressobj(-15)
+        return False
+
+    def cmd_LOGIN(self, args):
+        user, password = args[0], args[1]
+        if self.server.password is not None and password != self.server.password:
+            return "NO [AUTHENTICATIONFAILED] Invalid credentials (Failure)"
+        if self.server.accounts is not None and str(user) not in self.server.accounts:
+            return "NO [AUTHENTICATIONFAILED] Unknown account (Failure)"
+        self.authenticated = True
+        self.user = str(user)
+        return f"OK [CAPABILITY {self.server.capabilities}] {user} authenticated (Success)"
+
+    # ── Mailboxes ──
+
+    def cmd_LIST(self, args):
+        special_only = False
+        if isinstance(args[0], list):
+            # RFC 5258 selection options, e.g. LIST (SPECIAL-USE) "" "*"
+            special_only = "SPECIAL-USE" in [str(o).upper() for o in args[0]]
+            args = args[1:]
+        ref, pattern = args[0], args[1]
+        items = []
+        if len(args) > 3 and str(args[2]).upper() == "RETURN":
+            opts = args[3]
+            for i, opt in enumerate(opts):
+                if str(opt).upper() == "STATUS" and i + 1 < len(opts):
+                    items = [str(x).upper() for x in opts[i + 1]]
+        if items and "LIST-STATUS" not in self.server.capabilities:
+            return "BAD LIST-STATUS not supported"
+        regex = re.compile(re.escape(decode_name(ref + pattern))
+                           .replace(r"\*", ".*").replace("%", "[^/]*") + "$")
+        names = sorted(self.account.folders)
+        for i, name in enumerate(names):
+            if not regex.match(name):
+                continue
+            folder = self.account.folders[name]
+            if special_only and folder.special in ("", "\\Noselect"):
+                continue
+            nested = i + 1 < len(names) and names[i + 1].startswith(name + "/")
+            children = "\\HasChildren" if nested else "\\HasNoChildren"
+            flags = " ".join(f for f in (children, folder.special) if f)
+            self.untagged(f'LIST ({flags}) "/" {encode_name(name)}')
+            if items and folder.selectable:
+                self.untagged(f"STATUS {encode_name(name)} ({self.status_items(folder, items)})")
+
+    cmd_XLIST = cmd_LIST
+
+    def cmd_LSUB(self, args):
+        return self.cmd_LIST(args)
+
+    def status_items(self, folder, items):
+        values = {
+            "MESSAGES": len(folder.uids),
+            "UIDNEXT": folder.uidnext,
+            "UIDVALIDITY": folder.uidvalidity,
+            "UNSEEN": sum(1 for m in folder.uids.values() if "\\Seen" not in m.flags),
+            "RECENT": 0,
+            # Gmail's mod-sequence is account-wide, not per folder
+            "HIGHESTMODSEQ": self.account.modseq if self.account.labels else folder.modseq,
+        }
+        return " ".join(f"{i} {values[i]}" for i in items if i in values)
+
+    def cmd_STATUS(self, args):
+        folder = self.folder(args[0])
+        if folder is None or not folder.selectable:
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        items = [str(x).upper() for x in args[1]]
+        self.untagged(f"STATUS {encode_name(folder.name)} ({self.status_items(folder, items)})")
+
+    def cmd_SELECT(self, args, readonly=False):
+        folder = self.folder(args[0])
+        if folder is None or not folder.selectable:
+            self.selected = None
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        self.selected = folder
+        self.readonly = readonly
+        self.untagged("FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)")
+        self.untagged(f"OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid.")
+        self.untagged(f"{len(folder.uids)} EXISTS")
+        self.untagged("0 RECENT")
+        self.untagged(f"OK [UIDNEXT {folder.uidnext}] Predicted next UID.")
+        mode = "READ-ONLY" if readonly else "READ-WRITE"
+        return f"OK [{mode}] {folder.name} selected. (Success)"
+
+    def cmd_EXAMINE(self, args):
+        return self.cmd_SELECT(args, readonly=True)
+
+    def cmd_CLOSE(self, args):
+        if self.selected is None:
+            return "BAD No mailbox selected"
+        if not self.readonly:
+            self.expunge(report=False)
+        self.selected = None
+
+    def cmd_UNSELECT(self, args):
+        self.selected = None
+
+    def cmd_CREATE(self, args):
+        name = decode_name(args[0])
+        if name in self.account.folders:
+            return "NO [ALREADYEXISTS] Folder already exists"
+        self.account.create(name)
+
+    def cmd_DELETE(self, args):
+        name = decode_name(args[0])
+        folder = self.account.folders.get(name)
+        if folder is None or name in SYSTEM_FOLDERS:
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        if self.selected is folder:
+            self.selected = None
+        self.account.delete(name)
+
+    def cmd_RENAME(self, args):
+        old, new = decode_name(args[0]), decode_name(args[1])
+        if old not in self.account.folders or old in SYSTEM_FOLDERS:
+            return "NO [NONEXISTENT] Unknown Mailbox"
+        if new in self.account.folders:
+            return "NO [ALREADYEXISTS] Folder already exists"
+        self.account.rename(old, new)
+
+    # ── Selected state ──
+
+    def require_selected(self):
+        if self.selected is None:
+            raise ValueError("No mailbox selected")
+        return self.selected
+
+    def expunge(self, uids=None, report=True):
+        folder = self.selected
+        account = self.account
+        targets = [u for u in (uids if uids is not None else list(folder.order))
+                   if u in folder.uids and "\\Deleted" in folder.uids[u].flags]
+        seqs = []
+        for uid in targets:
+            msg = folder.uids[uid]
+            if not account.labels:
+                seqs.append(account.discard(msg, folder))
+            elif folder is account.all_mail:
+                seqs.append(folder.seq(uid))
+                account.expunge_message(msg)
+            else:
+                msg.flags.discard("\\Deleted")
+                seqs.append(account.unlabel(msg, folder.name))
+        if report:
+            # Sequence numbers shift as each message goes; report in order
+            for seq in seqs:
+                self.untagged(f"{seq} EXPUNGE")
+
+    def cmd_EXPUNGE(self, args):
+        self.require_selected()
+        if self.readonly:
+            return "NO Mailbox is read-only"
+        self.expunge()
+
+    def cmd_UID_EXPUNGE(self, args):
+        folder = self.require_selected()
+        self.expunge(parse_set(args[0], folder))
+
+    def search(self, folder, criteria):
+        uids = list(folder.order)
+        i = 0
+        while i < len(criteria):
+            key = str(criteria[i]).upper()
+            if key == "ALL":
+                pass
+            elif key == "UID":
+                i += 1
+                wanted = set(parse_set(criteria[i], folder))
+                uids = [u for u in uids if u in wanted]
+            elif key == "X-GM-LABELS":
+                i += 1
+                label = decode_name(criteria[i])
+                uids = [u for u in uids if label in folder.uids[u].labels]
+            elif key in ("DELETED", "UNDELETED"):
+                want = key == "DELETED"
+                uids = [u for u in uids if ("\\Deleted" in folder.uids[u].flags) == want]
+            elif key == "SINCE" or key == "BEFORE":
+                i += 1
+            elif re.match(r"^[\d:,*]+$", key):
+                pass
+            i += 1
+        return uids
+
+    def cmd_UID_SEARCH(self, args):
+        folder = self.require_selected()
+        uids = self.search(folder, args)
+        self.untagged("SEARCH" + "".join(f" {u}" for u in uids))
+
+    def cmd_UID_COPY(self, args):
+        folder = self.require_selected()
+        dest = self.folder(args[1])
+        if dest is None:
+            return "NO [TRYCREATE] No folder " + args[1]
+        for uid in parse_set(args[0], folder):
+            self.account.copy(folder.uids[uid], dest.name)
+
+    def cmd_UID_MOVE(self, args):
+        folder = self.require_selected()
+        dest = self.folder(args[1])
+        if dest is None:
+            return "NO [TRYCREATE] No folder " + args[1]
+        if "MOVE" not in self.server.capabilities:
+            return "BAD MOVE not supported"
+        for uid in parse_set(args[0], folder):
+            seq = self.account.move(folder.uids[uid], folder, dest.name)
+            self.untagged(f"{seq} EXPUNGE")
+
+    def cmd_UID_STORE(self, args):
+        folder = self.require_selected()
+        op = str(args[1]).upper()
+        values = args[2] if isinstance(args[2], list) else [args[2]]
+        silent = op.endswith(".SILENT")
+        op = op.replace(".SILENT", "")
+        for uid in parse_set(args[0], folder):
+            msg = folder.uids[uid]
+            if op.endswith("X-GM-LABELS"):
+                if "X-GM-EXT-1" not in self.server.capabilities:
+                    return "BAD X-GM-LABELS not supported"
+                labels = [decode_name(v) for v in values]
+                for label in labels:
+                    if op.startswith("-"):
+                        self.account.unlabel(msg, label)
+                    else:
+                        self.account.label(msg, label)
+                if not silent:
+                    shown = " ".join(encode_name(l) for l in sorted(msg.labels))
+                    self.untagged(f"{folder.seq(uid)} FETCH (X-GM-LABELS ({shown}) UID {uid})"
+                                  if uid in folder.uids else f"{uid} FETCH (UID {uid})")
+                continue
+            flags = set(values)
+            if op.startswith("+"):
+                msg.flags |= flags
+            elif op.startswith("-"):
+                msg.flags -= flags
+            else:
+                msg.flags = flags
+            self.account.touch(msg)
+            if not silent:
+                self.untagged(f"{folder.seq(uid)} FETCH (UID {uid} FLAGS ({' '.join(sorted(msg.flags))}))")
+
+    def cmd_UID_FETCH(self, args):
+        folder = self.require_selected()
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        since = None
+        if len(args) > 2 and isinstance(args[2], list) and len(args[2]) == 2 \
+                and str(args[2][0]).upper() == "CHANGEDSINCE":
+            since = int(args[2][1])
+            items = items + ["MODSEQ"]
+        for uid in parse_set(args[0], folder):
+            if since is None or folder.uids[uid].modseq > since:
+                self.send_fetch(folder, uid, items)
+
+    def send_fetch(self, folder, uid, items):
+        msg = folder.uids[uid]
+        parts = [f"UID {uid}"]
+        literals = []
+        i = 0
+        while i < len(items):
+            item = str(items[i]).upper()
+            if item == "FLAGS":
+                parts.append(f"FLAGS ({' '.join(sorted(msg.flags))})")
+            elif item == "RFC822.SIZE":
+                parts.append(f"RFC822.SIZE {len(msg.raw)}")
+            elif item == "X-GM-MSGID":
+                parts.append(f"X-GM-MSGID {msg.gid}")
+            elif item == "X-GM-LABELS":
+                shown = " ".join(encode_name(l) for l in sorted(msg.labels))
+                parts.append(f"X-GM-LABELS ({shown})")
+            elif item == "MODSEQ":
+                if not any(p.startswith("MODSEQ") for p in parts):
+                    parts.append(f"MODSEQ ({msg.modseq})")
+            elif item == "ENVELOPE":
+                parts.append(f"ENVELOPE {envelope(msg.raw)}")
+            elif item.startswith("BODY") or item.startswith("RFC822"):
+                section = item
+                if item.endswith("[HEADER.FIELDS") or item.endswith("[HEADER.FIELDS.NOT"):
+                    i += 1
+                    fields = [str(f).upper() for f in items[i]]
+                    i += 1  # closing "]" token
+                    section = item.replace(".PEEK", "") + " (" + " ".join(fields) + ")]"
+                    data = header_fields(msg.raw, fields)
+                elif "HEADER" in item:
+                    section = item.replace(".PEEK", "")
+                    data = msg.raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+                else:
+                    section = item.replace(".PEEK", "")
+                    data = msg.raw
+                partial = PARTIAL_RE.search(section)
+                if partial:
+                    # BODY[]<offset.size> answers as BODY[]<offset>
+                    offset, size = int(partial.group(1)), int(partial.group(2))
+                    data = data[offset:offset + size]
+                    section = section[:partial.start()] + f"<{offset}>"
+                literals.append((section, data))
+            i += 1
+        head = f"* {folder.seq(uid)} FETCH (" + " ".join(parts)
+        if not literals:
+            self.send(head + ")\r\n")
+            return
+        self.send(head)
+        for section, data in literals:
+            self.send(f" {section} {{{len(data)}}}\r\n")
+            self.send(data)
+        self.send(")\r\n")
+
+
+def _nstring(value):
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def envelope(raw):
+    """RFC 3501 ENVELOPE of a raw message."""
+    headers = BytesHeaderParser().parsebytes(raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n")
+
+    def addresses(name):
+        values = headers.get_all(name)
+        if not values:
+            return "NIL"
+        parts = []
+        for display, address in getaddresses(values):
+            mailbox, _, host = address.partition("@")
+            parts.append(f"({_nstring(display or None)} NIL {_nstring(mailbox)} {_nstring(host)})")
+        return "(" + "".join(parts) + ")"
+
+    sender = addresses("From")
+    fields = [_nstring(headers.get("Date")), _nstring(headers.get("Subject")), sender,
+              addresses("Sender") if headers.get("Sender") else sender,
+              addresses("Reply-To") if headers.get("Reply-To") else sender,
+              addresses("To"), addresses("Cc"), addresses("Bcc"),
+              _nstring(headers.get("In-Reply-To")), _nstring(headers.get("Message-ID"))]
+    return "(" + " ".join(fields) + ")"
+
+
+def header_fields(raw, fields):
+    """The named header fields of a raw message, IMAP style."""
+    head = raw.split(b"\r\n\r\n", 1)[0]
+    lines = []
+    keep = False
+    for line in head.split(b"\r\n"):
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        name = line.split(b":", 1)[0].decode("ascii", errors="replace").upper()
+        keep = name in fields
+        if keep:
+            lines.append(line)
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Threaded fake Gmail on 127.0.0.1 with fault injection."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, account, capabilities=GMAIL_CAPABILITIES, password=None,
+                 latency=0.0, command_latency=None, throttle_every=0,
+                 disconnect_every=0, idle_timeout=0, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        # One Account for every login, or {username: Account}
+        self.accounts = account if isinstance(account, dict) else None
+        self.account = next(iter(account.values())) if self.accounts else account
+        if "X-GM-EXT-1" not in capabilities.split():
+            for each in (self.accounts or {None: account}).values():
+                each.use_folders()
+        self.capabilities = capabilities
+        self.password = password
+        self.latency = latency
+        self.idle_timeout = idle_timeout
+        self.command_latency = command_latency or {}
+        self.throttle_every = throttle_every
+        self.disconnect_every = disconnect_every
+        self.stats = Stats()
+        self.counter = itertools.count(1)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def account_for(self, user):
+        if self.accounts is None or user is None:
+            return self.account
+        return self.accounts[user]
+
+    def before_command(self, handler, tag, name):
+        """Apply injected faults: returns None, "throttle" or "drop"."""
+        n = next(self.counter)
+        with self.stats.lock:
+            self.stats.commands[name] += 1
+        delay = self.command_latency.get(name)
+        if delay:
+            time.sleep(delay)
+        if name in ("LOGIN", "LOGOUT", "CAPABILITY"):
+            return None
+        if self.disconnect_every and n % self.disconnect_every == 0:
+            handler.send("* BYE Connection dropped (injected fault)\r\n")
+            handler.flush()
+            handler.request.shutdown(socket.SHUT_RDWR)
+            return "drop"
+        if self.throttle_every and n % self.throttle_every == 0:
+            # Rejected before running, like Gmail's throttling
+            handler.send(f"{tag} NO [THROTTLED] Too many commands (injected)\r\n")
+            return "throttle"
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Gmail INBOX filer — Frost Peak
+Files INBOX mail into the 8 categories organize-email.py creates.
+
+Each message's From, To/Cc, List-Id and Subject are matched against
+RULES (or a JSON file of the same shape, --rules FILE), compiled by
+imap_rules into one regex per header field. Headers are fetched a few
+thousand messages per UID FETCH with BODY.PEEK[HEADER.FIELDS (...)],
+which leaves \\Seen alone, and the matches are moved one destination at
+a time with UID MOVE over compact UID sets (on Gmail that swaps the
+INBOX label for the category label). Messages no rule matches stay in
+INBOX.
+
+Running again is safe: filed messages have left INBOX, so an interrupted
+run simply picks up what is left.
+
+--watch keeps running and files mail as it arrives: it waits in IDLE on
+INBOX (polling with NOOP on servers without IDLE) and, on each wake-up,
+fetches and files only the UIDs above the last one it handled, so the
+cost follows new mail rather than mailbox size. IDLE is restarted every
+25 minutes, ahead of Gmail's 29-minute cut-off, and a dropped
+connection is reopened. The last handled UID is kept in the metadata
+cache, so a restarted watcher picks up what arrived while it was down;
+a first start begins with new mail only (file the backlog with a normal
+run).
+
+Usage:
+    python3 file-inbox.py                  # Dry-run (preview only)
+    python3 file-inbox.py --execute        # Move the matched messages
+    python3 file-inbox.py --rules FILE     # Rules from a JSON file
+    python3 file-inbox.py --watch --execute      # Keep filing new mail as it arrives
+    python3 file-inbox.py --watch          # ...or only report what would be filed
+    python3 file-inbox.py --profile [TRACE]      # Latency report (+ JSON trace)
+    python3 file-inbox.py --execute --yes  # Unattended: no prompts (see imap_credentials)
+"""
+
+import imaplib
+import sys
+import time
+
+from imap_credentials import CredentialError, arg_value, confirm, get_credentials
+from imap_helpers import imap_encode, move_selected, selected_uidvalidity, uid_ranges, unselect
+from imap_rules import FETCH_FIELDS, RuleSet, load_rules, parse_header_fetch, parse_headers
+from imap_run import Context
+from imap_session import UidValidityChanged
+from imap_trace import phase, profile_arg
+
+# ──────────────────────────────────────────────
+# Filing rules: destination → {field: [patterns]}
+# Fields: list-id, from, to (To and Cc), subject. Patterns are
+# case-insensitive regexes; see imap_rules for how a match is chosen.
+# ──────────────────────────────────────────────
+
+RULES = {
+    # ── Finance ──
+    "Finance/Stripe":           {"from": [r"[@.]stripe\."]},
+    "Finance/Gusto":            {"from": [r"[@.]gusto\."]},
+    "Finance/Payroll":          {"subject": [r"\bpayroll\b"]},
+    "Finance/Bank Statements":  {"subject": [r"\bstatement is (ready|available)\b"]},
+    "Finance/Invoices":         {"subject": [r"\binvoices?\b"]},
+    "Finance/Receipts":         {"subject": [r"\breceipts?\b"]},
+    "Finance/Payments":         {"subject": [r"\bpayment (received|confirmation|failed)\b"]},
+    "Finance/Taxes":            {"subject": [r"\b(1099|w-?2|w-?9|tax documents?|tax return)\b"]},
+    "Finance/Insurance":        {"subject": [r"\b(policy|premium) (renewal|notice)\b"]},
+    "Finance/Bank":             {"from": [r"[@.](chase|wellsfargo|bankofamerica|bank)\."]},
+
+    # ── Sales & Marketing ──
+    "Sales & Marketing/Google Ads":  {"from": [r"ads-(account-)?noreply@google\.com", r"[@.]google-ads\."]},
+    "Sales & Marketing/Meta Ads":    {"from": [r"[@.](meta-ads|facebookmail)\."]},
+    "Sales & Marketing/Kajabi":      {"from": [r"[@.]kajabi\."]},
+    "Sales & Marketing/Leads":       {"subject": [r"\bnew (lead|inquiry)\b"]},
+    "Sales & Marketing/Reviews":     {"from": [r"[@.](yelp|tripadvisor|trustpilot|reviews)\."],
+                                      "subject": [r"\bnew review\b"]},
+    "Sales & Marketing/Social":      {"from": [r"[@.](facebook|instagram|linkedin|social)\."]},
+    "Sales & Marketing/Campaigns":   {"from": [r"[@.](mailchimp|klaviyo|campaigns)\."]},
+
+    # ── Operations ──
+    "Operations/Squarespace":   {"from": [r"[@.]squarespace\."]},
+    "Operations/Xola Support":  {"from": [r"[@.]xola\."]},
+    "Operations/Shipping":      {"from": [r"[@.](usps|ups|fedex|dhl|shipping)\."],
+                                 "subject": [r"\b(has shipped|tracking number|out for delivery)\b"]},
+    "Operations/Orders":        {"subject": [r"\border (confirmation|#\s?\d+)"]},
+    "Operations/Domain":        {"subject": [r"\bdomain (renewal|expir\w*)\b"]},
+    "Operations/DNS":           {"from": [r"[@.](cloudflare|dns)\."]},
+
+    # ── Legal & HR ──
+    "Legal & HR/Signatures":    {"from": [r"[@.](docusign|hellosign|dropboxsign|signatures)\."]},
+    "Legal & HR/Security":      {"subject": [r"\bsecurity alert\b", r"\bnew sign-in\b"]},
+    "Legal & HR/HR":            {"from": [r"[@.](bamboohr|hr)\."]},
+
+    # ── Scheduling ──
+    "Scheduling/Declined":      {"subject": [r"^declined:"]},
+    "Scheduling/Cancelled":     {"subject": [r"^(cancelled|canceled)( event)?:"]},
+    "Scheduling/Calendar":      {"from": [r"calendar-notification@google\.com"],
+                                 "subject": [r"^(updated )?invitation:", r"^accepted:"]},
+    "Scheduling/Zoom":          {"from": [r"[@.]zoom\.(us|com)"]},
+
+    # ── Personal ──
+    "Personal/Password Reset":  {"subject": [r"\b(reset your password|password reset)\b"]},
+    "Personal/Newsletters":     {"list-id": [r"newsletter", r"substack"],
+                                 "from": [r"[@.](substack|newsletters?)\."]},
+    "Personal/Travel":          {"from": [r"[@.](delta|united|southwest|airbnb|expedia|booking|travel)\."]},
+    "Personal/Shopping":        {"from": [r"[@.](amazon|etsy|shopping)\."]},
+}
+
+FETCH_CHUNK = 2000   # messages per UID FETCH
+MOVE_CHUNK = 5000    # messages per UID MOVE (before splitting into UID sets)
+SAMPLES = 3          # subjects shown per destination in the plan
+POLL_INTERVAL = 60   # seconds between checks when the server has no IDLE
+RETRY_DELAY = 60     # seconds before reconnecting after the session gave up
+
+
+def fetch_headers(imap, uids, rules):
+    """{destination: [uid]} and {destination: [subject]} for the INBOX UIDs."""
+    matched, samples = {}, {}
+    started = time.monotonic()
+    for i in range(0, len(uids), FETCH_CHUNK):
+        for uid_set in uid_ranges(uids[i:i + FETCH_CHUNK]):
+            status, data = imap.uid("FETCH", uid_set, f"(BODY.PEEK[HEADER.FIELDS {FETCH_FIELDS}])")
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+            for uid, raw in parse_header_fetch(data):
+                headers = parse_headers(raw)
+                dest = rules.match(headers)
+                if dest is None:
+                    continue
+                matched.setdefault(dest, []).append(uid)
+                if len(samples.setdefault(dest, [])) < SAMPLES:
+                    samples[dest].append(headers["subject"])
+        done = min(i + FETCH_CHUNK, len(uids))
+        if len(uids) > FETCH_CHUNK:
+            rate = done / max(time.monotonic() - started, 0.001)
+            print(f"  Headers: {done}/{len(uids)} ({rate:.0f} msg/s)")
+    return matched, samples
+
+
+def move_matched(imap, matched, caps):
+    """Move each destination's UIDs out of the selected INBOX; {dest: moved}."""
+    moved = {}
+    if matched and "MOVE" not in caps and "UIDPLUS" not in caps:
+        print("    [!] Server has neither MOVE nor UIDPLUS: filed messages are copied and"
+              " left in INBOX flagged \\Deleted (expunge them from your mail client)")
+    for dest, uids in matched.items():
+        moved[dest] = 0
+        for i in range(0, len(uids), MOVE_CHUNK):
+            chunk = uids[i:i + MOVE_CHUNK]
+            results = [move_selected(imap, dest, caps, uid_set) for uid_set in uid_ranges(chunk)]
+            failures = [data for ok, data in results if not ok]
+            if failures:
+                print(f"    [!] MOVE to '{dest}' failed: {failures[0]}")
+                break
+            moved[dest] += len(chunk)
+        print(f"    {dest:<40} {moved[dest]:>6} msgs")
+    return moved
+
+
+def create_folders(ctx, dests):
+    """CREATE the destinations the account does not have yet."""
+    folders = ctx.list_folders()
+    for dest in sorted(dests):
+        if folders is not None and dest in folders:
+            continue
+        status, data = ctx.imap.create(imap_encode(dest))
+        if status == "OK":
+            print(f"  Created: {dest}")
+            if folders is not None:
+                folders.add(dest)
+
+
+# ──────────────────────────────────────────────
+# Watch mode
+# ──────────────────────────────────────────────
+
+def select_inbox(ctx, execute):
+    """Select INBOX; returns (uidvalidity, last UID already handled)."""
+    status, data = ctx.imap.select("INBOX", readonly=not execute)
+    if status != "OK":
+        print(f"Could not select INBOX: {data}")
+        sys.exit(1)
+    uidvalidity = selected_uidvalidity(ctx.imap)
+    _, data = ctx.imap.response("UIDNEXT")
+    try:
+        uidnext = int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        uidnext = 1
+    saved = ctx.cache.watermark("INBOX")
+    if saved and saved[0] == uidvalidity:
+        return uidvalidity, saved[1]
+    return uidvalidity, uidnext - 1
+
+
+def file_new(ctx, rules, uids, execute):
+    """Match and (with --execute) file newly arrived UIDs."""
+    matched, samples = fetch_headers(ctx.imap, uids, rules)
+    stamp = time.strftime("%H:%M:%S")
+    total = sum(len(u) for u in matched.values())
+    if not execute:
+        print(f"[{stamp}] {len(uids)} new, {total} would be filed")
+        for dest in sorted(matched):
+            print(f"    {dest:<40} {len(matched[dest]):>6} msgs  e.g. {samples[dest][0][:40]}")
+        return
+    if matched:
+        ctx.cache.invalidate()
+        create_folders(ctx, matched)
+        moved = move_matched(ctx.imap, matched, ctx.caps)
+        total = sum(moved.values())
+    print(f"[{stamp}] {len(uids)} new, {total} filed")
+
+
+def watch(ctx, rules):
+    """File INBOX mail as it arrives, until interrupted."""
+    execute = "--execute" in ctx.argv
+    imap = ctx.imap
+    idle = "IDLE" in ctx.caps
+    phase("watch")
+    uidvalidity, last = select_inbox(ctx, execute)
+    how = "IDLE" if idle else f"polling every {POLL_INTERVAL}s"
+    print(f"Watching INBOX for UIDs above {last} ({how}); Ctrl-C to stop.\n")
+    try:
+        while True:
+            try:
+                status, data = imap.uid("SEARCH", "UID", f"{last + 1}:*")
+                uids = sorted(u for u in map(int, (data[0] or b"").split()) if u > last) \
+                    if status == "OK" else []
+                if uids:
+                    file_new(ctx, rules, uids, execute)
+                    last = uids[-1]
+                    if execute:
+                        ctx.cache.set_watermark("INBOX", uidvalidity, last)
+                    continue
+                if idle:
+                    imap.idle()
+                else:
+                    time.sleep(POLL_INTERVAL)
+                    imap.noop()
+            except UidValidityChanged:
+                print("  [~] INBOX was recreated; watching it from its next message")
+                uidvalidity, last = select_inbox(ctx, execute)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                print(f"  [~] Connection lost ({e}); retrying in {RETRY_DELAY}s")
+                time.sleep(RETRY_DELAY)
+                try:
+                    imap.reconnect()
+                except UidValidityChanged:
+                    uidvalidity, last = select_inbox(ctx, execute)
+                except (imaplib.IMAP4.error, OSError):
+                    pass
+    except KeyboardInterrupt:
+        print(f"\nStopped watching (handled up to UID {last}).")
+    return True
+
+
+def banner(argv):
+    execute = "--execute" in argv
+    print("=" * 62)
+    print("  Gmail INBOX Filer — Frost Peak")
+    print("  Files INBOX mail into the 8 categories by header rules")
+    print("=" * 62)
+    print()
+
+    if "--watch" in argv:
+        print(f"  MODE: WATCH{', EXECUTE (messages will be moved!)' if execute else ' (report only)'}")
+        if not execute:
+            print("  Add --execute to move messages")
+    elif execute:
+        print("  MODE: EXECUTE (messages will be moved!)")
+    else:
+        print("  MODE: DRY RUN (preview only)")
+        print("  Add --execute to move messages")
+    print()
+
+
+def run(ctx):
+    """Match INBOX against the rules and (with --execute) file it; False if aborted."""
+    execute = "--execute" in ctx.argv
+    imap, caps = ctx.imap, ctx.caps
+
+    rules_file = arg_value(ctx.argv, "--rules")
+    try:
+        rules = load_rules(rules_file) if rules_file else RuleSet(RULES)
+    except (OSError, ValueError) as e:
+        print(f"Cannot load rules: {e}")
+        sys.exit(1)
+    print(f"Rules: {len(rules)} patterns for {len(set(rules.destinations))} folders"
+          f"{f' from {rules_file}' if rules_file else ''}\n")
+    if "--watch" in ctx.argv:
+        return watch(ctx, rules)
+
+    phase("fetch")
+    status, data = imap.select("INBOX", readonly=not execute)
+    if status != "OK":
+        print(f"Could not select INBOX: {data}")
+        sys.exit(1)
+    try:
+        status, data = imap.uid("SEARCH", "UNDELETED")
+        if status != "OK":
+            print(f"INBOX search failed: {data}")
+            sys.exit(1)
+        uids = sorted(int(u) for u in (data[0] or b"").split())
+        print(f"INBOX: {len(uids)} messages")
+        t0 = time.monotonic()
+        matched, samples = fetch_headers(imap, uids, rules)
+        print(f"Matched in {time.monotonic() - t0:.1f}s\n")
+
+        # ── Print plan ──
+        phase("plan")
+        total = sum(len(u) for u in matched.values())
+        print("─" * 62)
+        print("MOVES (INBOX → folder):")
+        print("─" * 62)
+        for dest in sorted(matched):
+            print(f"  {dest:<40} {len(matched[dest]):>6} msgs")
+            for subject in samples[dest]:
+                print(f"      {subject[:70]}")
+        print(f"\n  Total: {total} of {len(uids)} messages; "
+              f"{len(uids) - total} stay in INBOX\n")
+
+        if not execute:
+            print("=" * 62)
+            print("  DRY RUN complete. No messages were moved.")
+            print("  Run with --execute to file them.")
+            print("=" * 62)
+            return True
+        if not matched:
+            print("Nothing to file.")
+            return True
+
+        # ── Confirm ──
+        print("=" * 62)
+        print(f"  READY: {total} messages into {len(matched)} folders")
+        print("  Messages are NEVER deleted — only moved out of INBOX.")
+        print("=" * 62)
+        if not confirm(ctx.argv, "\n  Type 'yes' to proceed: "):
+            print("Aborted.")
+            return False
+        print()
+
+        # ── Create missing folders, then move ──
+        phase("apply")
+        ctx.cache.invalidate()
+        create_folders(ctx, matched)
+        print(f"\nMoving {total} messages...")
+        moved = move_matched(imap, matched, caps)
+    finally:
+        unselect(imap, caps, "INBOX")
+
+    failed = total - sum(moved.values())
+    print()
+    print("=" * 62)
+    print(f"  INBOX filed: {sum(moved.values())} moved, {failed} failed")
+    print("=" * 62)
+    return True
+
+
+def main():
+    banner(sys.argv)
+
+    # ── Credentials ──
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
+
+    # ── Connect ──
+    phase("connect")
+    print("Connecting to Gmail IMAP...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+        print("Connected successfully.\n")
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        print("Make sure you're using an App Password, not your regular password.")
+        print("Create one at: https://myaccount.google.com/apppasswords")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        run(ctx)
+    finally:
+        ctx.close()
+
+
+if __name__ == "__main__":
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run with --execute again to file what is left.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
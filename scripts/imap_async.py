@@ -0,0 +1,323 @@
+"""
+Asyncio IMAP client that pipelines read-only discovery commands.
+
+imaplib waits for each tagged response before sending the next command,
+so counting N folders costs N round trips. IMAP lets a client keep
+several tagged commands in flight on one connection; this client writes
+a whole window of STATUS / LIST / EXAMINE commands, then matches the
+tagged completions (and the untagged data in between) back to them, so a
+batch costs about one round trip.
+
+Only read-only commands go through here. Untagged responses are returned
+in imaplib's shape ({TYPE: [data, ...]}, literals as (head, bytes)
+tuples) so imap_helpers' parsers work on them unchanged.
+
+The side connection is opened once per Session (run_pipelined) and kept
+until the Session logs out. Each pipelined command takes a token from
+the account's shared RateLimiter before it is written, and its latency
+and any [THROTTLED] rejection feed back into it, as for every other
+command.
+"""
+
+import asyncio
+import random
+import re
+import ssl as ssl_module
+import threading
+import time
+from collections import deque
+
+import imap_trace
+from imap_session import MAILBOX_COMMANDS, RECONNECT_RETRIES, THROTTLE_RE
+
+TAGGED_RE = re.compile(rb"^(A\d+) (OK|NO|BAD) ?(.*)$")
+UNTAGGED_RE = re.compile(rb"^\* (?:(\d+) )?([A-Z-]+) ?(.*)$", re.DOTALL)
+LITERAL_RE = re.compile(rb"\{(\d+)\+?\}$")
+
+PIPELINE_WINDOW = 64
+
+
+def quote(text):
+    """IMAP quoted string."""
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncIMAP:
+    """One IMAP connection with many tagged commands in flight."""
+
+    nbytes = 0
+    limiter = None          # imap_session.RateLimiter of the account
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tagnum = 0
+        self.pending = {}       # tag → (future, untagged dict, command, send time)
+        self.order = deque()    # tags in send order
+        self.task = None
+        self.error = None       # set once the connection has died
+        self.sent = {}          # tag → (args, send time, response bytes), when tracing
+
+    @classmethod
+    async def open(cls, host, port, use_ssl=True, timeout=60):
+        context = ssl_module.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), timeout)
+        self = cls(reader, writer)
+        greeting = await self._read_response()
+        if not greeting[0].startswith(b"* OK"):
+            raise ConnectionError(f"unexpected greeting: {greeting[0]!r}")
+        self.task = asyncio.ensure_future(self._dispatch())
+        return self
+
+    async def _read_response(self):
+        """One complete response: [line, literal, line, literal, ..., line]."""
+        parts = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("connection closed by server")
+            self.nbytes += len(line)
+            line = line.rstrip(b"\r\n")
+            parts.append(line)
+            match = LITERAL_RE.search(line)
+            if not match:
+                return parts
+            parts.append(await self.reader.readexactly(int(match.group(1))))
+            self.nbytes += len(parts[-1])
+
+    async def _dispatch(self):
+        """Route responses to the command futures until the socket closes."""
+        try:
+            while True:
+                self.nbytes = 0
+                parts = await self._read_response()
+                tagged = TAGGED_RE.match(parts[0])
+                if self.order and self.order[0] in self.sent:
+                    self.sent[self.order[0]][2] += self.nbytes
+                if tagged:
+                    tag = tagged.group(1).decode()
+                    if tag in self.sent:
+                        self._trace(tag, tagged.group(2).decode())
+                    if tag in self.pending:
+                        future, untagged, name, t0 = self.pending.pop(tag)
+                        self.order.remove(tag)
+                        if self.limiter is not None:
+                            self.limiter.observe(f"{name} pipelined", time.monotonic() - t0)
+                        if not future.done():
+                            future.set_result((tagged.group(2).decode(),
+                                               [tagged.group(3)], untagged))
+                    continue
+                if not self.order or not parts[0].startswith(b"* "):
+                    continue
+                # Servers answer pipelined commands in order, so untagged
+                # data belongs to the oldest command still in flight
+                untagged = self.pending[self.order[0]][1]
+                kind, data = _untagged(parts)
+                untagged.setdefault(kind, []).extend(data)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+            self.error = ConnectionError(str(e) or "connection lost")
+            for future, *_ in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.error)
+
+    def send(self, *args):
+        """Write one tagged command; returns a future of (typ, data, untagged)."""
+        self.tagnum += 1
+        tag = f"A{self.tagnum:04d}"
+        future = asyncio.get_running_loop().create_future()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        self.pending[tag] = (future, {}, args[0], time.monotonic())
+        self.order.append(tag)
+        if imap_trace.active is not None:
+            self.sent[tag] = [args, time.monotonic(), 0]
+        self.writer.write(f"{tag} {' '.join(args)}\r\n".encode("utf-8"))
+        return future
+
+    def _trace(self, tag, status):
+        """Record one completed command with imap_trace."""
+        args, t0, nbytes = self.sent.pop(tag)
+        mailbox = imap_trace.mailbox_arg(args[1]) if args[0] in MAILBOX_COMMANDS else ""
+        imap_trace.active.record("pipelined", args[0], mailbox,
+                                 time.monotonic() - t0, nbytes, status=status)
+
+    async def pace(self):
+        """Wait for the rate limiter's go-ahead for one more command."""
+        if self.limiter is None:
+            return
+        wait = self.limiter.reserve()
+        if wait:
+            try:
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            await asyncio.sleep(wait)
+
+    async def command(self, *args):
+        await self.pace()
+        future = self.send(*args)
+        await self.writer.drain()
+        return await future
+
+    async def pipeline(self, commands, window=PIPELINE_WINDOW):
+        """Run many commands with up to `window` in flight; results in order.
+
+        A command cut off by a dropped connection gets its exception in
+        place of a result, so the caller can resend just those.
+        """
+        results = []
+        for i in range(0, len(commands), window):
+            futures = []
+            for args in commands[i:i + window]:
+                await self.pace()
+                futures.append(self.send(*args))
+            try:
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            results.extend(await asyncio.gather(*futures, return_exceptions=True))
+        return results
+
+    async def login(self, user, password):
+        typ, data, _ = await self.command("LOGIN", quote(user), quote(password))
+        if typ != "OK":
+            raise ConnectionError(f"login failed: {data}")
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 10)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        self.writer.close()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+
+def _untagged(parts):
+    """Convert a raw untagged response to imaplib's (TYPE, [data]) shape."""
+    match = UNTAGGED_RE.match(parts[0])
+    if not match:
+        return "UNKNOWN", [b"\r\n".join(p for p in parts if isinstance(p, bytes))]
+    number, kind, rest = match.groups()
+    kind = kind.decode()
+    if number is not None:
+        return kind, [number]
+    code = re.match(rb"\[([A-Z-]+) ?([^\]]*)\]", rest) if kind == "OK" else None
+    if code:
+        # "* OK [UIDVALIDITY 3]" is filed under UIDVALIDITY, like imaplib
+        return code.group(1).decode(), [code.group(2)]
+    if len(parts) == 1:
+        return kind, [rest]
+    data = []
+    head = rest
+    for i in range(1, len(parts), 2):
+        data.append((head, parts[i]))
+        head = parts[i + 1] if i + 1 < len(parts) else b""
+    if head:
+        data.append(head)
+    return kind, data
+
+
+# ──────────────────────────────────────────────
+# Synchronous entry points for the scripts
+# ──────────────────────────────────────────────
+
+def _retry(result):
+    """True if a pipelined command must be sent again."""
+    if result is None or isinstance(result, Exception):
+        return True
+    typ, data, _ = result
+    return typ != "OK" and any(THROTTLE_RE.search(d) for d in data if isinstance(d, bytes))
+
+
+class SideConnection:
+    """The extra connection a Session pipelines its commands on.
+
+    Opened on first use with the Session's host, port and credentials and
+    kept, with its own event loop, for every later batch; a connection
+    that has died is replaced on the next one. Commands are paced by the
+    Session's RateLimiter.
+    """
+
+    def __init__(self, host, port, use_ssl, credentials, limiter):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.credentials = credentials
+        self.limiter = limiter
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.lock = threading.Lock()
+
+    def run(self, commands):
+        with self.lock:
+            return self.loop.run_until_complete(self._run(commands))
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.loop.run_until_complete(self.client.logout())
+                self.client = None
+            self.loop.close()
+
+    async def _connect(self):
+        """The live client, logging in a new one if there is none."""
+        if self.client is not None and self.client.error is None:
+            return self.client
+        if self.client is not None:
+            await self.client.logout()
+            self.client = None
+        client = await AsyncIMAP.open(self.host, self.port, self.use_ssl)
+        client.limiter = self.limiter
+        try:
+            await client.login(*self.credentials)
+        except ConnectionError:
+            await client.logout()
+            raise
+        self.client = client
+        return client
+
+    async def _run(self, commands):
+        """Pipeline the commands, resending any cut off by a disconnect or
+        rejected with [THROTTLED] (they are all read-only). Gives up after
+        RECONNECT_RETRIES attempts in a row that complete nothing."""
+        results = [None] * len(commands)
+        todo = list(range(len(commands)))
+        stalled = 0
+        error = None
+        while todo and stalled <= RECONNECT_RETRIES:
+            if stalled:
+                await asyncio.sleep(min(2 ** (stalled - 1), 30) * random.uniform(0.5, 1.5))
+            try:
+                client = await self._connect()
+                for i, result in zip(todo, await client.pipeline([commands[i] for i in todo])):
+                    results[i] = result
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                error = ConnectionError(str(e) or "connection lost")
+            left = [i for i in todo if _retry(results[i])]
+            if self.limiter is not None and any(
+                    not isinstance(results[i], Exception) and results[i] is not None
+                    for i in left):
+                await asyncio.sleep(self.limiter.throttled())
+            stalled = stalled + 1 if len(left) == len(todo) else 0
+            todo = left
+        for result in results:
+            if isinstance(result, Exception) or result is None:
+                raise error if result is None else result
+        return results
+
+
+def run_pipelined(imap, commands):
+    """Run read-only commands pipelined on the Session's side connection.
+
+    `imap` is a logged-in Session; the side connection reuses its host,
+    port, cached credentials and RateLimiter, and stays open until the
+    Session logs out. Returns one (typ, data, untagged) per command.
+    """
+    if getattr(imap, "side", None) is None:
+        imap.side = SideConnection(imap.host, imap.port, hasattr(imap, "ssl_context"),
+                                   imap.credentials, getattr(imap, "limiter", None))
+    return imap.side.run(commands)
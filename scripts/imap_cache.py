@@ -0,0 +1,203 @@
+"""
+Persistent per-account metadata cache (SQLite).
+
+Every run used to start from zero: LIST, then a STATUS for each folder.
+The cache keeps, per account, each folder's MESSAGES / UIDNEXT /
+UIDVALIDITY / HIGHESTMODSEQ from the last STATUS, and the outcome of the
+last run of every planned operation.
+
+Revalidation is one command. Gmail's HIGHESTMODSEQ is account-wide, so a
+STATUS on All Mail (MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ) changes
+whenever any message is added, removed, relabelled or flagged anywhere.
+If it matches the stored value, every cached folder is still accurate
+and only folders the cache has never seen are queried; repeated dry runs
+cost a LIST and a single STATUS. If it differs, the cache is cleared and
+refilled from the STATUS calls the run makes anyway. Servers without
+X-GM-EXT-1 and CONDSTORE have no account-wide change marker, so there
+the cache is written but never trusted.
+
+Revalidation is all-or-nothing on purpose: any change anywhere drops
+every cached count. The only per-folder check IMAP offers is a STATUS
+(or LIST-STATUS) of the folder, and its reply already carries the
+MESSAGES count being cached, so checking folders one by one and
+re-fetching the ones that differ costs exactly what re-counting them all
+does (MessageCounts.prefetch_many pipelines that into about one round
+trip per batch). Only the account-wide marker is cheaper than a recount.
+
+The stored marker is taken before any folder is re-counted, so mail that
+arrives mid-run only makes the next run refresh, never trust stale
+counts. Any change a run makes itself (rename, merge, delete) clears the
+marker. `--refresh` ignores the cache for one run.
+
+The cache also keeps how far file-inbox.py --watch has filed INBOX
+(UIDVALIDITY and last UID), so a restarted watcher only looks at mail
+that arrived since.
+
+Caches live next to the journals: ~/.local/state/gmail-reorg/cache-<account>.sqlite
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from imap_helpers import imap_encode, parse_status_response, status_for
+from imap_journal import journal_path
+
+ACCOUNT_ITEMS = "(MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)"
+FIELDS = ("MESSAGES", "UIDNEXT", "UIDVALIDITY", "HIGHESTMODSEQ")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    name TEXT PRIMARY KEY,
+    messages INTEGER, uidnext INTEGER, uidvalidity INTEGER, highestmodseq INTEGER,
+    checked REAL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS outcomes (
+    script TEXT, op TEXT, src TEXT, dst TEXT NOT NULL DEFAULT '',
+    ok INTEGER, ts REAL,
+    PRIMARY KEY (script, op, src, dst)
+);
+"""
+
+
+def cache_path(account):
+    """Cache file for one account."""
+    return journal_path("cache", account)[:-len(".jsonl")] + ".sqlite"
+
+
+def open_cache(account, argv):
+    """The account's MetadataCache; `--refresh` in argv ignores its contents."""
+    cache = MetadataCache(cache_path(account))
+    cache.trusted = "--refresh" not in argv
+    return cache
+
+
+class MetadataCache:
+    """Folder STATUS and operation outcomes that survive between runs."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.trusted = True
+        self.valid = None       # None until validate() has run
+        self.folders = {}       # name -> attrs, read once by validate()
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    # ── Folder counts ──
+
+    def validate(self, imap, caps):
+        """Check the account-wide change marker once; True if counts are current.
+
+        All or nothing: see the module docstring for why folders are not
+        revalidated one by one.
+        """
+        if self.valid is not None:
+            return self.valid
+        all_mail = getattr(caps, "all_mail", None)
+        if not ("X-GM-EXT-1" in caps and "CONDSTORE" in caps and all_mail):
+            self.valid = False
+            return False
+        try:
+            status, data = imap.status(imap_encode(all_mail), ACCOUNT_ITEMS)
+            attrs = (status_for(parse_status_response(data), all_mail) or {}) if status == "OK" else {}
+        except Exception:
+            attrs = {}
+        marker = [attrs.get(f) for f in FIELDS] if attrs else None
+        with self.lock:
+            self.valid = bool(self.trusted and marker and self._meta("account") == marker)
+            if not self.valid:
+                self.db.execute("DELETE FROM folders")
+                self._set_meta("account", marker)
+            rows = self.db.execute(
+                "SELECT name, messages, uidnext, uidvalidity, highestmodseq FROM folders"
+            ).fetchall()
+        self.folders = {row[0]: {f: v for f, v in zip(FIELDS, row[1:]) if v is not None}
+                        for row in rows}
+        if self.valid:
+            print(f"  Metadata cache: account unchanged, reusing {len(self.folders)} folder counts")
+        elif marker and self.trusted:
+            print("  Metadata cache: account changed since last run; refreshing counts")
+        return self.valid
+
+    def load(self, folders):
+        """Cached STATUS attributes for the folders it knows ({} if invalid)."""
+        if not self.valid:
+            return {}
+        return {f: self.folders[f] for f in folders if f in self.folders}
+
+    def store(self, statuses):
+        """Save {folder: attrs} from fresh STATUS replies."""
+        now = time.time()
+        rows = [(name, *(attrs.get(f) for f in FIELDS), now)
+                for name, attrs in statuses.items() if attrs]
+        if not rows:
+            return
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+
+    def invalidate(self):
+        """Forget the change marker after this run modified the account."""
+        with self.lock:
+            if self.valid is not False or self._meta("account") is not None:
+                self._set_meta("account", None)
+            self.valid = False
+
+    # ── Watch position ──
+
+    def watermark(self, mailbox):
+        """(uidvalidity, last UID) a watcher had handled in `mailbox`, or None."""
+        with self.lock:
+            value = self._meta(f"watch:{mailbox}")
+        return tuple(value) if value else None
+
+    def set_watermark(self, mailbox, uidvalidity, uid):
+        with self.lock:
+            self._set_meta(f"watch:{mailbox}", [uidvalidity, uid])
+
+    # ── Operation outcomes ──
+
+    def record_outcomes(self, script, ops, results):
+        """Remember how each applied operation went."""
+        now = time.time()
+        rows = [(script, op["op"], op["src"], op.get("dst") or "", int(bool(ok)), now)
+                for op, ok in zip(ops, results)]
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+
+    def report_outcomes(self, script, ops):
+        """Print planned operations that failed the last time they ran."""
+        failed = []
+        with self.lock:
+            for op in ops:
+                row = self.db.execute(
+                    "SELECT ok, ts FROM outcomes WHERE script = ? AND op = ? AND src = ? AND dst = ?",
+                    (script, op["op"], op["src"], op.get("dst") or "")).fetchone()
+                if row and not row[0]:
+                    failed.append((op, row[1]))
+        if not failed:
+            return
+        print(f"  [~] {len(failed)} of these operations failed last time:")
+        for op, ts in failed:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+            arrow = f" → '{op['dst']}'" if op.get("dst") else ""
+            print(f"      {op['op'].upper()} '{op['src']}'{arrow} ({when})")
+        print()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,169 @@
+"""
+Server capability probe and strategy selection.
+
+The scripts used to assume the lowest common denominator of IMAP. Now
+each run probes the server once per account, right after login, and
+picks the fastest way to do each job from what it advertises:
+
+  counting   LIST-STATUS: every folder in one round trip
+             otherwise:   STATUS pipelined on a side connection
+  moving     X-GM-EXT-1:  relabel in All Mail (UID STORE ±X-GM-LABELS),
+                          no message data copied
+             MOVE:        atomic UID MOVE per chunk
+             UIDPLUS:     UID COPY + STORE \\Deleted + UID EXPUNGE
+             otherwise:   COPY + STORE \\Deleted + EXPUNGE
+  renaming   RENAME (sub-folders follow the parent everywhere)
+  deleting   Gmail:       DELETE only removes the label; messages stay in
+                          All Mail
+             otherwise:   DELETE destroys the folder's messages, so only
+                          empty folders are deleted
+  transport  COMPRESS=DEFLATE: compress the connection (large LIST and
+             FETCH replies shrink several times)
+
+All Mail is found through its \\All special-use flag rather than by name,
+so "[Google Mail]/All Mail" accounts work and an account that hides All
+Mail from IMAP falls back to moving. The result is a ServerProfile, which
+is also the plain capability set, so `"MOVE" in caps` checks keep working.
+"""
+
+import re
+import threading
+
+GMAIL_ALL_MAIL = "[Gmail]/All Mail"
+
+# Capabilities that change how the scripts work
+PROBED = ("MOVE", "UIDPLUS", "LIST-STATUS", "CONDSTORE", "QRESYNC",
+          "COMPRESS=DEFLATE", "X-GM-EXT-1", "LITERAL+", "SPECIAL-USE")
+
+LIST_RE = re.compile(r'^\((.*?)\)\s+(?:"(?:[^"\\]|\\.)*"|NIL)\s+"?(.*?)"?\s*$')
+
+
+class ServerProfile(frozenset):
+    """The post-login CAPABILITY set plus the strategies chosen from it."""
+
+    def __new__(cls, caps, all_mail=None, host=""):
+        self = super().__new__(cls, (c.upper() for c in caps))
+        self.all_mail = all_mail
+        self.host = host
+        return self
+
+    @property
+    def gmail(self):
+        return "X-GM-EXT-1" in self
+
+    @property
+    def counting(self):
+        return "list-status" if "LIST-STATUS" in self else "pipelined-status"
+
+    @property
+    def moving(self):
+        if self.gmail and self.all_mail:
+            return "relabel"
+        if "MOVE" in self:
+            return "move"
+        if "UIDPLUS" in self:
+            return "copy-uid-expunge"
+        return "copy-expunge"
+
+    @property
+    def deleting(self):
+        return "label" if self.gmail else "empty-only"
+
+    @property
+    def compress(self):
+        return "COMPRESS=DEFLATE" in self
+
+    def describe(self):
+        """Lines for the scripts' output, one per strategy."""
+        counting = {
+            "list-status": "LIST-STATUS (all folders, one round trip)",
+            "pipelined-status": "pipelined STATUS (one round trip per batch)",
+        }[self.counting]
+        moving = {
+            "relabel": f"relabel in {self.all_mail} (X-GM-LABELS, no copying)",
+            "move": "UID MOVE in chunks",
+            "copy-uid-expunge": "UID COPY + UID EXPUNGE in chunks (no MOVE)",
+            "copy-expunge": "COPY + EXPUNGE (no MOVE or UIDPLUS)",
+        }[self.moving]
+        deleting = {
+            "label": "DELETE label (messages stay in All Mail)",
+            "empty-only": "DELETE empty folders only (DELETE destroys mail here)",
+        }[self.deleting]
+        supported = [c for c in PROBED if c in self]
+        return [
+            f"Server:     {self.host or 'IMAP'}"
+            f"{' (Gmail)' if self.gmail else ''}",
+            f"Counting:   {counting}",
+            f"Moving:     {moving}",
+            "Renaming:   RENAME (sub-folders follow)",
+            f"Deleting:   {deleting}",
+            f"Transport:  {'COMPRESS=DEFLATE' if self.compress else 'uncompressed'}",
+            f"Extensions: {' '.join(supported) or 'none'}",
+        ]
+
+
+def server_capabilities(imap):
+    """Return the post-login CAPABILITY set (uppercase strings)."""
+    try:
+        status, data = imap.capability()
+        if status == "OK" and data and data[0]:
+            return set(data[0].decode("ascii", errors="replace").upper().split())
+    except Exception:
+        pass
+    return {str(c).upper() for c in imap.capabilities}
+
+
+def find_all_mail(imap, caps):
+    """Name of the \\All special-use folder, or None if it is hidden."""
+    return find_special_use(imap, caps, "\\All")
+
+
+def find_special_use(imap, caps, use):
+    """Name of the folder with special-use attribute `use` (e.g. "\\Trash"), or None."""
+    if "SPECIAL-USE" in caps and "LIST-EXTENDED" in caps:
+        # RFC 6154: only the special-use folders come back
+        status, data = imap.list('(SPECIAL-USE) ""', '"*"')
+    else:
+        # Gmail's system folders all live under "[Gmail]" or "[Google Mail]"
+        status, data = imap.list('""', '"[*"')
+    if status != "OK":
+        return None
+    for item in data or []:
+        if not isinstance(item, bytes):
+            continue
+        match = LIST_RE.match(item.decode("utf-8", errors="replace"))
+        if match and use.upper() in match.group(1).upper().split():
+            return match.group(2).replace('\\"', '"').replace("&-", "&")
+    return None
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def cached_profile(host, account):
+    """The profile already probed for this account, if any."""
+    with _profiles_lock:
+        return _profiles.get((host, account))
+
+
+def probe_server(imap):
+    """Probe a logged-in connection once per account; returns a ServerProfile.
+
+    Later calls for the same account reuse the first result. Compression
+    is switched on for `imap` when the server offers it (imap_helpers'
+    connect() does the same for every later connection).
+    """
+    account = imap.credentials[0] if getattr(imap, "credentials", None) else None
+    key = (imap.host, account)
+    with _profiles_lock:
+        profile = _profiles.get(key)
+    if profile is None:
+        caps = server_capabilities(imap)
+        all_mail = find_all_mail(imap, caps) if "X-GM-EXT-1" in caps else None
+        profile = ServerProfile(caps, all_mail, imap.host)
+        with _profiles_lock:
+            _profiles[key] = profile
+    if profile.compress and hasattr(imap, "compress"):
+        imap.compress()
+    return profile
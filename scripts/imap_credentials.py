@@ -0,0 +1,125 @@
+"""
+Credential sources for unattended runs.
+
+The scripts used to prompt for the address and App Password every time,
+which blocks cron jobs and batch runs. The password now comes from the
+first of these that is set, and the prompt is only the last resort:
+
+    --password-file PATH / $GMAIL_REORG_PASSWORD_FILE
+        first line of a file that only its owner may read (chmod 600)
+    --password-command CMD / $GMAIL_REORG_PASSWORD_COMMAND
+        first line printed by a command, e.g. "pass show mail/gmail-app"
+    $GMAIL_REORG_PASSWORD
+        the password itself (visible in the process environment; prefer
+        a file or command)
+
+The address comes from --email ADDR or $GMAIL_REORG_EMAIL. In paths and
+commands "{email}" is replaced by the address, so one setting can serve
+several accounts (~/.config/gmail-reorg/{email}.password).
+
+--yes answers the "Type 'yes'" confirmations, for scheduled runs:
+
+    GMAIL_REORG_EMAIL=me@example.com \\
+    GMAIL_REORG_PASSWORD_FILE=~/.config/gmail-reorg/password \\
+        python3 reorg-email.py --execute --yes
+"""
+
+import getpass
+import os
+import shlex
+import stat
+import subprocess
+
+EMAIL_ENV = "GMAIL_REORG_EMAIL"
+PASSWORD_ENV = "GMAIL_REORG_PASSWORD"
+PASSWORD_FILE_ENV = "GMAIL_REORG_PASSWORD_FILE"
+PASSWORD_COMMAND_ENV = "GMAIL_REORG_PASSWORD_COMMAND"
+
+
+class CredentialError(Exception):
+    """A configured credential source could not be used."""
+
+
+def arg_value(argv, name):
+    """Value following `name` in argv, or None."""
+    if name in argv:
+        i = argv.index(name)
+        if i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+            return argv[i + 1]
+    return None
+
+
+def read_password_file(path):
+    """First line of a password file that only its owner can read."""
+    if not os.path.isfile(path):
+        raise CredentialError(
+            f"Password file not found: {path}\n\n"
+            "Create it with:\n"
+            f"  mkdir -p {os.path.dirname(path) or '.'}\n"
+            f"  echo 'your-app-password' > {path}\n"
+            f"  chmod 600 {path}")
+    st = os.stat(path)
+    if st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise CredentialError(
+            f"Password file {path} is accessible to other users "
+            f"(mode {stat.S_IMODE(st.st_mode):o}); run: chmod 600 {path}")
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise CredentialError(f"Password file {path} is not owned by you")
+    with open(path, encoding="utf-8") as fh:
+        password = fh.readline().strip()
+    if not password:
+        raise CredentialError(f"Password file {path} is empty")
+    return password
+
+
+def run_password_command(command):
+    """First line printed by a password command."""
+    try:
+        result = subprocess.run(shlex.split(command), capture_output=True,
+                                text=True, timeout=60)
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        raise CredentialError(f"Password command failed: {e}")
+    if result.returncode != 0:
+        raise CredentialError(f"Password command exited with {result.returncode}: "
+                              f"{result.stderr.strip()}")
+    password = result.stdout.splitlines()[0].strip() if result.stdout else ""
+    if not password:
+        raise CredentialError("Password command printed nothing")
+    return password
+
+
+def get_password(email, argv, prompt="App Password: "):
+    """Password for `email` from the configured source, else a prompt."""
+    path = arg_value(argv, "--password-file") or os.environ.get(PASSWORD_FILE_ENV)
+    if path:
+        return read_password_file(os.path.expanduser(path.replace("{email}", email)))
+    command = arg_value(argv, "--password-command") or os.environ.get(PASSWORD_COMMAND_ENV)
+    if command:
+        return run_password_command(command.replace("{email}", email))
+    if os.environ.get(PASSWORD_ENV):
+        return os.environ[PASSWORD_ENV]
+    return getpass.getpass(prompt)
+
+
+def get_email(argv):
+    """The account address from --email / $GMAIL_REORG_EMAIL, else a prompt."""
+    email = arg_value(argv, "--email") or os.environ.get(EMAIL_ENV)
+    if email:
+        print(f"Email: {email}")
+    else:
+        email = input("Email: ").strip()
+    return email
+
+
+def get_credentials(argv):
+    """(email, password), asking only for what no source provides."""
+    email = get_email(argv)
+    return email, get_password(email, argv)
+
+
+def confirm(argv, prompt):
+    """True if the user typed 'yes' (or --yes was given)."""
+    if "--yes" in argv:
+        print(f"{prompt.strip()} yes (--yes)")
+        return True
+    return input(prompt).strip().lower() == "yes"
@@ -0,0 +1,258 @@
+"""
+Folder hierarchy index.
+
+The scripts classify every folder on the server: is it a system folder,
+already under one of the categories, inside a subtree being renamed?
+Doing that with startswith() over a list of prefixes costs
+O(folders × prefixes), which adds up on shared mailboxes with tens of
+thousands of nested labels. FolderTree is a trie keyed on the path
+components, split on the hierarchy delimiter the server reports in its
+LIST response, so each of these questions costs O(depth):
+
+    tree.covering(name)       the shortest folder in the tree that is name
+                              or an ancestor of it (e.g. a system prefix)
+    tree.children(name)       direct sub-folders
+    tree.occupied(name)       name or anything under it exists
+    tree.subtree(name)        name and everything under it
+    tree.rename(old, new)     move a whole subtree, like IMAP RENAME
+
+Names are not stored on the nodes, so a rename moves one node however
+large the subtree is.
+
+MovePlanner uses a copy of the tree to turn "this folder goes there"
+requests into the fewest server operations (see its docstring).
+"""
+
+import re
+
+from imap_helpers import imap_utf7_decode
+
+# (\flags) "delimiter" name, where the delimiter may be NIL (flat namespace)
+LIST_RE = re.compile(r'^\((.*?)\)\s+(?:"((?:[^"\\]|\\.)*)"|NIL)\s+(.+?)\s*$', re.I)
+
+
+class _Node:
+    __slots__ = ("children", "exists")
+
+    def __init__(self):
+        self.children = {}
+        self.exists = False
+
+
+class FolderTree:
+    """Set of folder names indexed by hierarchy."""
+
+    def __init__(self, names=(), delimiter="/"):
+        self.delimiter = delimiter
+        self.root = _Node()
+        self.size = 0
+        for name in names:
+            self.add(name)
+
+    def split(self, name):
+        return name.split(self.delimiter) if self.delimiter else [name]
+
+    def join(self, parts):
+        return (self.delimiter or "").join(parts)
+
+    def _find(self, name):
+        node = self.root
+        for part in self.split(name):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def add(self, name):
+        node = self.root
+        for part in self.split(name):
+            node = node.children.setdefault(part, _Node())
+        if not node.exists:
+            node.exists = True
+            self.size += 1
+
+    def discard(self, name):
+        """Remove one folder (its sub-folders stay)."""
+        node = self._find(name)
+        if node is None or not node.exists:
+            return
+        node.exists = False
+        self.size -= 1
+        self._prune(self.split(name))
+
+    def _prune(self, parts):
+        """Drop the nodes along `parts` that no longer lead to any folder."""
+        path = [self.root]
+        for part in parts:
+            node = path[-1].children.get(part)
+            if node is None:
+                return
+            path.append(node)
+        for parent, part, node in zip(reversed(path[:-1]), reversed(parts), reversed(path[1:])):
+            if node.exists or node.children:
+                break
+            del parent.children[part]
+
+    def __contains__(self, name):
+        node = self._find(name)
+        return node is not None and node.exists
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self._walk(self.root, [])
+
+    def _walk(self, node, parts):
+        if node.exists:
+            yield self.join(parts)
+        for part in sorted(node.children):
+            yield from self._walk(node.children[part], parts + [part])
+
+    # ── Hierarchy queries ──
+
+    def covering(self, name):
+        """The shortest folder that is `name` or one of its ancestors, or None."""
+        node = self.root
+        parts = self.split(name)
+        for i, part in enumerate(parts):
+            node = node.children.get(part)
+            if node is None:
+                return None
+            if node.exists:
+                return self.join(parts[:i + 1])
+        return None
+
+    def is_under(self, name, root):
+        """True if `name` is `root` or inside it."""
+        return name == root or name.startswith(root + (self.delimiter or "\0"))
+
+    def parent(self, name):
+        """Parent path of `name`, or None at the top level."""
+        parts = self.split(name)
+        return self.join(parts[:-1]) if len(parts) > 1 else None
+
+    def occupied(self, name):
+        """True if `name` or anything under it exists."""
+        return self._find(name) is not None
+
+    def children(self, name):
+        """Direct sub-paths of `name` that are, or lead to, folders."""
+        node = self._find(name)
+        if node is None:
+            return []
+        parts = self.split(name)
+        return [self.join(parts + [part]) for part in sorted(node.children)]
+
+    def subtree(self, name):
+        """`name` (if it exists) and every folder under it, parents first."""
+        node = self._find(name)
+        return [] if node is None else list(self._walk(node, self.split(name)))
+
+    def rename(self, old, new):
+        """Move `old` and everything under it to `new`, as IMAP RENAME does."""
+        parts = self.split(old)
+        parent = self._find(self.join(parts[:-1])) if len(parts) > 1 else self.root
+        node = parent.children.get(parts[-1]) if parent else None
+        if node is None:
+            raise KeyError(old)
+        if self.is_under(new, old):
+            raise ValueError(f"cannot move {old} inside itself")
+        new_parts = self.split(new)
+        target = self.root
+        for part in new_parts[:-1]:
+            target = target.children.setdefault(part, _Node())
+        existing = target.children.get(new_parts[-1])
+        if existing is not None:
+            # `new` may only be a path leading to other folders, and then
+            # only if none of them collide with the moved ones
+            if existing.exists or existing.children.keys() & node.children.keys():
+                raise ValueError(f"{new} already exists")
+            node.children.update(existing.children)
+        del parent.children[parts[-1]]
+        target.children[new_parts[-1]] = node
+        self._prune(parts[:-1])
+
+
+class MovePlanner:
+    """Plan folder moves as whole-subtree RENAMEs wherever possible.
+
+    IMAP RENAME takes a folder's sub-folders along, so moving a subtree
+    whose destination is free is one command however many folders it
+    holds. Only where the destination already exists do the two trees
+    have to be merged: each sub-folder is moved into its counterpart
+    (again as a single RENAME where that is free), then the now childless
+    source is merged into the destination. Every step is applied to a
+    private copy of the tree, so later requests see the result of earlier
+    ones (a second source for the same destination merges rather than
+    colliding).
+
+    `ops` lists (op, src, dst) with op "rename", "merge" or "delete", in
+    an order that is safe to run: sub-folders are moved before their
+    parent is merged or deleted. Run them through imap_pool.run_parallel,
+    which serializes the ones touching the same subtree.
+    """
+
+    def __init__(self, tree):
+        self.tree = FolderTree(tree, tree.delimiter)
+        self.ops = []
+
+    def _within(self, parent, child):
+        return self.tree.join([parent, self.tree.split(child)[-1]])
+
+    def move(self, src, dst):
+        """Move folder `src` and its subtree to `dst`."""
+        tree = self.tree
+        if not tree.occupied(src) or src == dst:
+            return
+        if not tree.occupied(dst):
+            self.ops.append(("rename", src, dst))
+            tree.rename(src, dst)
+            return
+        for child in tree.children(src):
+            self.move(child, self._within(dst, child))
+        if src not in tree:
+            return
+        if dst in tree:
+            self.ops.append(("merge", src, dst))
+            tree.discard(src)
+        else:
+            # dst is only a path to other folders; src is a leaf by now
+            self.ops.append(("rename", src, dst))
+            tree.rename(src, dst)
+
+    def dissolve(self, container, dst):
+        """Move everything inside `container` under `dst`, then delete it.
+
+        For containers nested in each other, dissolve the inner one first.
+        """
+        for child in self.tree.children(container):
+            self.move(child, self._within(dst, child))
+        self.delete(container)
+
+    def delete(self, folder):
+        """Delete `folder` if it exists and has no sub-folders left."""
+        if folder in self.tree and not self.tree.children(folder):
+            self.ops.append(("delete", folder, None))
+            self.tree.discard(folder)
+
+
+def parse_list(response):
+    """FolderTree of the folders in a LIST response, using its delimiter."""
+    names = []
+    delimiters = []
+    for item in response or []:
+        if isinstance(item, bytes):
+            item = item.decode("utf-8", errors="replace")
+        match = LIST_RE.match(item) if isinstance(item, str) else None
+        if not match:
+            continue
+        delimiter = match.group(2)
+        delimiters.append(delimiter.replace('\\"', '"').replace("\\\\", "\\")
+                          if delimiter is not None else None)
+        name = match.group(3)
+        if len(name) >= 2 and name[0] == name[-1] == '"':
+            name = name[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+        names.append(imap_utf7_decode(name))
+    # NIL means a flat namespace; with no folders at all assume Gmail's "/"
+    return FolderTree(names, delimiters[0] if delimiters else "/")
@@ -0,0 +1,539 @@
+"""
+Shared IMAP helpers for the Gmail reorganization scripts.
+
+Imported by organize-email.py, cleanup-email.py and delete-old-labels.py,
+which all live next to this file and run with it on sys.path.
+"""
+
+import imaplib
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+from imap_async import run_pipelined
+from imap_caps import GMAIL_ALL_MAIL, cached_profile, probe_server
+from imap_session import PlainSession, Session, limiter_for
+
+IMAP_HOST = "imap.gmail.com"
+IMAP_PORT = 993
+IMAP_TIMEOUT = 120
+# Overrides the server, e.g. imap://127.0.0.1:1143 for a local fake_imap
+# server (plain IMAP) or imaps://host:993
+SERVER_ENV = "GMAIL_REORG_SERVER"
+
+
+def imap_utf7_encode(text):
+    """Encode & as &- for IMAP modified UTF-7."""
+    return text.replace('&', '&-')
+
+
+def imap_utf7_decode(text):
+    """Decode IMAP modified UTF-7 &- back to &."""
+    return text.replace('&-', '&')
+
+
+def imap_encode(folder_name):
+    """Quote and encode folder name for IMAP."""
+    return '"' + imap_utf7_encode(folder_name) + '"'
+
+
+def server_address():
+    """(host, port, use_ssl) from $GMAIL_REORG_SERVER, else Gmail."""
+    url = os.environ.get(SERVER_ENV)
+    if not url:
+        return IMAP_HOST, IMAP_PORT, True
+    parts = urlsplit(url if "://" in url else "imaps://" + url)
+    use_ssl = parts.scheme != "imap"
+    return parts.hostname, parts.port or (IMAP_PORT if use_ssl else 143), use_ssl
+
+
+def connect(email, password, host=None, port=None):
+    """Open and log in one rate-limited, self-reconnecting connection.
+
+    Every connection to the same account shares one adaptive RateLimiter
+    (see imap_session), so callers never need to sleep between commands.
+    A socket timeout turns a stalled connection into a reconnect instead
+    of a hang. Once the account has been probed (imap_caps.probe_server),
+    later connections turn on compression straight away.
+    """
+    default_host, default_port, use_ssl = server_address()
+    host = host or default_host
+    port = port or default_port
+    session = Session if use_ssl else PlainSession
+    imap = session(host, port, timeout=IMAP_TIMEOUT)
+    imap.limiter = limiter_for(host, email)
+    imap.login(email, password)
+    profile = cached_profile(host, email)
+    if profile is not None and profile.compress:
+        imap.compress()
+    return imap
+
+
+# ──────────────────────────────────────────────
+# Moving messages
+# ──────────────────────────────────────────────
+
+def move_selected(imap, dest, caps, uid_set="1:*"):
+    """Move messages in the selected folder to dest.
+
+    Uses a single atomic UID MOVE (RFC 6851) when the server supports it,
+    so nothing is left half-copied if the connection drops. Otherwise
+    falls back to UID COPY + STORE \\Deleted, then expunges only the
+    copied UIDs with UIDPLUS. Without UIDPLUS a plain EXPUNGE would also
+    remove any other \\Deleted mail in the folder, so the copies are left
+    flagged for the caller to expunge once that is safe.
+
+    Returns (ok, data) where data is the failing server response.
+    """
+    if "MOVE" in caps:
+        status, data = imap.uid("MOVE", uid_set, imap_encode(dest))
+        return status == "OK", data
+
+    status, data = imap.uid("COPY", uid_set, imap_encode(dest))
+    if status != "OK":
+        return False, data
+    status, data = imap.uid("STORE", uid_set, "+FLAGS", "(\\Deleted)")
+    if status != "OK":
+        return False, data
+    if "UIDPLUS" in caps:
+        status, data = imap.uid("EXPUNGE", uid_set)
+    return status == "OK", data
+
+
+def uid_ranges(uids):
+    """Compress UIDs into IMAP sequence-set chunks like "1:5,9,12:20"."""
+    ranges = []
+    start = prev = None
+    for uid in sorted(set(uids)):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(f"{start}:{prev}" if prev != start else str(start))
+        start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if prev != start else str(start))
+    # Keep each command line well under server limits (~8 KB on Gmail)
+    chunks, chunk, size = [], [], 0
+    for r in ranges:
+        if chunk and size + len(r) > 4000:
+            chunks.append(",".join(chunk))
+            chunk, size = [], 0
+        chunk.append(r)
+        size += len(r) + 1
+    if chunk:
+        chunks.append(",".join(chunk))
+    return chunks
+
+
+def selected_uidvalidity(imap):
+    """UIDVALIDITY of the mailbox just selected, or None."""
+    _, data = imap.response("UIDVALIDITY")
+    try:
+        return int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class ChunkSizer:
+    """Adaptive UID-chunk size for large merges.
+
+    Starts small, then scales each chunk so one command takes about
+    `target` seconds: fast responses grow the chunk (at most 2x per step),
+    slow ones or timeouts shrink it.
+    """
+
+    def __init__(self, size=250, minimum=25, maximum=5000, target=2.0):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+
+    def observe(self, count, elapsed):
+        """Adjust the next chunk size from one chunk's latency."""
+        if count < self.size:
+            return
+        scale = self.target / max(elapsed, 0.01)
+        scale = max(0.25, min(scale, 2.0))
+        self.size = int(max(self.minimum, min(self.size * scale, self.maximum)))
+
+    def failed(self):
+        """Halve the chunk size after an error."""
+        self.size = max(self.minimum, self.size // 2)
+
+
+def run_chunks(uids, apply, progress, key, uidvalidity, label, sizer=None):
+    """Apply a UID command to uids in adaptive chunks, recording progress.
+
+    `apply(uid_set)` returns (ok, data). After each committed chunk
+    progress[key] records the UIDVALIDITY and the last UID done, so a
+    retry of the same merge skips everything already handled. Prints
+    per-chunk progress and throughput. A failed chunk halves `sizer`, so
+    a retry that passes the same one resumes with smaller chunks.
+
+    Returns (ok, data).
+    """
+    if sizer is None:
+        sizer = ChunkSizer()
+    total = len(uids)
+    done = 0
+    data = None
+    started = time.monotonic()
+    while done < total:
+        chunk = uids[done:done + sizer.size]
+        t0 = time.monotonic()
+        for uid_set in uid_ranges(chunk):
+            ok, data = apply(uid_set)
+            if not ok:
+                sizer.failed()
+                return False, data
+        elapsed = time.monotonic() - t0
+        sizer.observe(len(chunk), elapsed)
+        done += len(chunk)
+        progress[key] = {"uidvalidity": uidvalidity, "last_uid": chunk[-1]}
+        if total > len(chunk):
+            rate = done / max(time.monotonic() - started, 0.001)
+            print(f"      {label}: {done}/{total} "
+                  f"({len(chunk)} in {elapsed:.1f}s, {rate:.0f} msg/s)")
+    progress.pop(key, None)
+    return True, data
+
+
+def _resume_uids(imap, criteria, progress, key, uidvalidity):
+    """UID SEARCH, skipping UIDs already committed by an earlier attempt."""
+    status, data = imap.uid("SEARCH", *criteria)
+    if status != "OK":
+        return None, data
+    uids = sorted(int(u) for u in (data[0] or b"").split())
+    state = progress.get(key)
+    if state and state["uidvalidity"] == uidvalidity:
+        uids = [u for u in uids if u > state["last_uid"]]
+    return uids, data
+
+
+def unselect(imap, caps, mailbox):
+    """Leave the selected mailbox without expunging anything.
+
+    CLOSE expunges every message flagged \\Deleted, including ones the
+    user flagged and not us. UNSELECT (RFC 3691) does not; without it the
+    mailbox is re-opened with EXAMINE first, and CLOSE on a read-only
+    mailbox expunges nothing.
+    """
+    if "UNSELECT" in caps:
+        return imap.unselect()
+    imap.select(imap_encode(mailbox), readonly=True)
+    return imap.close()
+
+
+def relabel_all(imap, source, dest, progress, all_mail=GMAIL_ALL_MAIL,
+                caps=(), sizer=None):
+    """Gmail fast path: swap label source → dest on every message in place.
+
+    Selects All Mail, finds the messages carrying the source label with
+    UID SEARCH X-GM-LABELS, then adds dest and removes source with chunked
+    UID STORE ±X-GM-LABELS. No message data is copied. Leaves nothing
+    selected, without expunging All Mail (see unselect).
+
+    Returns (ok, data) like move_selected.
+    """
+    status, data = imap.select(imap_encode(all_mail))
+    if status != "OK":
+        return False, data
+    try:
+        uidvalidity = selected_uidvalidity(imap)
+        key = ("relabel", source)
+        uids, data = _resume_uids(imap, ["X-GM-LABELS", imap_encode(source)],
+                                  progress, key, uidvalidity)
+        if uids is None:
+            return False, data
+
+        def apply(uid_set):
+            status, data = imap.uid("STORE", uid_set, "+X-GM-LABELS",
+                                    f"({imap_encode(dest)})")
+            if status != "OK":
+                return False, data
+            status, data = imap.uid("STORE", uid_set, "-X-GM-LABELS",
+                                    f"({imap_encode(source)})")
+            return status == "OK", data
+
+        return run_chunks(uids, apply, progress, key, uidvalidity, "relabel", sizer)
+    finally:
+        unselect(imap, caps, all_mail)
+
+
+def move_all(imap, source, dest, caps, progress=None, retries=1):
+    """Move every message from source to dest with the best strategy.
+
+    Gmail (X-GM-EXT-1) relabels in place via All Mail (caps.all_mail when
+    caps is an imap_caps.ServerProfile); everything else
+    selects source and moves it in UID chunks with move_selected. A failed
+    attempt is retried `retries` times, resuming after the last committed
+    chunk; pass the same `progress` dict to a later call to resume there
+    too. Expects nothing selected and leaves nothing selected.
+    """
+    if progress is None:
+        progress = {}
+    sizer = ChunkSizer()
+    for attempt in range(retries + 1):
+        if attempt:
+            print(f"      Resuming '{source}' from last committed UID "
+                  f"({sizer.size} per chunk)...")
+        try:
+            ok, data = _move_all_once(imap, source, dest, caps, progress, sizer)
+        except imaplib.IMAP4.error as e:
+            ok, data = False, [str(e)]
+        if ok:
+            return ok, data
+    return ok, data
+
+
+def _move_all_once(imap, source, dest, caps, progress, sizer):
+    all_mail = getattr(caps, "all_mail", GMAIL_ALL_MAIL)
+    if "X-GM-EXT-1" in caps and all_mail:
+        ok, data = relabel_all(imap, source, dest, progress, all_mail, caps, sizer)
+        if ok:
+            return ok, data
+        # Fall through to plain IMAP if All Mail is unavailable or refused
+    status, data = imap.select(imap_encode(source))
+    if status != "OK":
+        return False, data
+    ok = False
+    try:
+        uidvalidity = selected_uidvalidity(imap)
+        key = ("move", source)
+        uids, data = _resume_uids(imap, ["ALL"], progress, key, uidvalidity)
+        if uids is None:
+            return False, data
+        ok, data = run_chunks(uids, lambda uid_set: move_selected(imap, dest, caps, uid_set),
+                              progress, key, uidvalidity, "move", sizer)
+        return ok, data
+    finally:
+        if ok:
+            # Every message is in dest now, so CLOSE may expunge what
+            # move_selected left flagged (servers without UIDPLUS)
+            imap.close()
+        else:
+            unselect(imap, caps, source)
+
+
+def delete_refusal(caps, counts, folder):
+    """Why deleting `folder` would lose mail on this server, or None.
+
+    On Gmail DELETE only removes a label; elsewhere it destroys the
+    folder's messages, so only empty folders may go.
+    """
+    if getattr(caps, "deleting", "label") == "label":
+        return None
+    count = counts.get(folder)
+    if count:
+        return f"{count} msgs would be destroyed (DELETE is not label-only here)"
+    return None
+
+
+# ──────────────────────────────────────────────
+# Message counting
+# ──────────────────────────────────────────────
+
+STATUS_RE = re.compile(r'^\s*(?:"((?:[^"\\]|\\.)*)"|(\S+))\s+\((.*)\)\s*$')
+
+
+def _join_response(data):
+    """Flatten imaplib response data (bytes and literal tuples) into lines."""
+    lines = []
+    pending = ""
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            # Literal: (b'{12}', b'Folder name') — the mailbox
+            # name arrives separately from the attribute list.
+            head = item[0].decode("utf-8", errors="replace")
+            head = re.sub(r'\{\d+\}$', "", head)
+            literal = item[1].decode("utf-8", errors="replace")
+            pending += head + '"' + literal.replace('"', '\\"') + '"'
+            continue
+        text = item.decode("utf-8", errors="replace") if isinstance(item, bytes) else item
+        lines.append(pending + text)
+        pending = ""
+    if pending:
+        lines.append(pending)
+    return lines
+
+
+def parse_status_response(data):
+    """Parse STATUS responses into {folder: {ATTR: int}}."""
+    result = {}
+    for line in _join_response(data):
+        match = STATUS_RE.match(line)
+        if not match:
+            continue
+        name = match.group(1)
+        if name is not None:
+            name = name.replace('\\"', '"').replace('\\\\', '\\')
+        else:
+            name = match.group(2)
+        tokens = match.group(3).split()
+        attrs = {}
+        for key, value in zip(tokens[::2], tokens[1::2]):
+            try:
+                attrs[key.upper()] = int(value)
+            except ValueError:
+                pass
+        result[imap_utf7_decode(name)] = attrs
+    return result
+
+
+def status_for(statuses, folder):
+    """folder's attributes in parse_status_response output, or None.
+
+    Matched by the mailbox the reply names (INBOX in any case), never by
+    position, so an unsolicited or reordered STATUS is not misfiled.
+    """
+    if folder in statuses:
+        return statuses[folder]
+    if folder.upper() == "INBOX":
+        return next((a for name, a in statuses.items() if name.upper() == "INBOX"), None)
+    return None
+
+
+class MessageCounts:
+    """Per-run cache of folder STATUS (message count and UIDVALIDITY).
+
+    Counts come from STATUS (MESSAGES UIDVALIDITY) rather than
+    SELECT/CLOSE, and when the server advertises LIST-STATUS (RFC 5819)
+    every folder is covered by a single LIST ... RETURN (STATUS ...) on
+    first use. Each folder is queried at most once; the apply phases keep
+    the cache in step with the changes they make.
+
+    With a MetadataCache (imap_cache), counts still valid from an earlier
+    run are reused and only the rest are queried; fresh results are saved
+    back to it.
+
+    Queries go over `imap` and are not locked: make them from the thread
+    that owns it, and look up everything pool workers will need (see
+    prefetch_many) before handing them the work.
+    """
+
+    ITEMS = "(MESSAGES UIDNEXT UIDVALIDITY)"
+
+    def __init__(self, imap, caps=None, cache=None):
+        self.imap = imap
+        self.status = {}
+        if caps is None:
+            caps = probe_server(imap)
+        self.caps = caps
+        self.list_status = "LIST-STATUS" in caps
+        self.prefetched = False
+        self.cache = cache
+        if "CONDSTORE" in caps:
+            self.ITEMS = self.ITEMS[:-1] + " HIGHESTMODSEQ)"
+
+    def cached(self, folders):
+        """Fill from the persistent cache, if it is still valid."""
+        if self.cache is None or not self.cache.validate(self.imap, self.caps):
+            return
+        for folder, attrs in self.cache.load(folders).items():
+            self.status.setdefault(folder, attrs)
+
+    def save(self, statuses):
+        if self.cache is not None:
+            self.cache.store(statuses)
+
+    def prefetch(self):
+        """Fill the cache for every folder with one LIST-STATUS round trip."""
+        if self.prefetched or not self.list_status:
+            return
+        self.prefetched = True
+        try:
+            status, _ = self.imap.list('""', f'"*" RETURN (STATUS {self.ITEMS})')
+            if status != "OK":
+                return
+            _, data = self.imap.response("STATUS")
+            statuses = parse_status_response(data or [])
+            for folder, attrs in statuses.items():
+                self.status.setdefault(folder, attrs)
+            self.save(statuses)
+        except Exception:
+            self.list_status = False
+
+    def prefetch_many(self, folders):
+        """Fill the cache for many folders in one pipelined batch.
+
+        Without LIST-STATUS, the STATUS commands for every uncached folder
+        are pipelined on a side connection (see imap_async), costing about
+        one round trip per batch instead of one per folder. Falls back to
+        per-folder STATUS on any error.
+        """
+        folders = list(dict.fromkeys(folders))
+        self.cached(folders)
+        self.prefetch()
+        todo = [f for f in folders if f not in self.status]
+        if len(todo) < 2 or getattr(self.imap, "credentials", None) is None:
+            return
+        try:
+            results = run_pipelined(
+                self.imap, [("STATUS", imap_encode(f), self.ITEMS) for f in todo])
+        except Exception as e:
+            print(f"  [~] Pipelined STATUS unavailable ({e}); counting one by one")
+            return
+        statuses = {}
+        for _, _, untagged in results:
+            statuses.update(parse_status_response(untagged.get("STATUS", [])))
+        for folder, (typ, _, _) in zip(todo, results):
+            if typ != "OK":
+                self.status[folder] = {}
+                continue
+            attrs = status_for(statuses, folder)
+            if attrs is not None:
+                self.status[folder] = attrs
+            # else no reply named it: lookup() asks again rather than guess
+        stray = [name for name in statuses
+                 if all(status_for({name: {}}, folder) is None for folder in todo)]
+        if stray:
+            print(f"  [~] Ignoring STATUS for folders not asked about: {', '.join(sorted(stray))}")
+        self.save({f: self.status[f] for f in todo if f in self.status})
+
+    def lookup(self, folder):
+        """STATUS attributes for a folder ({} if it cannot be queried)."""
+        if folder in self.status:
+            return self.status[folder]
+        self.cached([folder])
+        self.prefetch()
+        if folder in self.status:
+            return self.status[folder]
+        attrs = {}
+        try:
+            status, data = self.imap.status(imap_encode(folder), self.ITEMS)
+            if status == "OK":
+                attrs = status_for(parse_status_response(data), folder) or {}
+        except Exception:
+            pass
+        self.status[folder] = attrs
+        self.save({folder: attrs})
+        return attrs
+
+    def get(self, folder):
+        """Get number of messages in a folder."""
+        return self.lookup(folder).get("MESSAGES", 0)
+
+    def uidvalidity(self, folder):
+        """UIDVALIDITY of a folder, or None if unknown."""
+        return self.lookup(folder).get("UIDVALIDITY")
+
+    def moved(self, source, dest):
+        """Record that every message in source now lives in dest."""
+        attrs = self.status.pop(source, {})
+        if "MESSAGES" in self.status.get(dest, {}):
+            self.status[dest]["MESSAGES"] += attrs.get("MESSAGES", 0)
+
+    def renamed(self, source, dest):
+        """Record a folder rename, including any cached children."""
+        prefix = source + "/"
+        for folder in list(self.status):
+            if folder == source or folder.startswith(prefix):
+                self.status[dest + folder[len(source):]] = self.status.pop(folder)
+
+    def deleted(self, folder):
+        """Forget a deleted folder."""
+        self.status.pop(folder, None)
@@ -0,0 +1,381 @@
+"""
+Local envelope index of a Gmail account (SQLite).
+
+Questions about the mailbox ("how many Stripe receipts are also labelled
+Invoices?", "what would this CATEGORY_MAP change move?") used to need
+live IMAP round trips. index-email.py syncs every message of All Mail
+into a local database instead: UID, X-GM-MSGID, FLAGS, RFC822.SIZE,
+the ENVELOPE fields and the message's X-GM-LABELS, plus the folder list
+and the server profile. The planners then run against it with
+--offline, without a connection.
+
+    messages (uid, msgid, size, flags, date, subject, sender, recipients, message_id)
+    labels   (label, uid)         one row per label on a message
+    counts   (label, messages)    per-label totals, rebuilt after each sync
+    folders  (name)               the LIST result
+
+Syncing costs one STATUS on All Mail, a LIST, and then only what
+changed. UIDs from the last sync's UIDNEXT up are fetched whole, in
+BATCH-UID commands spread over the connection pool. Label and flag
+changes on older messages come from one UID FETCH ... (CHANGEDSINCE
+<last HIGHESTMODSEQ>), which works because Gmail's HIGHESTMODSEQ is
+account-wide and every relabel bumps it. Deleted messages are found
+with a UID SEARCH only when All Mail's message count disagrees with the
+index. A new UIDVALIDITY, or --full, rebuilds from scratch.
+
+Needs X-GM-EXT-1 (labels live on All Mail); without CONDSTORE, the
+flags and labels of every known message are re-read instead.
+
+Indexes live next to the journals: ~/.local/state/gmail-reorg/index-<account>.sqlite
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from imap_caps import ServerProfile
+from imap_folders import FolderTree, parse_list
+from imap_helpers import (MessageCounts, imap_encode, imap_utf7_decode, parse_status_response,
+                          status_for)
+from imap_journal import journal_path
+from imap_pool import ContextExecutor
+from imap_rules import decode_words
+
+BATCH = 5000    # UIDs per UID FETCH
+FETCH_ITEMS = "(UID FLAGS RFC822.SIZE ENVELOPE X-GM-LABELS X-GM-MSGID)"
+CHANGE_ITEMS = "(UID FLAGS X-GM-LABELS)"
+STATUS_ITEMS = "(MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    uid INTEGER PRIMARY KEY, msgid INTEGER, size INTEGER, flags TEXT,
+    date TEXT, subject TEXT, sender TEXT, recipients TEXT, message_id TEXT
+);
+CREATE TABLE IF NOT EXISTS labels (
+    label TEXT, uid INTEGER, PRIMARY KEY (label, uid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS labels_uid ON labels (uid);
+CREATE TABLE IF NOT EXISTS counts (label TEXT PRIMARY KEY, messages INTEGER);
+CREATE TABLE IF NOT EXISTS folders (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+LITERAL_TAIL_RE = re.compile(rb"\{\d+\+?\}$")
+# Gmail reports INBOX among X-GM-LABELS as \Inbox
+SYSTEM_LABELS = {"\\Inbox": "INBOX"}
+
+
+def index_path(account):
+    """Index file for one account."""
+    return journal_path("index", account)[:-len(".jsonl")] + ".sqlite"
+
+
+# ──────────────────────────────────────────────
+# FETCH response parsing
+# ──────────────────────────────────────────────
+
+class _Literal(bytes):
+    pass
+
+
+def _parse(segments):
+    """Nested lists of str / None (NIL) from response text and literals."""
+    stack = [[]]
+    for segment in segments:
+        if isinstance(segment, _Literal):
+            stack[-1].append(segment.decode("utf-8", errors="replace"))
+            continue
+        pos = 0
+        while pos < len(segment):
+            match = TOKEN_RE.match(segment, pos)
+            if not match or match.end() == pos:
+                break
+            pos = match.end()
+            open_, close, quoted, atom = match.groups()
+            if open_:
+                stack.append([])
+            elif close:
+                if len(stack) > 1:
+                    inner = stack.pop()
+                    stack[-1].append(inner)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted).decode("utf-8", errors="replace"))
+            elif atom is not None:
+                text = atom.decode("utf-8", errors="replace")
+                stack[-1].append(None if text.upper() == "NIL" else text)
+    while len(stack) > 1:
+        inner = stack.pop()
+        stack[-1].append(inner)
+    return stack[0]
+
+
+def parse_fetch(data):
+    """Yield {ITEM: value} for each FETCH response in imaplib's response data."""
+    segments = []
+    for item in data or []:
+        if isinstance(item, tuple):
+            segments += [LITERAL_TAIL_RE.sub(b"", item[0]), _Literal(item[1])]
+            continue
+        if not isinstance(item, bytes):
+            continue
+        segments.append(item)
+        values = _parse(segments)
+        segments = []
+        # imaplib leaves "<seq> (<items>)" of each "* <seq> FETCH (<items>)"
+        pairs = next((v for v in values if isinstance(v, list)), None)
+        if pairs is not None:
+            yield {str(k).upper(): v for k, v in zip(pairs[::2], pairs[1::2])}
+
+
+def _addresses(value):
+    """'Name <mailbox@host>, ...' from an ENVELOPE address list."""
+    out = []
+    for address in value or []:
+        if not isinstance(address, list) or len(address) < 4 or address[2] is None:
+            continue
+        email = f"{address[2]}@{address[3]}" if address[3] else address[2]
+        out.append(f"{decode_words(address[0])} <{email}>" if address[0] else email)
+    return ", ".join(out)
+
+
+def _labels(value):
+    return [SYSTEM_LABELS.get(label) or imap_utf7_decode(label) for label in value or [] if label]
+
+
+def message_row(item):
+    """(messages row, labels) from one parsed FETCH response."""
+    env = item.get("ENVELOPE") or [None] * 10
+    env = list(env) + [None] * (10 - len(env))
+    recipients = ", ".join(filter(None, (_addresses(env[5]), _addresses(env[6]))))
+    row = (int(item["UID"]), int(item.get("X-GM-MSGID") or 0),
+           int(item.get("RFC822.SIZE") or 0), " ".join(item.get("FLAGS") or []),
+           env[0], decode_words(env[1] or ""), _addresses(env[2]), recipients, env[9])
+    return row, _labels(item.get("X-GM-LABELS"))
+
+
+# ──────────────────────────────────────────────
+# The index
+# ──────────────────────────────────────────────
+
+class EnvelopeIndex:
+    """Messages, labels and folders of one account, synced from All Mail."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _store(self, items, full):
+        """Write parsed FETCH responses; `full` ones carry the envelope."""
+        rows, labels = [], []
+        for item in items:
+            if "UID" not in item:
+                continue
+            row, names = message_row(item)
+            rows.append(row)
+            labels += [(name, row[0]) for name in names]
+        uids = [(row[0],) for row in rows]
+        with self.lock:
+            self.db.execute("BEGIN")
+            if full:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            else:
+                self.db.executemany("UPDATE messages SET flags = ? WHERE uid = ?",
+                                    [(row[3], row[0]) for row in rows])
+            self.db.executemany("DELETE FROM labels WHERE uid = ?", uids)
+            self.db.executemany("INSERT OR IGNORE INTO labels VALUES (?, ?)", labels)
+            self.db.execute("COMMIT")
+        return len(rows)
+
+    # ── Sync ──
+
+    def sync(self, imap, caps, pool, full=False):
+        """Bring the index up to date.
+
+        Returns {"new", "changed", "removed", "messages", "rebuilt"}.
+        """
+        all_mail = caps.all_mail
+        status, data = imap.status(imap_encode(all_mail), STATUS_ITEMS)
+        if status != "OK":
+            raise RuntimeError(f"STATUS {all_mail} failed: {data}")
+        attrs = status_for(parse_status_response(data), all_mail) or {}
+        status, data = imap.list()
+        if status != "OK":
+            raise RuntimeError(f"LIST failed: {data}")
+        tree = parse_list(data)
+
+        stored = self._meta("mailbox") or {}
+        uidnext = attrs.get("UIDNEXT", 1)
+        rebuild = full or stored.get("UIDVALIDITY") != attrs.get("UIDVALIDITY")
+        start = 1 if rebuild else stored.get("UIDNEXT", 1)
+        if rebuild:
+            with self.lock:
+                self.db.execute("BEGIN")
+                for table in ("messages", "labels", "counts"):
+                    self.db.execute(f"DELETE FROM {table}")
+                # Until the rebuild completes, the next sync must start over
+                # and --offline must not plan from a partial index
+                self.db.execute("DELETE FROM meta WHERE key IN ('mailbox', 'synced')")
+                self.db.execute("COMMIT")
+
+        def fetch(uid_set, items, modifier=None):
+            """UID FETCH on a pooled connection, examining All Mail first."""
+            conn = pool.acquire()
+            try:
+                typ, data = conn.select(imap_encode(all_mail), readonly=True)
+                if typ != "OK":
+                    raise RuntimeError(f"cannot examine {all_mail}: {data}")
+                args = (uid_set, items) + ((modifier,) if modifier else ())
+                typ, data = conn.uid("FETCH", *args)
+                if typ != "OK":
+                    raise RuntimeError(f"UID FETCH {uid_set} failed: {data}")
+                return list(parse_fetch(data))
+            finally:
+                pool.release(conn)
+
+        def run(uid_sets, items, full_rows, modifier=None):
+            total = 0
+            with ContextExecutor(max_workers=pool.size) as executor:
+                for done, batch in enumerate(executor.map(
+                        lambda s: fetch(s, items, modifier), uid_sets), 1):
+                    total += self._store(batch, full_rows)
+                    if len(uid_sets) > 1 and (done % 10 == 0 or done == len(uid_sets)):
+                        print(f"  {done}/{len(uid_sets)} batches, {total} messages")
+            return total
+
+        # New messages: everything from the last UIDNEXT up
+        new_sets = [f"{lo}:{min(lo + BATCH - 1, uidnext - 1)}"
+                    for lo in range(start, uidnext, BATCH)]
+        new = run(new_sets, FETCH_ITEMS, True) if new_sets else 0
+
+        # Label and flag changes on messages indexed before
+        changed = 0
+        if start > 1:
+            since = stored.get("HIGHESTMODSEQ")
+            if "CONDSTORE" in caps and since and attrs.get("HIGHESTMODSEQ"):
+                if attrs["HIGHESTMODSEQ"] != since:
+                    changed = run([f"1:{start - 1}"], CHANGE_ITEMS, False,
+                                  f"(CHANGEDSINCE {since})")
+            else:
+                changed = run([f"{lo}:{min(lo + BATCH - 1, start - 1)}"
+                               for lo in range(1, start, BATCH)], CHANGE_ITEMS, False)
+
+        # Expunged messages, looked for only when the count disagrees
+        removed = 0
+        with self.lock:
+            indexed = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if indexed != attrs.get("MESSAGES", indexed):
+            conn = pool.acquire()
+            try:
+                conn.select(imap_encode(all_mail), readonly=True)
+                typ, data = conn.uid("SEARCH", "ALL")
+            finally:
+                pool.release(conn)
+            if typ == "OK":
+                live = [(int(u),) for u in (data[0] or b"").split()]
+                with self.lock:
+                    self.db.execute("BEGIN")
+                    self.db.execute("CREATE TEMP TABLE IF NOT EXISTS live (uid INTEGER PRIMARY KEY)")
+                    self.db.execute("DELETE FROM live")
+                    self.db.executemany("INSERT OR IGNORE INTO live VALUES (?)", live)
+                    removed = self.db.execute(
+                        "DELETE FROM messages WHERE uid NOT IN (SELECT uid FROM live)").rowcount
+                    self.db.execute("DELETE FROM labels WHERE uid NOT IN (SELECT uid FROM live)")
+                    self.db.execute("COMMIT")
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM counts")
+            self.db.execute("INSERT INTO counts SELECT label, COUNT(*) FROM labels GROUP BY label")
+            self.db.execute("DELETE FROM folders")
+            self.db.executemany("INSERT OR IGNORE INTO folders VALUES (?)",
+                                [(name,) for name in tree])
+            self._set_meta("mailbox", attrs)
+            self._set_meta("delimiter", tree.delimiter)
+            self._set_meta("profile", {"caps": sorted(caps), "all_mail": all_mail,
+                                       "host": caps.host})
+            self._set_meta("synced", time.time())
+            self.db.execute("COMMIT")
+            messages = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return {"new": new, "changed": changed, "removed": removed, "messages": messages,
+                "rebuilt": rebuild}
+
+    # ── Offline queries ──
+
+    def synced(self):
+        """Time of the last completed sync, or None."""
+        return self._meta("synced")
+
+    def profile(self):
+        """The ServerProfile recorded at the last sync."""
+        value = self._meta("profile") or {"caps": [], "all_mail": None, "host": ""}
+        return ServerProfile(value["caps"], value["all_mail"], value["host"])
+
+    def folder_tree(self):
+        """FolderTree of the folders LISTed at the last sync."""
+        names = [row[0] for row in self.db.execute("SELECT name FROM folders")]
+        return FolderTree(names, self._meta("delimiter") if names else "/")
+
+    def label_counts(self):
+        """{label: messages} as of the last sync."""
+        return dict(self.db.execute("SELECT label, messages FROM counts"))
+
+    def query(self, sql, params=()):
+        """(column names, rows) of a read-only SQL query."""
+        with self.lock:
+            self.db.execute("PRAGMA query_only = ON")
+            try:
+                cursor = self.db.execute(sql, params)
+                rows = cursor.fetchall()
+            finally:
+                self.db.execute("PRAGMA query_only = OFF")
+        return [d[0] for d in cursor.description or []], rows
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_index(account, create=False):
+    """The account's EnvelopeIndex, or None if it was never synced (unless create)."""
+    path = index_path(account)
+    if not create and not os.path.exists(path):
+        return None
+    return EnvelopeIndex(path)
+
+
+class IndexCounts(MessageCounts):
+    """MessageCounts answered from an EnvelopeIndex, for --offline planning.
+
+    Counts are the label totals of the last sync; there is no server to
+    ask, so folders the index does not know hold 0 messages and have no
+    UIDVALIDITY.
+    """
+
+    def __init__(self, index, caps):
+        self.imap = None
+        self.caps = caps
+        self.cache = None
+        self.list_status = False
+        self.prefetched = True
+        self.status = {label: {"MESSAGES": n} for label, n in index.label_counts().items()}
+
+    def prefetch_many(self, folders):
+        pass
+
+    def lookup(self, folder):
+        return self.status.setdefault(folder, {"MESSAGES": 0})
@@ -0,0 +1,209 @@
+"""
+Append-only operation journal for --execute runs.
+
+Every planned and completed operation is written as one JSON line and
+fsync'd before the script moves on, so an interrupted run (network blip,
+laptop sleep, Ctrl-C) can be rerun and skip everything already done.
+Operations are keyed by kind, source, destination and the source folder's
+UIDVALIDITY, so a folder that was deleted and recreated under the same
+name is never mistaken for finished work. Partial merges also journal
+their last committed UID (see imap_helpers.move_all).
+
+Journals live in ~/.local/state/gmail-reorg/ and are removed once a run
+finishes with no failures.
+
+Dry runs also save their computed plan (operations, expected message
+counts, UIDVALIDITY) next to the journal, so `--apply` can execute that
+exact plan after a cheap STATUS check instead of rediscovering the
+account.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+
+def state_dir():
+    """Where journals, plans and caches live ($XDG_STATE_HOME is read per call)."""
+    return os.path.join(
+        os.environ.get("XDG_STATE_HOME", os.path.expanduser("~/.local/state")),
+        "gmail-reorg")
+
+
+def journal_path(script, account):
+    """Journal file for one script run against one account."""
+    safe = re.sub(r"[^A-Za-z0-9@._-]", "_", account)
+    return os.path.join(state_dir(), f"{script}-{safe}.jsonl")
+
+
+def plan_path(script, account):
+    """Default plan file written by a dry run."""
+    return journal_path(script, account)[:-len(".jsonl")] + ".plan.json"
+
+
+def apply_arg(argv, script, account):
+    """Plan path for `--apply [PATH]`, or None when not applying a plan."""
+    if "--apply" not in argv:
+        return None
+    i = argv.index("--apply")
+    if i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+        return argv[i + 1]
+    return plan_path(script, account)
+
+
+# ──────────────────────────────────────────────
+# Plans
+# ──────────────────────────────────────────────
+
+def plan_op(counts, op, source, dest=None):
+    """One plan entry, with the source's current count and UIDVALIDITY."""
+    attrs = counts.lookup(source)
+    return {"op": op, "src": source, "dst": dest,
+            "messages": attrs.get("MESSAGES", 0),
+            "uidvalidity": attrs.get("UIDVALIDITY")}
+
+
+def save_plan(path, script, account, ops):
+    """Write a dry run's plan atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    plan = {"script": script, "account": account,
+            "created": round(time.time()), "ops": ops}
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(plan, fh, ensure_ascii=False, indent=1)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+def load_plan(path, script, account):
+    """Read a saved plan, refusing one made by another script or account."""
+    with open(path, encoding="utf-8") as fh:
+        plan = json.load(fh)
+    if plan.get("script") != script or plan.get("account") != account:
+        raise ValueError(f"{path} is a {plan.get('script')} plan for "
+                         f"{plan.get('account')}, not {script} for {account}")
+    return plan
+
+
+def check_plan(plan, counts, journal=None):
+    """Cheaply confirm the server still matches a saved plan.
+
+    Only STATUS is used (one LIST-STATUS call where supported). Returns
+    (problems, changed): problems are sources that vanished or were
+    recreated (new UIDVALIDITY), which make the plan unsafe; changed are
+    sources whose message count moved, which is normal for live mail.
+    Operations the journal already marks done are not checked.
+    """
+    problems = []
+    changed = []
+    counts.prefetch_many(op["src"] for op in plan["ops"])
+    for op in plan["ops"]:
+        if journal and journal.is_done(op["op"], op["src"], op["dst"], op["uidvalidity"]):
+            continue
+        attrs = counts.lookup(op["src"])
+        if not attrs:
+            problems.append(f"'{op['src']}' no longer exists")
+        elif op["uidvalidity"] is not None and attrs.get("UIDVALIDITY") != op["uidvalidity"]:
+            problems.append(f"'{op['src']}' was recreated (UIDVALIDITY changed)")
+        elif attrs.get("MESSAGES", 0) != op["messages"]:
+            changed.append(f"'{op['src']}': {op['messages']} → {attrs.get('MESSAGES', 0)} msgs")
+    return problems, changed
+
+
+class _Progress(dict):
+    """Chunk-progress dict that journals every update (see run_chunks)."""
+
+    def __init__(self, journal):
+        super().__init__()
+        self.journal = journal
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.journal.append({"event": "progress", "key": list(key), **value})
+
+    def pop(self, key, *default):
+        if key in self:
+            self.journal.append({"event": "progress-done", "key": list(key)})
+        return super().pop(key, *default)
+
+
+class Journal:
+    """fsync'd JSON-lines journal of planned/done/failed operations."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.failed = 0
+        self.progress = _Progress(self)
+        self.fh = None
+        self.lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def key(op, source, dest=None, uidvalidity=None):
+        return (op, source, dest, uidvalidity)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn final line from a crash mid-write
+                    continue
+                event = entry.get("event")
+                if event == "done":
+                    self.done.add(self.key(entry["op"], entry["src"],
+                                           entry.get("dst"), entry.get("uidvalidity")))
+                elif event == "progress":
+                    dict.__setitem__(self.progress, tuple(entry["key"]), {
+                        "uidvalidity": entry["uidvalidity"],
+                        "last_uid": entry["last_uid"],
+                    })
+                elif event == "progress-done":
+                    dict.pop(self.progress, tuple(entry["key"]), None)
+
+    def append(self, entry):
+        """Write one entry and fsync it before returning (thread-safe)."""
+        entry = {"ts": round(time.time(), 3), **entry}
+        with self.lock:
+            if self.fh is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.fh = open(self.path, "a", encoding="utf-8")
+            self.fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def resumed(self):
+        """True if an earlier interrupted run left work behind."""
+        return bool(self.done or self.progress)
+
+    def is_done(self, op, source, dest=None, uidvalidity=None):
+        return self.key(op, source, dest, uidvalidity) in self.done
+
+    def planned(self, op, source, dest=None, uidvalidity=None):
+        self.append({"event": "planned", "op": op, "src": source, "dst": dest,
+                     "uidvalidity": uidvalidity})
+
+    def record(self, ok, op, source, dest=None, uidvalidity=None):
+        """Journal the outcome of one operation."""
+        self.append({"event": "done" if ok else "failed", "op": op,
+                     "src": source, "dst": dest, "uidvalidity": uidvalidity})
+        if ok:
+            self.done.add(self.key(op, source, dest, uidvalidity))
+        else:
+            self.failed += 1
+
+    def close(self, keep=None):
+        """Close the journal; delete it after a clean run unless keep."""
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if keep is None:
+            keep = self.failed > 0
+        if not keep and os.path.exists(self.path):
+            os.remove(self.path)
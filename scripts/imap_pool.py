@@ -0,0 +1,202 @@
+"""
+Parallel executor for independent folder operations.
+
+Opens a small, bounded pool of authenticated IMAP connections and runs
+plan operations (see imap_journal.plan_op) on them concurrently. Two
+operations are ordered if they touch the same folder or one touches a
+parent of the other's folder (e.g. a rename that creates
+"Finance/Billing" and a merge into it, or a child rename and the
+deletion of its container); everything else runs in parallel. When an
+operation fails, the operations that depend on it are skipped.
+
+Gmail allows about 15 concurrent IMAP sessions per account, so the pool
+stays well under that.
+
+Worker threads run their tasks through ContextExecutor, in a copy of
+the submitting thread's contextvars context, so per-account state kept
+in ContextVars (the trace phase, a batch run's log stream) follows the
+work into the pool.
+"""
+
+import contextvars
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_JOBS = 4
+MAX_JOBS = 10
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor running each task in the submitter's context."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def jobs_arg(argv, default=DEFAULT_JOBS):
+    """Connection count from `--jobs N`, clamped to 1..MAX_JOBS."""
+    if "--jobs" in argv:
+        i = argv.index("--jobs")
+        try:
+            return max(1, min(int(argv[i + 1]), MAX_JOBS))
+        except (IndexError, ValueError):
+            pass
+    return default
+
+
+class ConnectionPool:
+    """Up to `size` logged-in connections, opened on demand.
+
+    `connect()` must return a new authenticated connection. An existing
+    connection (normally the one used for planning) can be handed in as
+    `first` so it is reused rather than left idle.
+    """
+
+    def __init__(self, connect, size, first=None):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+        if first is not None:
+            self.idle.put(first)
+            self.first = first
+        else:
+            self.first = None
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            grow = len(self.opened) + (self.first is not None) < self.size
+            if grow:
+                # Reserve the slot before the slow login
+                self.opened.append(None)
+        if not grow:
+            return self.idle.get()
+        try:
+            imap = self.connect()
+        except Exception:
+            with self.lock:
+                self.opened.remove(None)
+            raise
+        with self.lock:
+            self.opened[self.opened.index(None)] = imap
+        return imap
+
+    def release(self, imap):
+        self.idle.put(imap)
+
+    def close(self):
+        """Log out every connection the pool opened (not `first`)."""
+        for imap in self.opened:
+            if imap is None:
+                continue
+            try:
+                imap.logout()
+            except Exception:
+                pass
+        self.opened = []
+
+
+def _ancestors(name, delimiter):
+    """Every folder path that contains `name`, outermost first."""
+    if not delimiter:
+        return []
+    parts = name.split(delimiter)
+    return [delimiter.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def dependencies(ops, delimiter="/"):
+    """For each op, the indices of earlier ops it must wait for.
+
+    Ops are indexed by the folders they touch, split on the server's
+    hierarchy delimiter, so each op costs O(depth) lookups instead of a
+    pass over every earlier op. Only the last earlier op on the same
+    folder or on an ancestor is listed: it waits for the ones before it,
+    and is skipped if they fail, so the order and the skipping are the
+    same as listing them all.
+    """
+    last = {}                   # folder -> last op touching it
+    below = defaultdict(list)   # folder -> ops inside it since that op
+    deps = []
+    for i, op in enumerate(ops):
+        names = {n for n in (op["src"], op.get("dst")) if n}
+        parents = {p for n in names for p in _ancestors(n, delimiter)}
+        found = set()
+        for name in names | parents:
+            if name in last:
+                found.add(last[name])
+        for name in names:
+            found.update(below.pop(name, ()))
+        for name in names:
+            last[name] = i
+        for parent in parents - names:
+            below[parent].append(i)
+        deps.append(found)
+    return deps
+
+
+def run_parallel(ops, run, pool, delimiter="/"):
+    """Run `run(imap, op) -> bool` for every op, honouring dependencies.
+
+    `delimiter` is the server's hierarchy delimiter (FolderTree.delimiter).
+    Returns a list of results in op order; ops skipped because a
+    dependency failed count as False.
+    """
+    deps = dependencies(ops, delimiter)
+    waiting = {i: set(d) for i, d in enumerate(deps)}
+    dependents = defaultdict(list)
+    for i, d in enumerate(deps):
+        for j in d:
+            dependents[j].append(i)
+    results = [None] * len(ops)
+
+    def task(i):
+        imap = pool.acquire()
+        try:
+            return run(imap, ops[i])
+        finally:
+            pool.release(imap)
+
+    def resolve(i, ok):
+        """Record a result and return dependents that became ready."""
+        results[i] = ok
+        ready = []
+        for j in dependents[i]:
+            waiting[j].discard(i)
+            if waiting[j] or results[j] is not None:
+                continue
+            if any(results[k] is False for k in deps[j]):
+                op = ops[j]
+                print(f"  [!] SKIPPED {op['op'].upper()} '{op['src']}': "
+                      f"depends on a failed operation")
+                ready.extend(resolve(j, False))
+            else:
+                ready.append(j)
+        return ready
+
+    executor = ContextExecutor(max_workers=pool.size)
+    try:
+        running = {}
+        ready = [i for i, d in waiting.items() if not d]
+        while ready or running:
+            for i in ready:
+                running[executor.submit(task, i)] = i
+            ready = []
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    ok = bool(future.result())
+                except Exception as e:
+                    print(f"  [!] {ops[i]['op'].upper()} error for '{ops[i]['src']}': {e}")
+                    ok = False
+                ready.extend(resolve(i, ok))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
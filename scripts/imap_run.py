@@ -0,0 +1,193 @@
+"""
+One account session shared by the phases of a run.
+
+organize-email.py, cleanup-email.py and delete-old-labels.py each used to
+log in, LIST the whole account and count its folders on their own. Each
+now exposes banner() and run(ctx) and works through a Context: the
+logged-in connection, the server profile, the folder tree (listed once),
+the message counts and the connection pool. Run on its own, a script
+builds a Context for itself; reorg-email.py builds one and passes it to
+all three phases in turn, so the account is discovered once.
+
+After each phase, applied() carries the phase's operations into the
+folder tree and counts: the ones that succeeded, or in a dry run the ones
+planned, so the next phase plans against the account as it will be.
+
+With --offline, offline_context() builds the Context from the local
+envelope index (imap_index) instead of a login: folders, counts and the
+server profile as of the last index-email.py sync. Only dry runs can
+plan offline.
+"""
+
+import importlib.util
+import os
+import sys
+import time
+from collections import Counter
+
+from imap_cache import open_cache
+from imap_caps import probe_server
+from imap_credentials import get_email
+from imap_folders import parse_list
+from imap_helpers import MessageCounts, connect
+from imap_index import IndexCounts, index_path, open_index
+from imap_pool import ConnectionPool, jobs_arg
+from imap_snapshot import snapshot_arg, take_snapshot
+from imap_trace import phase
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_script(name):
+    """Import a hyphenated script as a module (its main() is not run)."""
+    spec = importlib.util.spec_from_file_location(name[:-3].replace("-", "_"),
+                                                  os.path.join(HERE, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Context:
+    """A logged-in account and what is known about it so far."""
+
+    def __init__(self, email, password, argv):
+        self.email = email
+        self.password = password
+        self.argv = argv
+        self.jobs = jobs_arg(argv)
+        self.pipeline = False   # True when reorg-email.py runs every phase
+        self.offline = False    # True when planning from the envelope index
+        self.index = None
+        self.imap = None
+        self.caps = None
+        self.cache = None
+        self.counts = None
+        self.folders = None
+        self.stats = Counter()  # op kind (or "failed") -> count, over all phases
+        self._pool = None
+
+    def connect(self):
+        """Log in (raises imaplib.IMAP4.error) and probe the server."""
+        self.imap = connect(self.email, self.password)
+        self.caps = probe_server(self.imap)
+        self.cache = open_cache(self.email, self.argv)
+        self.counts = MessageCounts(self.imap, self.caps, self.cache)
+
+    def open_offline(self, index):
+        """Plan from an EnvelopeIndex instead of a live connection."""
+        self.offline = True
+        self.index = index
+        self.caps = index.profile()
+        self.cache = open_cache(self.email, self.argv)
+        self.counts = IndexCounts(index, self.caps)
+        self.folders = index.folder_tree()
+
+    def describe(self):
+        print("Server strategy:")
+        for line in self.caps.describe():
+            print(f"  {line}")
+        print()
+
+    def list_folders(self):
+        """FolderTree of the account, LISTed on first use; None if LIST fails."""
+        if self.folders is None:
+            status, data = self.imap.list()
+            if status != "OK":
+                return None
+            self.folders = parse_list(data)
+        return self.folders
+
+    def delimiter(self):
+        """The server's hierarchy delimiter from LIST ("/" before any LIST)."""
+        return self.folders.delimiter if self.folders is not None else "/"
+
+    def pool(self):
+        """Connection pool for the apply phases, kept for the whole run."""
+        if self._pool is None:
+            self._pool = ConnectionPool(lambda: connect(self.email, self.password),
+                                        self.jobs, first=self.imap)
+        return self._pool
+
+    def snapshot(self, ops):
+        """Export the folders ops start from to --snapshot DIR, if given; False if that failed."""
+        try:
+            target = snapshot_arg(self.argv)
+        except ValueError as e:
+            print(e)
+            return False
+        if target is None:
+            return True
+        phase("snapshot")
+        folders = [op["src"] for op in ops if self.counts.get(op["src"])]
+        return take_snapshot(self.pool(), self.caps, self.counts, folders, *target,
+                             delimiter=self.delimiter())
+
+    def applied(self, ops, results):
+        """Carry the operations that succeeded into the folder tree and counts."""
+        folders = self.folders
+        for op, ok in zip(ops, results):
+            self.stats[op["op"] if ok else "failed"] += 1
+            if not ok:
+                continue
+            src, dst = op["src"], op.get("dst")
+            if op["op"] == "rename":
+                self.counts.renamed(src, dst)
+            elif op["op"] == "merge":
+                self.counts.moved(src, dst)
+            else:
+                self.counts.deleted(src)
+            if folders is None:
+                continue
+            if op["op"] == "rename":
+                try:
+                    folders.rename(src, dst)
+                except (KeyError, ValueError):
+                    folders.discard(src)
+                    folders.add(dst)
+                # Like Gmail, RENAME creates missing parents
+                parent = folders.parent(dst)
+                while parent and parent not in folders:
+                    folders.add(parent)
+                    parent = folders.parent(parent)
+            else:
+                folders.discard(src)
+
+    def close(self):
+        """Log out every connection and close the index and count cache."""
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self.imap is not None:
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+            self.imap = None
+
+
+def offline_context(argv):
+    """Context for an --offline dry run, from the account's envelope index.
+
+    Exits if --execute or --apply was given, or if the account was never
+    indexed.
+    """
+    if "--execute" in argv or "--apply" in argv:
+        print("--offline only plans; drop it to --execute or --apply.")
+        sys.exit(2)
+    email = get_email(argv)
+    index = open_index(email)
+    if index is None or index.synced() is None:
+        print(f"No envelope index at {index_path(email)}; run index-email.py first.")
+        sys.exit(1)
+    ctx = Context(email, None, argv)
+    ctx.open_offline(index)
+    age = (time.time() - index.synced()) / 3600
+    print(f"Offline: planning from the index synced {age:.1f}h ago "
+          f"({len(ctx.folders)} folders)\n")
+    return ctx
@@ -0,0 +1,439 @@
+"""
+IMAP connection class shared by the Gmail reorganization scripts.
+
+Session is an imaplib.IMAP4_SSL that sends every command through an
+adaptive token-bucket RateLimiter instead of the fixed time.sleep()
+calls the scripts used to make between operations, and that reconnects
+by itself when the server drops it (see SessionMixin). One limiter is
+shared by every connection to the same account, so a connection pool
+is throttled as a whole.
+
+The limiter starts at the server profile's rate and adapts:
+  - fast responses add a little rate back (additive increase)
+  - a command much slower than its usual latency cuts the rate
+  - NO/BAD [THROTTLED] or [UNAVAILABLE] halves the rate, backs off with
+    jitter and retries the command, which the server rejected unrun
+"""
+
+import imaplib
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+import imap_trace
+
+# Per-server limiter settings (commands/second); "default" for the rest
+RATE_PROFILES = {
+    "imap.gmail.com": {"rate": 10.0, "burst": 20, "min_rate": 0.5, "max_rate": 40.0},
+    "default":        {"rate": 5.0,  "burst": 10, "min_rate": 0.5, "max_rate": 20.0},
+    # fake_imap benchmarks only, never picked by host: effectively unlimited
+    "bench":          {"rate": 1000.0, "burst": 1000, "min_rate": 50.0, "max_rate": 10000.0},
+}
+# Names a RATE_PROFILES entry to use whatever the host (bench-email.py
+# sets "bench"); a local proxy or tunnel to Gmail still gets "default"
+RATE_PROFILE_ENV = "GMAIL_REORG_RATE_PROFILE"
+
+THROTTLE_RE = re.compile(rb"\[(THROTTLED|UNAVAILABLE)\]", re.IGNORECASE)
+THROTTLE_RETRIES = 5
+RECONNECT_RETRIES = 4
+# Gmail ends an IDLE after about 29 minutes; restart well before that
+IDLE_RESTART = 25 * 60
+IDLE_GRACE = 60         # beyond IDLE_RESTART, a silent socket counts as dead
+
+# Commands that are safe to re-send after reconnecting
+IDEMPOTENT = {"CAPABILITY", "NOOP", "LIST", "LSUB", "STATUS", "SELECT",
+              "EXAMINE", "CLOSE", "UNSELECT", "SEARCH", "FETCH", "STORE",
+              "EXPUNGE", "NAMESPACE"}
+IDEMPOTENT_UID = {"SEARCH", "FETCH", "STORE", "MOVE", "EXPUNGE"}
+
+# RFC 4978; imaplib only sends commands it knows about
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+
+# Commands whose first argument is the mailbox they act on (for tracing)
+MAILBOX_COMMANDS = {"SELECT", "EXAMINE", "STATUS", "CREATE", "DELETE", "RENAME",
+                    "SUBSCRIBE", "UNSUBSCRIBE", "APPEND"}
+
+
+class RateLimiter:
+    """Thread-safe token bucket whose rate follows server feedback."""
+
+    def __init__(self, rate, burst, min_rate, max_rate):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.latency = {}   # command → EWMA seconds
+        self.backoff = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host):
+        name = os.environ.get(RATE_PROFILE_ENV) or host
+        return cls(**RATE_PROFILES.get(name, RATE_PROFILES["default"]))
+
+    def reserve(self):
+        """Take one command's token; returns how long to wait before sending."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # Going negative reserves a slot for this caller
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def acquire(self):
+        """Block until one command may be sent."""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def observe(self, command, elapsed):
+        """Adapt the rate to one command's latency."""
+        with self.lock:
+            usual = self.latency.get(command)
+            if usual is not None and elapsed > max(3 * usual, 0.5):
+                self.rate = max(self.min_rate, self.rate * 0.7)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.5)
+                self.backoff = 0.0
+            if usual is None:
+                self.latency[command] = elapsed
+            else:
+                self.latency[command] = 0.8 * usual + 0.2 * elapsed
+
+    def throttled(self):
+        """Halve the rate and return how long to back off (with jitter)."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.backoff = min(max(self.backoff * 2, 1.0), 60.0)
+            return self.backoff * random.uniform(0.5, 1.5)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(host, account):
+    """The RateLimiter shared by every connection to one account."""
+    with _limiters_lock:
+        key = (host, account)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter.for_host(host)
+        return _limiters[key]
+
+
+class UidValidityChanged(imaplib.IMAP4.error):
+    """The selected mailbox was recreated while we were reconnecting."""
+
+
+class SessionMixin:
+    """Rate limiting plus automatic reconnect for an imaplib connection.
+
+    Dead connections (BYE, reset sockets, timeouts) are reopened and
+    re-authenticated with the cached credentials, the selected mailbox is
+    re-selected and its UIDVALIDITY checked, and the command is retried
+    with jittered backoff if it is idempotent. Non-idempotent commands
+    (COPY, RENAME, DELETE, APPEND...) are not retried; they raise
+    IMAP4.abort on a live connection so the caller can record a failure
+    and carry on.
+    """
+
+    limiter = None
+    timeout = None
+    credentials = None
+    selected = None         # (mailbox, readonly, uidvalidity)
+    reconnecting = False
+    bytes_in = 0            # response bytes read, for imap_trace
+    retries = 0             # reconnects + throttle retries of the current command
+    waited = 0.0            # limiter and backoff sleeps of the current command
+    deflate = None          # zlib streams once COMPRESS=DEFLATE is active
+    inflate = None
+    compressed = False      # re-enable compression after reconnecting
+    side = None             # imap_async.SideConnection, once something is pipelined
+
+    def login(self, user, password):
+        self.credentials = (user, password)
+        return super().login(user, password)
+
+    def logout(self):
+        if self.side is not None:
+            self.side.close()
+            self.side = None
+        return super().logout()
+
+    def select(self, mailbox="INBOX", readonly=False):
+        typ, data = super().select(mailbox, readonly)
+        if typ == "OK":
+            uidvalidity = self.untagged_responses.get("UIDVALIDITY", [None])[-1]
+            self.selected = (mailbox, readonly, uidvalidity)
+        return typ, data
+
+    def close(self):
+        # Cleared afterwards so a CLOSE cut off mid-flight is re-selected
+        # and retried after reconnecting
+        try:
+            return super().close()
+        finally:
+            self.selected = None
+
+    def unselect(self):
+        try:
+            return super().unselect()
+        finally:
+            self.selected = None
+
+    def compress(self):
+        """Switch on COMPRESS=DEFLATE (RFC 4978); True if the server agreed."""
+        if self.deflate is not None:
+            return True
+        typ, _ = self._simple_command("COMPRESS", "DEFLATE")
+        if typ != "OK":
+            return False
+        self.deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.inflate = zlib.decompressobj(-15)
+        self.inbuf = bytearray()
+        self.compressed = True
+        return True
+
+    def _fill(self):
+        """Inflate more of the compressed stream into inbuf."""
+        while True:
+            chunk = self.file.read1(65536)
+            if not chunk:
+                raise self.abort("socket error: EOF")
+            data = self.inflate.decompress(chunk)
+            if data:
+                self.inbuf += data
+                return
+
+    def readline(self):
+        if self.inflate is None:
+            line = super().readline()
+        else:
+            while (end := self.inbuf.find(b"\n")) < 0:
+                self._fill()
+            line = bytes(self.inbuf[:end + 1])
+            del self.inbuf[:end + 1]
+        self.bytes_in += len(line)
+        return line
+
+    def read(self, size):
+        if self.inflate is None:
+            data = super().read(size)
+        else:
+            while len(self.inbuf) < size:
+                self._fill()
+            data = bytes(self.inbuf[:size])
+            del self.inbuf[:size]
+        self.bytes_in += len(data)
+        return data
+
+    def send(self, data):
+        if self.deflate is not None:
+            data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+    def idle(self, timeout=IDLE_RESTART):
+        """Wait in IDLE (RFC 2177) for news about the selected mailbox.
+
+        Returns the untagged responses that ended the wait (b"12 EXISTS",
+        ...), or [] once `timeout` seconds pass quietly: a timer sends DONE,
+        so IDLE is restarted by the caller long before Gmail's cut-off. A
+        dropped connection (BYE, reset, silence past the timeout) is
+        reopened with the mailbox re-selected, and [] returned, so the
+        caller simply checks for new mail again.
+        """
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            return self._idle(timeout)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if self.credentials is None:
+                raise
+            print(f"      [~] IDLE ended by the server ({e}); reconnecting...")
+            self.reconnect()
+            return []
+
+    def _idle(self, timeout):
+        tag = self._new_tag()
+        events = []
+        lock = threading.Lock()
+        done = []
+
+        def finish():
+            with lock:
+                if not done:
+                    done.append(True)
+                    self.send(b"DONE\r\n")
+
+        try:
+            self.send(tag + b" IDLE\r\n")
+            line = self._get_line()
+            while line.startswith(b"* "):
+                events.append(line[2:])
+                line = self._get_line()
+            if not line.startswith(b"+"):
+                raise self.error(f"IDLE refused: {line.decode(errors='replace')}")
+            self.sock.settimeout(timeout + IDLE_GRACE)
+            timer = threading.Timer(timeout, finish)
+            timer.daemon = True
+            timer.start()
+            try:
+                if events:
+                    finish()
+                while True:
+                    line = self._get_line()
+                    if line.startswith(tag):
+                        break
+                    if line.startswith(b"* BYE"):
+                        raise self.abort(line.decode(errors="replace"))
+                    if line.startswith(b"* ") and not line.startswith(b"* OK"):
+                        events.append(line[2:])
+                        finish()
+            finally:
+                timer.cancel()
+                self.sock.settimeout(self.timeout)
+        finally:
+            self.tagged_commands.pop(tag, None)
+        return events
+
+    def _simple_command(self, name, *args):
+        tracer = imap_trace.active
+        if tracer is None or self.reconnecting:
+            return self._retrying_command(name, *args)
+        t0 = time.monotonic()
+        before = self.bytes_in
+        self.retries = 0
+        self.waited = 0.0
+        status = "ERROR"
+        try:
+            typ, data = self._retrying_command(name, *args)
+            status = typ
+            return typ, data
+        finally:
+            command, mailbox = name, self.selected[0] if self.selected else ""
+            if name == "UID" and args:
+                command = f"UID {str(args[0]).upper()}"
+            elif name in MAILBOX_COMMANDS and args:
+                mailbox = args[0]
+            tracer.record(self, command, imap_trace.mailbox_arg(mailbox),
+                          time.monotonic() - t0, self.bytes_in - before,
+                          self.retries, self.waited, status)
+
+    def _retrying_command(self, name, *args):
+        if self.reconnecting or self.credentials is None:
+            return self._limited_command(name, *args)
+        for attempt in range(RECONNECT_RETRIES + 1):
+            try:
+                return self._limited_command(name, *args)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if name == "LOGOUT":
+                    return "BYE", [str(e).encode()]
+                if attempt == RECONNECT_RETRIES:
+                    raise
+                delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.5)
+                print(f"      [~] Connection lost ({e}); reconnecting in {delay:.0f}s...")
+                self.retries += 1
+                time.sleep(delay)
+                try:
+                    self.reconnect()
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    print(f"      [~] Reconnect failed: {e}")
+                    continue
+                if not is_idempotent(name, args):
+                    raise imaplib.IMAP4.abort(
+                        f"{name} {' '.join(map(str, args[:1]))} interrupted by a "
+                        f"disconnect; reconnected but not retried")
+
+    def reconnect(self):
+        """Reopen the socket, log in again and restore the selected mailbox."""
+        self.reconnecting = True
+        try:
+            try:
+                self.shutdown()
+            except OSError:
+                pass
+            self.deflate = self.inflate = None
+            imaplib.IMAP4.__init__(self, self.host, self.port, self.timeout)
+            super().login(*self.credentials)
+            if self.compressed:
+                self.compress()
+            if self.selected:
+                mailbox, readonly, uidvalidity = self.selected
+                typ, data = super().select(mailbox, readonly)
+                if typ != "OK":
+                    self.selected = None
+                    raise imaplib.IMAP4.error(f"cannot re-select {mailbox}: {data}")
+                now = self.untagged_responses.get("UIDVALIDITY", [None])[-1]
+                if uidvalidity is not None and now != uidvalidity:
+                    self.selected = None
+                    raise UidValidityChanged(
+                        f"{mailbox} UIDVALIDITY changed across reconnect; UIDs are stale")
+        finally:
+            self.reconnecting = False
+
+    def _limited_command(self, name, *args):
+        if self.limiter is None:
+            return super()._simple_command(name, *args)
+        for attempt in range(THROTTLE_RETRIES + 1):
+            t0 = time.monotonic()
+            self.limiter.acquire()
+            self.waited += time.monotonic() - t0
+            t0 = time.monotonic()
+            try:
+                typ, data = super()._simple_command(name, *args)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                # BAD [THROTTLED] is raised rather than returned
+                if attempt < THROTTLE_RETRIES and THROTTLE_RE.search(str(e).encode()):
+                    self.backoff()
+                    continue
+                raise
+            if (typ == "NO" and attempt < THROTTLE_RETRIES
+                    and any(isinstance(d, bytes) and THROTTLE_RE.search(d) for d in data)):
+                self.backoff()
+                continue
+            self.limiter.observe(name, time.monotonic() - t0)
+            return typ, data
+        return typ, data
+
+    def backoff(self):
+        """Sleep off a [THROTTLED] rejection before retrying."""
+        delay = self.limiter.throttled()
+        self.retries += 1
+        self.waited += delay
+        time.sleep(delay)
+
+
+def is_idempotent(name, args):
+    """True if re-sending the command after a disconnect is harmless.
+
+    UID MOVE counts: UIDs that already moved are simply gone from the
+    source, so a retry only moves what is left.
+    """
+    if name == "UID":
+        return bool(args) and str(args[0]).upper() in IDEMPOTENT_UID
+    return name in IDEMPOTENT
+
+
+class Session(SessionMixin, imaplib.IMAP4_SSL):
+    """Rate-limited, self-reconnecting IMAP-over-SSL connection."""
+
+    def __init__(self, host, port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        self.timeout = timeout
+        super().__init__(host, port, timeout=timeout)
+
+
+class PlainSession(SessionMixin, imaplib.IMAP4):
+    """Session without TLS, for local test servers only."""
+
+    def __init__(self, host, port=imaplib.IMAP4_PORT, timeout=None):
+        self.timeout = timeout
+        super().__init__(host, port, timeout=timeout)
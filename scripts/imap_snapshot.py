@@ -0,0 +1,406 @@
+"""
+Pre-change snapshots of the folders a plan touches (--snapshot DIR).
+
+Merges expunge messages from their source and deletes remove folders,
+with no copy on disk. With --snapshot DIR an --execute run first
+exports every folder its operations start from into DIR, as one Maildir
+per folder (DIR/Finance/Stripe/{cur,new,tmp}) or, with --snapshot-format
+mbox, one mboxrd file per folder (DIR/Finance/Stripe.mbox).
+
+Snapshots accumulate: DIR/.snapshot.sqlite records every message
+exported and, per folder, the UIDVALIDITY and UIDNEXT reached. A repeat
+snapshot reads only UIDs above that mark (Gmail gives a message a new
+UID in a folder whenever it gains the label), and skips a folder with
+no round trip at all when its STATUS shows the same UIDNEXT. Messages
+are keyed by X-GM-MSGID on Gmail, else by folder, UIDVALIDITY and UID;
+a message already exported under another label is hard-linked (Maildir)
+or copied from the other mbox, not downloaded again.
+
+Folders are exported in parallel over the connection pool. Bodies are
+fetched a few MB per UID FETCH with BODY.PEEK[] (which leaves \\Seen
+alone), and messages over PART_SIZE in BODY.PEEK[]<offset.size> parts,
+so memory stays bounded by FETCH_BYTES whatever the message sizes.
+Files are written as the data arrives; a Maildir message appears in
+cur/ only once complete, and an interrupted snapshot picks up from the
+messages it recorded.
+"""
+
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from imap_credentials import arg_value
+from imap_helpers import imap_encode, selected_uidvalidity, uid_ranges
+from imap_index import parse_fetch
+from imap_pool import ContextExecutor
+from imap_rules import parse_header_fetch
+
+FORMATS = ("maildir", "mbox")
+META_BATCH = 5000           # UIDs per metadata UID FETCH
+FETCH_BYTES = 8 << 20       # message bytes per body UID FETCH
+FETCH_COUNT = 500           # ...and messages
+PART_SIZE = 1 << 20         # larger messages are fetched in parts of this size
+COPY_CHUNK = 1 << 20
+
+MAILDIR_FLAGS = {"\\Draft": "D", "\\Flagged": "F", "\\Answered": "R",
+                 "\\Seen": "S", "\\Deleted": "T"}
+FROM_LINE_RE = re.compile(rb"^(>*From )", re.M)
+# Folder path components that would collide with a Maildir's own directories
+RESERVED = {"cur", "new", "tmp", "", ".", ".."}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (name TEXT PRIMARY KEY, uidvalidity INTEGER, uidnext INTEGER);
+CREATE TABLE IF NOT EXISTS messages (key TEXT PRIMARY KEY, path TEXT, offset INTEGER, length INTEGER);
+CREATE TABLE IF NOT EXISTS members (key TEXT, folder TEXT, PRIMARY KEY (key, folder)) WITHOUT ROWID;
+"""
+
+
+def snapshot_arg(argv):
+    """(directory, format) from --snapshot DIR [--snapshot-format F], or None."""
+    if "--snapshot" not in argv:
+        return None
+    path = arg_value(argv, "--snapshot")
+    if not path:
+        raise ValueError("--snapshot needs a directory")
+    fmt = (arg_value(argv, "--snapshot-format") or "maildir").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"--snapshot-format must be one of {', '.join(FORMATS)}")
+    return os.path.expanduser(path), fmt
+
+
+def folder_path(root, folder, delimiter):
+    """Filesystem path for a folder, one directory level per hierarchy level."""
+    parts = folder.split(delimiter) if delimiter else [folder]
+    safe = []
+    for part in parts:
+        part = part.replace(os.sep, "_")
+        safe.append(part + "_" if part in RESERVED or part.startswith(".") else part)
+    return os.path.join(root, *safe)
+
+
+# ──────────────────────────────────────────────
+# Writers
+# ──────────────────────────────────────────────
+
+class MaildirWriter:
+    """Messages of one folder as files in a Maildir."""
+
+    def __init__(self, path):
+        for sub in ("cur", "new", "tmp"):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+        self.path = path
+        self.host = socket.gethostname().replace("/", "_").replace(":", "_")
+        self.fh = None
+
+    def _names(self, key, flags):
+        """(tmp path, final path) for a message."""
+        letters = "".join(sorted(MAILDIR_FLAGS[f] for f in flags if f in MAILDIR_FLAGS))
+        name = f"{int(time.time())}.{re.sub(r'[^A-Za-z0-9]', '_', key)}.{self.host}"
+        return (os.path.join(self.path, "tmp", name),
+                os.path.join(self.path, "cur", f"{name}:2,{letters}"))
+
+    def begin(self, key, flags):
+        self.tmp, self.final = self._names(key, flags)
+        self.fh = open(self.tmp, "wb")
+        self.length = 0
+
+    def write(self, data):
+        self.length += self.fh.write(data)
+
+    def end(self):
+        """Finish the message; returns its (path, offset, length) record."""
+        self.fh.close()
+        self.fh = None
+        os.replace(self.tmp, self.final)
+        return self.final, 0, self.length
+
+    def copy(self, record, key, flags):
+        """Add a message exported before, by hard link where possible."""
+        _, final = self._names(key, flags)
+        try:
+            os.link(record[0], final)
+        except OSError:
+            shutil.copyfile(record[0], final)
+        return final, 0, record[2]
+
+    def close(self):
+        """Drop a message left unfinished."""
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+            os.remove(self.tmp)
+
+
+class MboxWriter:
+    """Messages of one folder appended to an mboxrd file.
+
+    Data is written a line at a time as it arrives: CRLF becomes LF and
+    a line starting with ">*From " gets one more ">".
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path + ".mbox"
+        self.fh = open(self.path, "ab")
+
+    def begin(self, key, flags):
+        self.offset = self.fh.tell()
+        self.carry = b""
+        stamp = time.asctime(time.gmtime()).encode()
+        self.length = self.fh.write(b"From MAILER-DAEMON " + stamp + b"\n")
+
+    def _lines(self, data):
+        data = FROM_LINE_RE.sub(rb">\1", data.replace(b"\r\n", b"\n"))
+        self.length += self.fh.write(data)
+
+    def write(self, data):
+        # Complete lines only; the rest waits for the next part
+        data = self.carry + data
+        cut = data.rfind(b"\n") + 1
+        self.carry = data[cut:]
+        self._lines(data[:cut])
+
+    def end(self):
+        if self.carry:
+            self._lines(self.carry + b"\n")
+            self.carry = b""
+        self.length += self.fh.write(b"\n")
+        self.fh.flush()
+        return self.path, self.offset, self.length
+
+    def copy(self, record, key, flags):
+        """Append a message exported before, copied from its mbox."""
+        path, offset, length = record
+        self.offset = self.fh.tell()
+        copied = 0
+        with open(path, "rb") as src:
+            src.seek(offset)
+            while copied < length:
+                chunk = src.read(min(COPY_CHUNK, length - copied))
+                if not chunk:
+                    break
+                copied += self.fh.write(chunk)
+        self.fh.flush()
+        return self.path, self.offset, copied
+
+    def close(self):
+        self.fh.close()
+
+
+WRITERS = {"maildir": MaildirWriter, "mbox": MboxWriter}
+
+
+# ──────────────────────────────────────────────
+# Export
+# ──────────────────────────────────────────────
+
+class Snapshot:
+    """A snapshot directory and its manifest."""
+
+    def __init__(self, root, fmt, caps, delimiter):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.fmt = fmt
+        self.gmail = caps.gmail
+        self.delimiter = delimiter
+        self.db = sqlite3.connect(os.path.join(root, ".snapshot.sqlite"),
+                                  check_same_thread=False, isolation_level=None)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.meta_items = "(UID FLAGS RFC822.SIZE" + (" X-GM-MSGID)" if self.gmail else ")")
+
+    def mark(self, folder):
+        """(uidvalidity, uidnext) reached by earlier snapshots of a folder."""
+        with self.lock:
+            row = self.db.execute("SELECT uidvalidity, uidnext FROM folders WHERE name = ?",
+                                  (folder,)).fetchone()
+        return row or (None, 1)
+
+    def unchanged(self, folder, attrs):
+        """True if a folder's STATUS shows nothing new since the last snapshot."""
+        uidvalidity, uidnext = self.mark(folder)
+        return (attrs.get("UIDVALIDITY") is not None and attrs.get("UIDVALIDITY") == uidvalidity
+                and attrs.get("UIDNEXT") == uidnext)
+
+    def _record(self, folder, records):
+        """Note [(key, (path, offset, length))] as exported into folder, in one transaction."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                                [(key,) + record for key, record in records])
+            self.db.executemany("INSERT OR IGNORE INTO members VALUES (?, ?)",
+                                [(key, folder) for key, _ in records])
+            self.db.execute("COMMIT")
+
+    def _lookup(self, key, folder):
+        """(already in this folder, record of an earlier export or None)."""
+        with self.lock:
+            member = self.db.execute("SELECT 1 FROM members WHERE key = ? AND folder = ?",
+                                     (key, folder)).fetchone()
+            record = self.db.execute("SELECT path, offset, length FROM messages WHERE key = ?",
+                                     (key,)).fetchone()
+        return member is not None, record
+
+    def export(self, conn, folder):
+        """Export a folder's messages not yet in the snapshot; returns a Counter."""
+        stats = Counter()
+        typ, data = conn.select(imap_encode(folder), readonly=True)
+        if typ != "OK":
+            raise RuntimeError(f"cannot examine {folder}: {data}")
+        try:
+            uidvalidity = selected_uidvalidity(conn)
+            _, data = conn.response("UIDNEXT")
+            try:
+                uidnext = int(data[-1])
+            except (TypeError, ValueError, IndexError):
+                uidnext = None
+            stored_validity, stored_next = self.mark(folder)
+            start = stored_next if stored_validity == uidvalidity else 1
+            if uidnext is None:
+                uid_sets = [f"{start}:*"]
+            else:
+                uid_sets = [f"{lo}:{min(lo + META_BATCH - 1, uidnext - 1)}"
+                            for lo in range(start, uidnext, META_BATCH)]
+            if uid_sets:
+                writer = WRITERS[self.fmt](folder_path(self.root, folder, self.delimiter))
+                try:
+                    for uid_set in uid_sets:
+                        self._export_set(conn, folder, uidvalidity, uid_set, start,
+                                         writer, stats)
+                finally:
+                    writer.close()
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+                                (folder, uidvalidity, uidnext))
+            return stats
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _export_set(self, conn, folder, uidvalidity, uid_set, start, writer, stats):
+        typ, data = conn.uid("FETCH", uid_set, self.meta_items)
+        if typ != "OK":
+            raise RuntimeError(f"UID FETCH in {folder} failed: {data}")
+        todo, copied = [], []
+        for item in parse_fetch(data):
+            # "n:*" returns the highest message even when its UID is below n
+            if "UID" not in item or int(item["UID"]) < start:
+                continue
+            uid = int(item["UID"])
+            key = (item["X-GM-MSGID"] if self.gmail and item.get("X-GM-MSGID")
+                   else f"{folder}\0{uidvalidity}\0{uid}")
+            flags = item.get("FLAGS") or []
+            member, record = self._lookup(key, folder)
+            if member:
+                continue
+            if record is not None:
+                copied.append((key, writer.copy(record, key, flags)))
+                continue
+            todo.append((uid, key, flags, int(item.get("RFC822.SIZE") or 0)))
+        if copied:
+            self._record(folder, copied)
+            stats["copied"] += len(copied)
+
+        # Small messages a batch at a time, large ones in parts
+        batch, size = [], 0
+        for entry in todo + [None]:
+            if entry is not None and entry[3] <= PART_SIZE:
+                batch.append(entry)
+                size += entry[3]
+                if size < FETCH_BYTES and len(batch) < FETCH_COUNT:
+                    continue
+            if batch:
+                self._fetch_whole(conn, folder, writer, batch, stats)
+                batch, size = [], 0
+            if entry is not None and entry[3] > PART_SIZE:
+                self._fetch_parts(conn, folder, writer, entry, stats)
+
+    def _fetch_whole(self, conn, folder, writer, batch, stats):
+        entries = {entry[0]: entry for entry in batch}
+        typ, data = conn.uid("FETCH", ",".join(uid_ranges(entries)), "(UID BODY.PEEK[])")
+        if typ != "OK":
+            raise RuntimeError(f"UID FETCH in {folder} failed: {data}")
+        records = []
+        for uid, raw in parse_header_fetch(data):
+            entry = entries.pop(uid, None)
+            if entry is None:
+                continue
+            _, key, flags, _ = entry
+            writer.begin(key, flags)
+            writer.write(raw)
+            records.append((key, writer.end()))
+            stats["bytes"] += len(raw)
+        self._record(folder, records)
+        stats["exported"] += len(records)
+        stats["missing"] += len(entries)
+
+    def _fetch_parts(self, conn, folder, writer, entry, stats):
+        uid, key, flags, size = entry
+        writer.begin(key, flags)
+        offset = 0
+        while offset < size:
+            typ, data = conn.uid("FETCH", str(uid), f"(UID BODY.PEEK[]<{offset}.{PART_SIZE}>)")
+            if typ != "OK":
+                raise RuntimeError(f"UID FETCH {uid} in {folder} failed: {data}")
+            parts = parse_header_fetch(data)
+            if not parts or not parts[0][1]:
+                break
+            writer.write(parts[0][1])
+            offset += len(parts[0][1])
+        if offset == 0:
+            stats["missing"] += 1
+            writer.close()
+            return
+        self._record(folder, [(key, writer.end())])
+        stats["exported"] += 1
+        stats["bytes"] += offset
+
+    def close(self):
+        self.db.close()
+
+
+def take_snapshot(pool, caps, counts, folders, root, fmt, delimiter="/"):
+    """Export folders into root in parallel; True if every folder succeeded."""
+    folders = list(dict.fromkeys(folders))
+    snap = Snapshot(root, fmt, caps, delimiter)
+    stats = Counter()
+    # Folders whose STATUS matches the manifest need no round trip
+    todo = [f for f in folders if not snap.unchanged(f, counts.lookup(f))]
+    stats["unchanged"] = len(folders) - len(todo)
+    print(f"Snapshot: {len(folders)} folders → {root} ({fmt}), "
+          f"{len(todo)} with new messages")
+    started = time.monotonic()
+    failed = []
+    lock = threading.Lock()
+
+    def task(folder):
+        conn = pool.acquire()
+        try:
+            counted = snap.export(conn, folder)
+            with lock:
+                stats.update(counted)
+        except Exception as e:
+            print(f"  [!] Snapshot of {folder} failed: {e}")
+            failed.append(folder)
+        finally:
+            pool.release(conn)
+
+    try:
+        with ContextExecutor(max_workers=pool.size) as executor:
+            list(executor.map(task, todo))
+    finally:
+        snap.close()
+    print(f"  {stats['exported']} messages exported ({stats['bytes'] / 1e6:.1f} MB), "
+          f"{stats['copied']} copied from other folders, {stats['unchanged']} folders "
+          f"unchanged, in {time.monotonic() - started:.1f}s")
+    if stats["missing"]:
+        print(f"  [~] {stats['missing']} messages vanished before they could be fetched")
+    print()
+    return not failed
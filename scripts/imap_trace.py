@@ -0,0 +1,182 @@
+"""
+Per-command IMAP tracing for `--profile` runs.
+
+When profiling is on, every command sent through a Session (and every
+pipelined command from imap_async) is recorded with its phase, connection,
+command, mailbox, latency, time spent waiting on the rate limiter,
+response size, retries and status. At exit the script prints latency
+percentiles (p50/p95/p99) per phase and per command, plus the mailboxes
+that cost the most time, and optionally writes the raw trace as JSON
+lines for further analysis:
+
+    python3 organize-email.py --profile                 # Report only
+    python3 organize-email.py --profile trace.jsonl     # Report + trace file
+
+Scripts mark phases with phase("plan"), phase("apply")...; commands are
+attributed to the phase that was current when they were sent. The phase
+is kept per context (a ContextVar), so accounts processed side by side
+in a batch each have their own; imap_pool.ContextExecutor carries it
+into worker threads. With profiling off, recording is a single None
+check per command.
+"""
+
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+
+active = None   # the running Tracer, or None when not profiling
+# (tracer, phase, start) of the phase current in this context
+_span = contextvars.ContextVar("imap_trace_span", default=None)
+
+
+def profile_arg(argv):
+    """Start a Tracer for `--profile [PATH]`; returns it, or None."""
+    global active
+    if "--profile" not in argv:
+        return None
+    i = argv.index("--profile")
+    path = None
+    if i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+        path = argv[i + 1]
+    active = Tracer(path)
+    return active
+
+
+def phase(name):
+    """Attribute the commands that follow to phase `name`."""
+    if active is not None:
+        active.set_phase(name)
+
+
+def mailbox_arg(text):
+    """Folder name from a quoted, &- encoded IMAP argument."""
+    text = str(text)
+    if len(text) >= 2 and text[0] == text[-1] == '"':
+        text = text[1:-1]
+    return text.replace("&-", "&")
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+class Tracer:
+    """Thread-safe collector of command records."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        self.phases = []        # finished (name, start, end)
+        self.open = set()       # (tracer, name, start) current in some context
+        self.latest = "setup"   # for threads started outside any traced context
+        self.start = time.monotonic()
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.set_phase("setup")
+
+    def set_phase(self, name):
+        now = time.monotonic()
+        span = _span.get()
+        with self.lock:
+            if span is not None and span in self.open:
+                self.open.discard(span)
+                self.phases.append((span[1], span[2], now))
+            span = (self, name, now)
+            self.open.add(span)
+            self.latest = name
+        _span.set(span)
+
+    def current(self):
+        """Phase of the calling context."""
+        span = _span.get()
+        return span[1] if span is not None and span[0] is self else self.latest
+
+    def conn_id(self, conn):
+        with self.lock:
+            return self.conns.setdefault(id(conn), len(self.conns) + 1)
+
+    def record(self, conn, command, mailbox, latency, nbytes, retries=0,
+               wait=0.0, status="OK"):
+        entry = {
+            "t": round(time.monotonic() - self.start, 6),
+            "phase": self.current(),
+            "conn": conn if isinstance(conn, str) else self.conn_id(conn),
+            "command": command,
+            "mailbox": mailbox,
+            "latency": round(latency, 6),
+            "wait": round(wait, 6),
+            "bytes": nbytes,
+            "retries": retries,
+            "status": status,
+        }
+        with self.lock:
+            self.records.append(entry)
+
+    # ── Output ──
+
+    def finish(self):
+        """Print the report and write the trace file, if requested."""
+        now = time.monotonic()
+        with self.lock:
+            self.phases += [(name, start, now) for _, name, start in self.open]
+            self.phases.sort(key=lambda span: span[1])
+            self.open.clear()
+        self.report()
+        if self.path:
+            with open(self.path, "w", encoding="utf-8") as fh:
+                for name, start, end in self.phases:
+                    fh.write(json.dumps({"phase": name,
+                                         "start": round(start - self.start, 6),
+                                         "end": round(end - self.start, 6)}) + "\n")
+                for entry in self.records:
+                    fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            print(f"  Trace written: {self.path} ({len(self.records)} commands)")
+
+    def _table(self, title, groups, walls=None):
+        print(f"\n  {title:<22} {'cmds':>6} {'wall s':>7} {'cmd s':>7} {'wait s':>7} "
+              f"{'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'KiB':>8} {'retry':>5}")
+        print("  " + "─" * 92)
+        for key, entries in groups:
+            lat = sorted(e["latency"] for e in entries)
+            wall = f"{walls[key]:>7.2f}" if walls and key in walls else f"{'':>7}"
+            print(f"  {key[:22]:<22} {len(entries):>6} {wall} {sum(lat):>7.2f} "
+                  f"{sum(e['wait'] for e in entries):>7.2f} "
+                  f"{percentile(lat, 50) * 1000:>7.1f} {percentile(lat, 95) * 1000:>7.1f} "
+                  f"{percentile(lat, 99) * 1000:>7.1f} "
+                  f"{sum(e['bytes'] for e in entries) / 1024:>8.1f} "
+                  f"{sum(e['retries'] for e in entries):>5}")
+
+    def report(self):
+        by_phase = defaultdict(list)
+        by_command = defaultdict(list)
+        by_mailbox = defaultdict(list)
+        for e in self.records:
+            by_phase[e["phase"]].append(e)
+            by_command[e["command"]].append(e)
+            if e["mailbox"]:
+                by_mailbox[e["mailbox"]].append(e)
+        walls = defaultdict(float)
+        for name, start, end in self.phases:
+            walls[name] += end - start
+        order = list(dict.fromkeys(name for name, _, _ in self.phases))
+
+        print()
+        print("=" * 62)
+        print(f"  PROFILE: {len(self.records)} IMAP commands in "
+              f"{time.monotonic() - self.start:.2f}s")
+        print("  (cmd s = summed command latency; above wall s when parallel;")
+        print("   wall s adds up each account's time in a phase)")
+        print("=" * 62)
+        self._table("Phase", [(p, by_phase[p]) for p in order if p in by_phase], walls)
+        self._table("Command", sorted(by_command.items(),
+                                      key=lambda kv: -sum(e["latency"] for e in kv[1])))
+        slowest = sorted(by_mailbox.items(),
+                         key=lambda kv: -sum(e["latency"] for e in kv[1]))[:10]
+        self._table("Mailbox (top 10)", slowest)
+        print()
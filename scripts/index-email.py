@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Gmail envelope indexer — Frost Peak
+Keeps a local SQLite index of every message's envelope and labels.
+
+A sync reads All Mail's UID, X-GM-MSGID, FLAGS, size, ENVELOPE and
+X-GM-LABELS into ~/.local/state/gmail-reorg/index-<account>.sqlite (see
+imap_index for the schema). The first sync reads everything; later ones
+fetch only new UIDs and, through CONDSTORE, the labels and flags that
+changed since the last one.
+
+With the index in place, questions about the mailbox are answered
+without a connection:
+
+    python3 index-email.py --sql "
+        SELECT COUNT(*) FROM labels s JOIN labels i USING (uid)
+        WHERE s.label = 'Finance/Stripe' AND i.label = 'Finance/Invoices'"
+
+and organize-email.py, cleanup-email.py, delete-old-labels.py and
+reorg-email.py plan dry runs from it with --offline. Offline plans are
+as current as the last sync, so they are shown but not saved for
+--apply.
+
+Usage:
+    python3 index-email.py                 # Sync (incremental after the first run)
+    python3 index-email.py --full          # Rebuild the index from scratch
+    python3 index-email.py --jobs 8        # Fetch on 8 IMAP connections
+    python3 index-email.py --stats         # Offline: totals and the largest labels
+    python3 index-email.py --sql "QUERY"   # Offline: run a read-only SQL query
+    python3 index-email.py --profile [TRACE]     # Latency report (+ JSON trace)
+"""
+
+import imaplib
+import sys
+import time
+
+from imap_credentials import CredentialError, arg_value, get_credentials, get_email
+from imap_index import index_path, open_index
+from imap_run import Context
+from imap_trace import phase, profile_arg
+
+TOP_LABELS = 20
+
+
+def banner(argv):
+    print("=" * 62)
+    print("  Gmail Envelope Indexer — Frost Peak")
+    print("  Local SQLite index of envelopes and labels")
+    print("=" * 62)
+    print()
+    if "--sql" in argv or "--stats" in argv:
+        print("  MODE: OFFLINE (reads the local index)")
+    elif "--full" in argv:
+        print("  MODE: FULL SYNC (rebuilds the index)")
+    else:
+        print("  MODE: SYNC (new and changed messages only)")
+    print()
+
+
+def run(ctx):
+    """Sync the account's index; False if the server cannot be indexed."""
+    caps = ctx.caps
+    if not caps.gmail or not caps.all_mail:
+        print("The index needs Gmail's X-GM-EXT-1 and an All Mail folder; "
+              "this server has neither.")
+        return False
+
+    index = open_index(ctx.email, create=True)
+    try:
+        phase("sync")
+        print(f"Syncing {caps.all_mail} on up to {ctx.jobs} connections...")
+        started = time.monotonic()
+        result = index.sync(ctx.imap, caps, ctx.pool(), full="--full" in ctx.argv)
+        elapsed = time.monotonic() - started
+    finally:
+        index.close()
+
+    print()
+    print("=" * 62)
+    print(f"  {'Rebuilt' if result['rebuilt'] else 'Synced'} in {elapsed:.1f}s: "
+          f"{result['new']} new, {result['changed']} changed, {result['removed']} removed")
+    print(f"  {result['messages']} messages indexed")
+    print(f"  Index: {index_path(ctx.email)}")
+    print("=" * 62)
+    return True
+
+
+def print_table(columns, rows):
+    widths = [max([len(str(c))] + [len(str(r[i])) for r in rows]) for i, c in enumerate(columns)]
+    print("  ".join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    print("  ".join("─" * w for w in widths))
+    for row in rows:
+        print("  ".join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+
+def offline(argv):
+    """--sql / --stats against the local index, without logging in."""
+    email = get_email(argv)
+    print()
+    index = open_index(email)
+    if index is None or index.synced() is None:
+        print(f"No envelope index at {index_path(email)}; run index-email.py first.")
+        sys.exit(1)
+    try:
+        if "--sql" in argv:
+            sql = arg_value(argv, "--sql")
+            if not sql:
+                print('--sql needs a query: --sql "SELECT ..."')
+                sys.exit(2)
+            try:
+                columns, rows = index.query(sql)
+            except Exception as e:
+                print(f"Query failed: {e}")
+                sys.exit(1)
+            print_table(columns, rows)
+            print(f"\n({len(rows)} rows)")
+            return
+        _, [(messages, size)] = index.query("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages")
+        age = (time.time() - index.synced()) / 3600
+        print(f"{messages} messages, {size / 1e6:.1f} MB, synced {age:.1f}h ago\n")
+        columns, rows = index.query(
+            "SELECT label, messages FROM counts ORDER BY messages DESC, label LIMIT ?",
+            (TOP_LABELS,))
+        print_table(columns, rows)
+    finally:
+        index.close()
+
+
+def main():
+    banner(sys.argv)
+    if "--sql" in sys.argv or "--stats" in sys.argv:
+        offline(sys.argv)
+        return
+
+    # ── Credentials ──
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
+
+    # ── Connect ──
+    phase("connect")
+    print("Connecting to Gmail IMAP...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+        print("Connected successfully.\n")
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        print("Make sure you're using an App Password, not your regular password.")
+        print("Create one at: https://myaccount.google.com/apppasswords")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        if not run(ctx):
+            sys.exit(1)
+    finally:
+        ctx.close()
+
+
+if __name__ == "__main__":
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run again to finish the sync.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
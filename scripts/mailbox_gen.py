@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Seeded synthetic Gmail accounts for scale testing.
+
+Builds a fake_imap.Account whose labels follow the scripts' own naming:
+the flat labels in organize-email.py's CATEGORY_MAP and
+delete-old-labels.py's OLD_LABELS, some already-categorized targets, the
+botched Finance/General/* and Finance/General/General/* nesting (some
+with sub-labels) that cleanup-email.py repairs, a few [Superhuman]
+labels, and filler client / project labels up to the requested count.
+Message counts per label follow a Zipf distribution (a handful of huge
+labels, a long tail of tiny ones); messages carry extra labels as on
+Gmail, and some carry none at all.
+
+Messages are bulk-loaded straight into the store instead of APPENDed, so
+a 1M-message account builds in seconds. The same seed always gives the
+same account.
+
+Usage:
+    python3 mailbox_gen.py --labels 1000 --messages 1000000       # Build and report
+    python3 mailbox_gen.py --labels 1000 --serve 1143             # Serve on 127.0.0.1:1143
+        then: GMAIL_REORG_SERVER=imap://127.0.0.1:1143 GMAIL_REORG_RATE_PROFILE=bench \\
+              python3 organize-email.py
+"""
+
+import random
+import sys
+import time
+from itertools import accumulate
+
+from fake_imap import Account, FakeIMAPServer
+from imap_run import load_script
+from imap_session import RATE_PROFILE_ENV
+
+FILLER_PARENTS = ["Clients", "Projects", "Vendors", "Archive", "Team"]
+FILLER_WORDS = ["Acme", "Harbor", "Summit", "Pelican", "Coastal", "Atlas",
+                "Beacon", "Cedar", "Delta", "Ember", "Falcon", "Granite",
+                "Horizon", "Island", "Juniper", "Keystone", "Lagoon", "Marina"]
+SUPERHUMAN = ["[Superhuman]/Reminders", "[Superhuman]/Snoozed", "[Superhuman]/Sent"]
+
+
+def label_names(rng, count):
+    """`count` label names in the shapes the scripts deal with.
+
+    Every shape is present at any size: a few existing merge targets
+    (each with a source to merge into it), a few OLD_LABELS, the botched
+    nesting and [Superhuman] come first, then the other existing targets,
+    flat labels and filler fill up to or are trimmed to `count`. Smaller
+    counts still get the first group.
+    """
+    organize = load_script("organize-email.py")
+    delete = load_script("delete-old-labels.py")
+    flat = [src for sources in organize.CATEGORY_MAP.values() for src in sources]
+    flat += delete.OLD_LABELS
+    targets = list(organize.CATEGORY_MAP)
+    finance = [t[len("Finance/"):] for t in targets if t.startswith("Finance/")]
+
+    # Some targets already exist, so organize has to merge into them
+    existing = rng.sample(targets, len(targets) // 4)
+    names = [name for target in existing[:4] for name in (target, organize.CATEGORY_MAP[target][0])]
+    names += rng.sample(delete.OLD_LABELS, min(3, len(delete.OLD_LABELS)))
+    # The nesting an earlier run botched
+    double = rng.sample(finance, 4)
+    names += [f"Finance/General/{f}" for f in double]
+    names += [f"Finance/General/General/{f}" for f in rng.sample(finance, 4)]
+    # ...some with sub-labels of their own
+    names += [f"Finance/General/{f}/{year}" for f in double[:2] for year in (2019, 2020)]
+    names += SUPERHUMAN
+    names = list(dict.fromkeys(names))
+    if len(names) >= count:
+        return names
+
+    names = list(dict.fromkeys(names + existing + flat))[:count]
+    i = 0
+    while len(names) < count:
+        parent = FILLER_PARENTS[i % len(FILLER_PARENTS)]
+        word = FILLER_WORDS[(i // len(FILLER_PARENTS)) % len(FILLER_WORDS)]
+        names.append(f"{parent}/{word} {i:05d}")
+        i += 1
+    return names
+
+
+def generate(seed=1, labels=1000, messages=100_000, skew=1.1, multi=0.3,
+             unlabelled=0.15, inbox=0.05):
+    """Build a synthetic Account.
+
+    skew is the Zipf exponent for label sizes; multi is the chance that a
+    message gets each additional label; unlabelled is the share of
+    messages only in All Mail; inbox the share also labelled INBOX.
+    """
+    rng = random.Random(seed)
+    names = label_names(rng, labels)
+    folders = names + ["INBOX"]
+
+    # Zipf weights, assigned to labels in random order
+    ranks = list(range(1, len(names) + 1))
+    rng.shuffle(ranks)
+    cum = list(accumulate(1.0 / r ** skew for r in ranks))
+    picks = iter(rng.choices(names, cum_weights=cum, k=messages * 2))
+    domains = [n.split("/")[-1].lower().replace(" ", "-").replace("&", "and")
+               for n in names]
+    sender_of = dict(zip(names, domains))
+    start = 1_420_070_400  # 2015-01-01
+    dates = [time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+                           time.gmtime(start + rng.randrange(10 * 365 * 86400)))
+             for _ in range(4096)]
+    random_ = rng.random
+
+    def stream():
+        for n in range(messages):
+            r = random_()
+            if r < unlabelled:
+                labels_ = []
+                sender = "news"
+            else:
+                first = next(picks)
+                labels_ = [first]
+                while random_() < multi:
+                    extra = next(picks, first)
+                    if extra not in labels_:
+                        labels_.append(extra)
+                sender = sender_of[first]
+            if r > 1 - inbox:
+                labels_.append("INBOX")
+            raw = (f"From: {sender} <notify@{sender}.example.com>\r\n"
+                   f"To: owner@example.com\r\n"
+                   f"Subject: {sender} update {n}\r\n"
+                   f"Date: {dates[n & 4095]}\r\n"
+                   f"Message-ID: <{seed}.{n}@{sender}.example.com>\r\n"
+                   f"\r\nSynthetic message {n}.\r\n").encode()
+            yield raw, labels_
+
+    account = Account()
+    account.bulk_load(folders, stream())
+    return account
+
+
+def summary(account):
+    """Label count, message count and the largest labels."""
+    sizes = sorted(((len(f.uids), name) for name, f in account.folders.items()
+                    if not name.startswith("[Gmail]")), reverse=True)
+    labelled = sum(1 for m in account.messages.values() if m.labels)
+    multi = sum(1 for m in account.messages.values() if len(m.labels) > 1)
+    return sizes, labelled, multi
+
+
+def option(name, default):
+    """Value following `name` in argv, or default."""
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+
+def main():
+    seed = int(option("--seed", "1"))
+    labels = int(option("--labels", "1000"))
+    messages = int(option("--messages", "100000"))
+    port = option("--serve", None)
+
+    t0 = time.perf_counter()
+    account = generate(seed, labels, messages)
+    elapsed = time.perf_counter() - t0
+    sizes, labelled, multi = summary(account)
+
+    print("=" * 62)
+    print(f"  Synthetic account (seed {seed})")
+    print("=" * 62)
+    print(f"  Labels:     {len(account.folders)} (incl. system folders)")
+    print(f"  Messages:   {len(account.messages)} "
+          f"({labelled} labelled, {multi} with several labels)")
+    print(f"  Built in:   {elapsed:.2f}s")
+    print("\n  Largest labels:")
+    for count, name in sizes[:10]:
+        print(f"    {name:<40} {count:>8} msgs")
+    print(f"  Empty labels: {sum(1 for c, _ in sizes if c == 0)}")
+
+    if port is None:
+        return
+    server = FakeIMAPServer(account, port=int(port))
+    host, port = server.address
+    print(f"\n  Serving on imap://{host}:{port} (any login). Ctrl-C to stop.")
+    print(f"  GMAIL_REORG_SERVER=imap://{host}:{port} "
+          f"{RATE_PROFILE_ENV}=bench python3 organize-email.py")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nStopped.")
@@ -9,15 +9,28 @@ Requires a Gmail App Password:
   3. Copy the 16-character password
 
 Usage:
-    python3 organize-email.py                # Dry-run (preview only)
+    python3 organize-email.py                # Dry-run (preview only, saves plan)
     python3 organize-email.py --execute      # Apply changes
+    python3 organize-email.py --apply [PLAN] # Apply the saved dry-run plan
+    python3 organize-email.py --execute --jobs 8   # Use 8 IMAP connections
+    python3 organize-email.py --profile [TRACE]    # Latency report (+ JSON trace)
+    python3 organize-email.py --refresh      # Ignore cached folder counts
+    python3 organize-email.py --offline      # Dry-run from the envelope index (index-email.py)
+    python3 organize-email.py --execute --yes      # Unattended: no prompts (see imap_credentials)
+    python3 organize-email.py --execute --snapshot DIR   # Export affected folders first (see imap_snapshot)
 """
 
 import imaplib
-import getpass
 import sys
-import time
-import re
+
+from imap_credentials import CredentialError, confirm, get_credentials
+from imap_folders import FolderTree
+from imap_helpers import imap_encode, move_all
+from imap_journal import (Journal, apply_arg, check_plan, journal_path,
+                          load_plan, plan_op, plan_path, save_plan)
+from imap_pool import run_parallel
+from imap_run import Context, offline_context
+from imap_trace import phase, profile_arg
 
 # ──────────────────────────────────────────────
 # Folder mapping: source → destination
@@ -151,55 +164,11 @@ SKIP_FOLDERS = {"INBOX", "[Gmail]", "[Superhuman]", "[Gmail]/All Mail",
                 "[Gmail]/Bin", "[Superhuman]/Snoozed", "[Superhuman]/Read Later"}
 
 
-def imap_utf7_encode(text):
-    """Encode string to IMAP modified UTF-7 (& must become &-)."""
-    return text.replace('&', '&-')
-
-
-def imap_encode(folder_name):
-    """Quote and encode folder name for IMAP."""
-    encoded = imap_utf7_encode(folder_name)
-    return f'"{encoded}"'
-
-
-def parse_folder_list(response):
-    """Parse LIST response into folder names."""
-    folders = []
-    for item in response:
-        if isinstance(item, bytes):
-            item = item.decode("utf-8", errors="replace")
-        # Match: (\flags) "separator" "folder name" or (\flags) "sep" folder
-        match = re.match(r'\(.*?\)\s+"(.+?)"\s+"?(.+?)"?\s*$', item)
-        if match:
-            name = match.group(2).strip('"')
-            folders.append(name)
-        else:
-            # Try simpler pattern
-            match = re.match(r'\(.*?\)\s+"(.+?)"\s+(.+)', item)
-            if match:
-                name = match.group(2).strip('"')
-                folders.append(name)
-    return folders
-
-
-def get_message_count(imap, folder):
-    """Get number of messages in a folder."""
-    try:
-        status, data = imap.select(imap_encode(folder), readonly=True)
-        if status == "OK":
-            count = int(data[0])
-            imap.close()
-            return count
-    except Exception:
-        pass
-    return 0
-
-
-def merge_folder(imap, source, dest):
+def merge_folder(imap, source, dest, caps, progress=None):
     """Move all messages from source to dest, then delete source."""
     try:
-        # Select source
-        status, data = imap.select(imap_encode(source))
+        # Select source (read-only, just for the message count)
+        status, data = imap.select(imap_encode(source), readonly=True)
         if status != "OK":
             print(f"    [!] Could not select {source}: {data}")
             return False
@@ -213,25 +182,15 @@ def merge_folder(imap, source, dest):
                 print(f"    Deleted empty folder: {source}")
             return True
 
-        # Copy all messages to destination
-        print(f"    Copying {msg_count} messages from '{source}' → '{dest}'...")
-        status, data = imap.uid("COPY", "1:*", imap_encode(dest))
-        if status != "OK":
-            print(f"    [!] COPY failed: {data}")
-            imap.close()
-            return False
+        imap.close()
 
-        # Mark as deleted in source
-        status, data = imap.uid("STORE", "1:*", "+FLAGS", "(\\Deleted)")
-        if status != "OK":
-            print(f"    [!] DELETE flag failed: {data}")
-            imap.close()
+        # Move all messages to destination (Gmail relabel, UID MOVE, or COPY)
+        print(f"    Moving {msg_count} messages from '{source}' → '{dest}'...")
+        ok, data = move_all(imap, source, dest, caps, progress)
+        if not ok:
+            print(f"    [!] MOVE failed: {data}")
             return False
 
-        # Expunge
-        imap.expunge()
-        imap.close()
-
         # Delete the now-empty folder
         status, data = imap.delete(imap_encode(source))
         if status == "OK":
@@ -264,46 +223,8 @@ def rename_folder(imap, source, dest):
         return False
 
 
-def main():
-    execute = "--execute" in sys.argv
-
-    print("=" * 62)
-    print("  Gmail IMAP Folder Reorganizer — Frost Peak")
-    print("  Consolidates folders into 8 top-level categories")
-    print("=" * 62)
-    print()
-
-    if not execute:
-        print("  MODE: DRY RUN (preview only)")
-        print("  Add --execute to apply changes")
-    else:
-        print("  MODE: EXECUTE (changes will be applied!)")
-    print()
-
-    # ── Credentials ──
-    email = input("Email: ").strip()
-    password = getpass.getpass("App Password: ")
-    print()
-
-    # ── Connect ──
-    print("Connecting to Gmail IMAP...")
-    try:
-        imap = imaplib.IMAP4_SSL("imap.gmail.com", 993)
-        imap.login(email, password)
-        print("Connected successfully.\n")
-    except imaplib.IMAP4.error as e:
-        print(f"Login failed: {e}")
-        print("Make sure you're using an App Password, not your regular password.")
-        print("Create one at: https://myaccount.google.com/apppasswords")
-        sys.exit(1)
-
-    # ── List current folders ──
-    status, folder_data = imap.list()
-    if status != "OK":
-        print("Failed to list folders.")
-        sys.exit(1)
-
-    existing_folders = set(parse_folder_list(folder_data))
+def plan_changes(existing_folders, counts):
+    """Print the rename/merge plan for the listed folders and return its operations."""
     print(f"Found {len(existing_folders)} folders on server.\n")
 
     # ── Build operations ──
@@ -315,7 +236,9 @@ def main():
     mapped_sources = set()
 
     for dest, sources in CATEGORY_MAP.items():
-        primary = None
+        # Destination already there (e.g. renamed by an earlier, interrupted
+        # run): every remaining source merges into it.
+        primary = dest if dest in existing_folders else None
         for i, src in enumerate(sources):
             if src not in existing_folders:
                 skipped.append(src)
@@ -329,18 +252,16 @@ def main():
                 # Subsequent sources → merge into the renamed dest
                 merges.append((src, primary))
 
-    # Find folders we're not touching
-    for f in sorted(existing_folders):
-        is_skip = False
-        for skip in SKIP_FOLDERS:
-            if f == skip or f.startswith(skip + "/"):
-                is_skip = True
-                break
-        if not is_skip and f not in mapped_sources:
-            # Check if it's a subfolder of a mapped source
-            parent = f.split("/")[0] if "/" in f else None
-            if parent not in mapped_sources:
-                untouched.append(f)
+    # Find folders we're not touching: not system folders, and neither a
+    # mapped source nor inside one (a rename takes its sub-folders along)
+    skip = FolderTree(SKIP_FOLDERS, existing_folders.delimiter)
+    mapped = FolderTree(mapped_sources, existing_folders.delimiter)
+    for f in existing_folders:
+        if skip.covering(f) is None and mapped.covering(f) is None:
+            untouched.append(f)
+
+    # Count every source in one pipelined batch rather than per folder
+    counts.prefetch_many([src for src, _ in renames + merges])
 
     # ── Print plan ──
     print("─" * 62)
@@ -354,7 +275,7 @@ def main():
     print("MERGE OPERATIONS (move messages, delete duplicate):")
     print("─" * 62)
     for src, dst in merges:
-        count = get_message_count(imap, src) if execute else "?"
+        count = counts.get(src)
         print(f"  {src:<35} → {dst}  ({count} msgs)")
     print(f"\n  Total: {len(merges)} merges\n")
 
@@ -374,13 +295,78 @@ def main():
             print(f"  {u}")
         print()
 
+    ops = [plan_op(counts, "rename", src, dst) for src, dst in renames]
+    ops += [plan_op(counts, "merge", src, dst) for src, dst in merges]
+    return ops
+
+
+def banner(argv):
+    execute = "--execute" in argv or "--apply" in argv
+    print("=" * 62)
+    print("  Gmail IMAP Folder Reorganizer — Frost Peak")
+    print("  Consolidates folders into 8 top-level categories")
+    print("=" * 62)
+    print()
+
     if not execute:
+        print("  MODE: DRY RUN (preview only)")
+        print("  Add --execute to apply changes")
+    elif "--apply" in argv:
+        print("  MODE: APPLY saved dry-run plan (changes will be applied!)")
+    else:
+        print("  MODE: EXECUTE (changes will be applied!)")
+    print()
+
+
+def run(ctx):
+    """Plan and (with --execute) apply the reorganization; False if aborted."""
+    execute = "--execute" in ctx.argv or "--apply" in ctx.argv
+    email, caps, counts, cache = ctx.email, ctx.caps, ctx.counts, ctx.cache
+    plan_file = apply_arg(ctx.argv, "organize", email)
+    journal = Journal(journal_path("organize", email)) if execute else None
+
+    phase("plan")
+    if plan_file:
+        # ── Load saved plan; only re-check it with STATUS ──
+        try:
+            plan = load_plan(plan_file, "organize", email)
+        except (OSError, ValueError) as e:
+            print(f"Cannot load plan: {e}")
+            sys.exit(1)
+        ops = plan["ops"]
+        print(f"Loaded plan: {plan_file} ({len(ops)} operations)")
+        problems, changed = check_plan(plan, counts, journal)
+        for c in changed:
+            print(f"  [~] {c}")
+        if problems:
+            print("\nServer changed since the dry run; re-run it to refresh the plan:")
+            for p in problems:
+                print(f"  [!] {p}")
+            journal.close(keep=journal.resumed())
+            sys.exit(1)
+        print()
+    else:
+        folders = ctx.list_folders()
+        if folders is None:
+            print("Failed to list folders.")
+            sys.exit(1)
+        ops = plan_changes(folders, counts)
+
+    renames = [op for op in ops if op["op"] == "rename"]
+    merges = [op for op in ops if op["op"] == "merge"]
+    cache.report_outcomes("organize", ops)
+
+    if not execute:
+        ctx.applied(ops, [True] * len(ops))
         print("=" * 62)
         print("  DRY RUN complete. No changes were made.")
-        print("  Run with --execute to apply these changes.")
+        if not (ctx.pipeline or ctx.offline):
+            save_plan(plan_path("organize", email), "organize", email, ops)
+            print("  Run with --execute to apply these changes,")
+            print("  or --apply to run exactly this plan without re-listing.")
+            print(f"  Plan saved: {plan_path('organize', email)}")
         print("=" * 62)
-        imap.logout()
-        return
+        return True
 
     # ── Confirm ──
     print("=" * 62)
@@ -388,40 +374,51 @@ def main():
     print("  This will reorganize your Gmail folders.")
     print("  Messages are NEVER deleted — only moved between folders.")
     print("=" * 62)
-    confirm = input("\n  Type 'yes' to proceed: ").strip().lower()
-    if confirm != "yes":
+    if not confirm(ctx.argv, "\n  Type 'yes' to proceed: "):
         print("Aborted.")
-        imap.logout()
-        return
+        journal.close(keep=journal.resumed())
+        return False
 
     print()
+    if not ctx.snapshot(ops):
+        print("Snapshot incomplete; nothing was changed.")
+        journal.close(keep=journal.resumed())
+        return False
 
-    # ── Phase 1: Renames ──
-    print("Phase 1: Renaming folders...")
-    rename_ok = 0
-    rename_fail = 0
-    for src, dst in renames:
-        if rename_folder(imap, src, dst):
-            rename_ok += 1
+    if journal.resumed():
+        print(f"Resuming interrupted run ({len(journal.done)} operations already done)\n")
+    for op in ops:
+        journal.planned(op["op"], op["src"], op["dst"], op["uidvalidity"])
+
+    def apply_op(conn, op):
+        """Rename or merge on one pooled connection, skipping journaled work."""
+        key = (op["op"], op["src"], op["dst"], op["uidvalidity"])
+        if journal.is_done(*key):
+            print(f"    Already done: {op['op']} '{op['src']}' → '{op['dst']}'")
+            return True
+        if op["op"] == "rename":
+            ok = rename_folder(conn, op["src"], op["dst"])
         else:
-            rename_fail += 1
-        time.sleep(0.2)  # Be gentle on Gmail
-
-    print(f"\n  Renames: {rename_ok} OK, {rename_fail} failed\n")
-
-    # ── Phase 2: Merges ──
-    if merges:
-        print("Phase 2: Merging duplicate folders...")
-        merge_ok = 0
-        merge_fail = 0
-        for src, dst in merges:
-            if merge_folder(imap, src, dst):
-                merge_ok += 1
-            else:
-                merge_fail += 1
-            time.sleep(0.3)
+            ok = merge_folder(conn, op["src"], op["dst"], caps, journal.progress)
+        journal.record(ok, *key)
+        return ok
+
+    # ── Renames and merges, independent ones in parallel ──
+    phase("apply")
+    cache.invalidate()
+    # A merge waits for the rename that creates its destination.
+    print(f"Applying {len(renames)} renames + {len(merges)} merges "
+          f"on up to {ctx.jobs} connections...")
+    results = run_parallel(ops, apply_op, ctx.pool(), ctx.delimiter())
+    cache.record_outcomes("organize", ops, results)
+    ctx.applied(ops, results)
+
+    for kind, label in (("rename", "Renames"), ("merge", "Merges")):
+        done = [ok for op, ok in zip(ops, results) if op["op"] == kind]
+        print(f"\n  {label}: {sum(done)} OK, {len(done) - sum(done)} failed")
+    print()
 
-        print(f"\n  Merges: {merge_ok} OK, {merge_fail} failed\n")
+    journal.close()
 
     # ── Done ──
     print("=" * 62)
@@ -429,9 +426,55 @@ def main():
     print("  Restart Thunderbird to see the new folder structure.")
     print("  In Thunderbird: right-click account → Subscribe → refresh")
     print("=" * 62)
+    return True
+
+
+def main():
+    banner(sys.argv)
+
+    if "--offline" in sys.argv:
+        ctx = offline_context(sys.argv)
+        try:
+            run(ctx)
+        finally:
+            ctx.close()
+        return
+
+    # ── Credentials ──
+    try:
+        email, password = get_credentials(sys.argv)
+    except CredentialError as e:
+        print(e)
+        sys.exit(1)
+    print()
 
-    imap.logout()
+    # ── Connect ──
+    phase("connect")
+    print("Connecting to Gmail IMAP...")
+    ctx = Context(email, password, sys.argv)
+    try:
+        ctx.connect()
+        print("Connected successfully.\n")
+    except imaplib.IMAP4.error as e:
+        print(f"Login failed: {e}")
+        print("Make sure you're using an App Password, not your regular password.")
+        print("Create one at: https://myaccount.google.com/apppasswords")
+        sys.exit(1)
+
+    ctx.describe()
+    try:
+        run(ctx)
+    finally:
+        ctx.close()
 
 
 if __name__ == "__main__":
-    main()
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run with --execute again to resume where it stopped.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Gmail reorganization pipeline — organize → cleanup → delete-old-labels
+
+Runs the three scripts' phases in order over one login: credentials are
+asked for once, the account is listed and counted once, and the folder
+tree and counts are carried from one phase to the next (see imap_run).
+In a dry run each phase plans against the account as the earlier phases
+would leave it, so the preview covers the whole reorganization.
+
+With --accounts, the same phases run against many mailboxes at once.
+Each account gets its own session, connection pool (--jobs is per
+account) and rate limiter, so throughput grows with the number of
+accounts; --parallel caps how many run at a time. Each account's output
+goes to its own log in the state directory and a single table sums them
+up. Passwords come from imap_credentials ("{email}" in a password file
+or command picks each account's own); --execute needs --yes, as there is
+nobody to answer per-account prompts.
+
+Usage:
+    python3 reorg-email.py                # Dry-run all three phases
+    python3 reorg-email.py --execute      # Apply all three phases
+    python3 reorg-email.py --execute --jobs 8   # Use 8 IMAP connections
+    python3 reorg-email.py --profile [TRACE]    # Latency report (+ JSON trace)
+    python3 reorg-email.py --refresh      # Ignore cached folder counts
+    python3 reorg-email.py --offline      # Dry-run from the envelope index (index-email.py)
+    python3 reorg-email.py --execute --yes      # Unattended: no prompts (see imap_credentials)
+    python3 reorg-email.py --execute --snapshot DIR   # Export affected folders first (see imap_snapshot)
+    python3 reorg-email.py --phases organize,cleanup     # Only these phases
+    python3 reorg-email.py --accounts FILE [--parallel N]  # Many accounts (one per line)
+
+Saved plans (--apply) belong to the individual scripts; run them on their
+own to review and apply a plan phase by phase.
+"""
+
+import contextvars
+import imaplib
+import io
+import os
+import sys
+import time
+
+from imap_credentials import CredentialError, arg_value, get_credentials, get_password
+from imap_journal import journal_path
+from imap_pool import ContextExecutor, jobs_arg
+from imap_run import Context, load_script, offline_context
+from imap_trace import phase, profile_arg
+
+PHASES = {
+    "organize": "organize-email.py",
+    "cleanup": "cleanup-email.py",
+    "delete-old-labels": "delete-old-labels.py",
+}
+MAX_PARALLEL = 8
+
+
+def chosen_phases(argv):
+    """[(name, module)] for `--phases a,b` (default: all), in pipeline order."""
+    names = (arg_value(argv, "--phases") or ",".join(PHASES)).split(",")
+    unknown = [n for n in names if n not in PHASES]
+    if unknown:
+        print(f"Unknown phase: {', '.join(unknown)} (choose from {', '.join(PHASES)})")
+        sys.exit(2)
+    return [(name, load_script(PHASES[name])) for name in PHASES if name in names]
+
+
+def run_phases(ctx, scripts):
+    """Run the phases in order over one Context; False if one was aborted."""
+    for name, script in scripts:
+        print()
+        script.banner(ctx.argv)
+        if not script.run(ctx):
+            print(f"\nStopped after {name}; later phases were not run.")
+            return False
+    return True
+
+
+# ── Batch mode ──
+
+def read_accounts(value):
+    """Addresses from an accounts file (one per line, # comments) or a comma list."""
+    if os.path.isfile(value):
+        with open(value, encoding="utf-8") as fh:
+            items = [line.split("#", 1)[0] for line in fh]
+    else:
+        items = value.split(",")
+    return list(dict.fromkeys(item.strip() for item in items if item.strip()))
+
+
+class AccountOutput(io.TextIOBase):
+    """sys.stdout stand-in that sends each account's prints to its log.
+
+    The log is held in a ContextVar, which imap_pool.ContextExecutor
+    carries into the threads an account's phases start (the connection
+    pool, snapshots), so their output lands in the same log.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.stream = contextvars.ContextVar("reorg_account_log", default=None)
+
+    def _stream(self):
+        return self.stream.get() or self.default
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def flush(self):
+        self._stream().flush()
+
+
+def run_account(email, password, scripts, output):
+    """All phases for one account, printing to its log; returns its summary row."""
+    log = journal_path("batch", email)[:-len(".jsonl")] + ".log"
+    os.makedirs(os.path.dirname(log), exist_ok=True)
+    started = time.monotonic()
+    ctx = Context(email, password, sys.argv)
+    ctx.pipeline = True
+    status = "ok"
+    with open(log, "w", encoding="utf-8") as fh:
+        token = output.stream.set(fh)
+        try:
+            ctx.connect()
+            ctx.describe()
+            if not run_phases(ctx, scripts):
+                status = "stopped"
+        except imaplib.IMAP4.error as e:
+            status = f"IMAP error: {e}"
+        except SystemExit as e:
+            status = f"exited ({e.code})"
+        except Exception as e:
+            status = f"error: {e}"
+        finally:
+            ctx.close()
+            output.stream.reset(token)
+    return {"email": email, "status": status, "seconds": time.monotonic() - started,
+            "stats": ctx.stats, "log": log}
+
+
+def batch_main(scripts, execute):
+    accounts = read_accounts(arg_value(sys.argv, "--accounts") or "")
+    if not accounts:
+        print("No accounts given (--accounts FILE or a comma-separated list).")
+        sys.exit(2)
+    if execute and "--yes" not in sys.argv:
+        print("Batch --execute has no one to confirm each account; add --yes.")
+        sys.exit(2)
+    try:
+        parallel = int(arg_value(sys.argv, "--parallel") or MAX_PARALLEL)
+    except ValueError:
+        parallel = MAX_PARALLEL
+    parallel = max(1, min(parallel, len(accounts)))
+
+    # Collect every password up front so prompts happen before the threads start
+    passwords = {}
+    for email in accounts:
+        try:
+            passwords[email] = get_password(email, sys.argv, f"App Password for {email}: ")
+        except CredentialError as e:
+            print(f"{email}: {e}")
+            sys.exit(1)
+
+    print(f"Running {', '.join(name for name, _ in scripts)} on {len(accounts)} accounts, "
+          f"{parallel} at a time (up to {jobs_arg(sys.argv)} connections each)...\n")
+    phase("batch")
+    output = AccountOutput(sys.stdout)
+    sys.stdout = output
+    started = time.monotonic()
+    rows = []
+    try:
+        with ContextExecutor(max_workers=parallel) as executor:
+            futures = [executor.submit(run_account, email, passwords[email], scripts, output)
+                       for email in accounts]
+            for future in futures:
+                row = future.result()
+                rows.append(row)
+                print(f"  {row['email']}: {row['status']} ({row['seconds']:.1f}s)")
+    finally:
+        sys.stdout = output.default
+    elapsed = time.monotonic() - started
+
+    print()
+    print("=" * 62)
+    print(f"  BATCH {'SUMMARY' if execute else 'DRY RUN'}: {len(accounts)} accounts "
+          f"in {elapsed:.1f}s")
+    print("=" * 62)
+    header = f"  {'Account':<30} {'Renames':>7} {'Merges':>6} {'Deletes':>7} {'Failed':>6} {'Time s':>7}  Status"
+    print(header)
+    print("  " + "─" * (len(header) - 2))
+    totals = {"rename": 0, "merge": 0, "delete": 0, "failed": 0}
+    for row in rows:
+        stats = row["stats"]
+        for key in totals:
+            totals[key] += stats[key]
+        print(f"  {row['email'][:30]:<30} {stats['rename']:>7} {stats['merge']:>6} "
+              f"{stats['delete']:>7} {stats['failed']:>6} {row['seconds']:>7.1f}  {row['status']}")
+    print("  " + "─" * (len(header) - 2))
+    print(f"  {'Total':<30} {totals['rename']:>7} {totals['merge']:>6} "
+          f"{totals['delete']:>7} {totals['failed']:>6} {elapsed:>7.1f}")
+    print(f"\n  Logs: {os.path.dirname(rows[0]['log'])}/batch-<account>.log")
+    if any(row["status"] != "ok" or row["stats"]["failed"] for row in rows):
+        sys.exit(1)
+
+
+def main():
+    execute = "--execute" in sys.argv
+    print("=" * 62)
+    print("  Gmail reorganization pipeline")
+    print("  organize → cleanup → delete old labels, one session")
+    print("=" * 62)
+    print(f"  MODE: {'EXECUTE (changes will be applied!)' if execute else 'DRY RUN (preview only)'}")
+    print()
+    if "--apply" in sys.argv:
+        print("--apply runs one script's saved plan; use the scripts on their own for that.")
+        sys.exit(2)
+
+    scripts = chosen_phases(sys.argv)
+    if "--accounts" in sys.argv:
+        batch_main(scripts, execute)
+        return
+
+    if "--offline" in sys.argv:
+        ctx = offline_context(sys.argv)
+    else:
+        try:
+            email, password = get_credentials(sys.argv)
+        except CredentialError as e:
+            print(e)
+            sys.exit(1)
+        print()
+
+        phase("connect")
+        print("Connecting to Gmail IMAP...")
+        ctx = Context(email, password, sys.argv)
+        try:
+            ctx.connect()
+            print("Connected successfully.\n")
+        except imaplib.IMAP4.error as e:
+            print(f"Login failed: {e}")
+            print("Make sure you're using an App Password, not your regular password.")
+            print("Create one at: https://myaccount.google.com/apppasswords")
+            sys.exit(1)
+        ctx.describe()
+
+    ctx.pipeline = True
+    try:
+        if not run_phases(ctx, scripts):
+            return
+    finally:
+        ctx.close()
+
+    print()
+    print("=" * 62)
+    print(f"  Pipeline {'complete' if execute else 'dry run complete'}: "
+          f"{len(ctx.folders or ())} labels")
+    print("=" * 62)
+
+
+if __name__ == "__main__":
+    tracer = profile_arg(sys.argv)
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nInterrupted. Run with --execute again to resume where it stopped.")
+        sys.exit(130)
+    finally:
+        if tracer:
+            tracer.finish()